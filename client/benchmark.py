@@ -0,0 +1,215 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Throughput benchmarks for the host side code. These run without a
+# controller attached. Run
+#
+#     python3 benchmark.py NAME [-n SAMPLES]
+#
+# where NAME is one of the keys of ``benchmarks`` at the bottom of this
+# file.
+
+import argparse
+import os
+import time
+import numpy as np
+from util import *
+
+def best_time(f, *args, repeat=5):
+    """
+    Run ``f(*args)`` ``repeat`` times.
+
+    :return: Tuple of the fastest run time in seconds and the return
+      value of the last run.
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        r = f(*args)
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best, r
+
+def report(name, n, t):
+    print(f"{name:<32} {n/t/1e6:10.3f} M/s ({t*1e3:.3f} ms for {n})")
+
+def bench_codec(args):
+    """ Scalar vs. vectorized sign extension and fixed point conversion. """
+    rng = np.random.default_rng(args.seed)
+    n = args.n
+
+    # 18 bit ADC words, both as an array and as the raw bytes that
+    # come out of ``machine.mem32`` reads.
+    words = rng.integers(0, 1 << 18, n, dtype=np.uint32)
+    raw = words.tobytes()
+    pywords = words.tolist()
+
+    t, scalar = best_time(lambda: [sign_extend(v, 18) for v in pywords])
+    report("sign_extend (scalar)", n, t)
+    t, vector = best_time(sign_extend_array, words, 18)
+    report("sign_extend_array", n, t)
+    t, vector_raw = best_time(sign_extend_array, raw, 18)
+    report("sign_extend_array (bytes)", n, t)
+    assert vector.tolist() == scalar
+    assert vector_raw.tolist() == scalar
+
+    # 21.43 fixed point control loop parameters.
+    fxp = rng.integers(-(1 << 52), 1 << 52, n, dtype=np.int64)
+    ufxp = fxp.astype(np.uint64)
+    t, fl = best_time(fixed_point_to_float, ufxp, 43)
+    report("fixed_point_to_float", n, t)
+    t, back = best_time(float_to_fixed_point, fl, 43)
+    report("float_to_fixed_point", n, t)
+    # Values with at most 53 significant bits survive the round trip.
+    assert (back == fxp).all()
+
+def bench_frames(args):
+    """ Text protocol parsing vs. binary frame decoding. """
+    rng = np.random.default_rng(args.seed)
+    per_frame = 20
+    n = args.n - args.n % per_frame
+    words = rng.integers(0, 1 << 18, n, dtype=np.uint32)
+
+    # Old protocol: one "dac adc" line per sample.
+    text = [f"{i // per_frame} {w}" for i, w in enumerate(words.tolist())]
+    def parse_text():
+        return [sign_extend(int(l.split(' ')[1]), 18) for l in text]
+
+    # New protocol: frames of samples as sent by comm.FrameWriter.
+    data = bytearray()
+    for seq, i in enumerate(range(0, n, per_frame)):
+        data += FRAME_HEADER.pack(FRAME_MAGIC, 1, 18, FRAME_SIGNED, 0,
+                                  per_frame, seq)
+        data += words[i:i+per_frame].astype('<u4').tobytes()
+    data = bytes(data)
+    def parse_frames():
+        dec = FrameDecoder()
+        return np.concatenate([f.samples for i in range(0, len(data), 65536)
+                               for f in dec.feed(data[i:i+65536])])
+
+    t, text_samples = best_time(parse_text)
+    report("text lines", n, t)
+    t, frame_samples = best_time(parse_frames)
+    report(f"binary frames ({per_frame}/frame)", n, t)
+    assert frame_samples.tolist() == text_samples
+    print(f"text {sum(len(l) + 1 for l in text)} bytes, "
+          f"binary {len(data)} bytes")
+
+def random_decimal_string(rng):
+    """ Random decimal string accepted by string_to_fixed_point. """
+    sign = "-" if rng.random() < 0.5 else ""
+    whole = str(rng.integers(0, 1 << 20)) if rng.random() < 0.7 else "0"
+    if rng.random() < 0.1:
+        return sign + whole
+    # string_to_fixed_point uses the default Decimal precision of 28
+    # digits, so it is only exact up to there.
+    digits = rng.integers(1, 28 - len(whole) + 1)
+    frac = "".join(str(d) for d in rng.integers(0, 10, digits))
+    return f"{sign}{whole}.{frac}"
+
+def bench_fixedpoint(args):
+    """
+    Exact fixed point conversions against the reference functions. That
+    they agree is checked by test_fixedpoint.py.
+    """
+    rng = np.random.default_rng(args.seed)
+    n = min(args.n, 20000)
+    fracnum = 43
+
+    strings = [random_decimal_string(rng) for _ in range(n)]
+    fxps = [int(v) for v in rng.integers(-(1 << 63), 1 << 63, n,
+                                         dtype=np.int64)]
+
+    # Microbenchmark. Cache hits are measured separately.
+    def uncached(f, vals):
+        f.cache_clear()
+        return [f(v, fracnum) for v in vals]
+    t, _ = best_time(lambda: [string_to_fixed_point(v, fracnum)
+                              for v in strings])
+    report("string_to_fixed_point", len(strings), t)
+    t, _ = best_time(uncached, to_fixed_point, strings)
+    report("to_fixed_point", len(strings), t)
+    # A sweep repeats a small set of values, which fits in the cache.
+    sweep = strings[:256] * (len(strings) // 256 + 1)
+    to_fixed_point.cache_clear()
+    t, _ = best_time(lambda: [to_fixed_point(v, fracnum) for v in sweep])
+    report("to_fixed_point (cached)", len(sweep), t)
+    t, _ = best_time(lambda: [fixed_point_to_string(v, fracnum)
+                              for v in fxps])
+    report("fixed_point_to_string", len(fxps), t)
+    t, _ = best_time(uncached, format_fixed_point, fxps)
+    report("format_fixed_point", len(fxps), t)
+
+def dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, f))
+               for f in os.listdir(path))
+
+def bench_columns(args):
+    """ CSV files against ColumnStore for noise_test.py samples. """
+    import pandas as pd
+    import shutil
+    import tempfile
+    from colstore import ColumnStore
+    rng = np.random.default_rng(args.seed)
+    per_frame = 64
+    n = args.n - args.n % per_frame
+    dac = np.repeat(np.arange(n // per_frame, dtype=np.int32), per_frame)
+    sample = rng.integers(-(1 << 17), 1 << 17, n, dtype=np.int32)
+
+    d = tempfile.mkdtemp()
+    try:
+        csv = os.path.join(d, "run.csv")
+        def write_csv():
+            # As before: the whole run is kept, then written at the end.
+            pd.DataFrame({"dac": dac, "sample": sample}).to_csv(csv)
+        def write_store():
+            path = os.path.join(d, "run.samples")
+            shutil.rmtree(path, ignore_errors=True)
+            # As noise_test.py: one append per frame.
+            with ColumnStore.create(path, {"dac": "i4", "sample": "i4"}) as st:
+                for i in range(0, n, per_frame):
+                    st.append(dac=dac[i], sample=sample[i:i + per_frame])
+            return path
+        t, _ = best_time(write_csv, repeat=3)
+        report("write CSV", n, t)
+        t, path = best_time(write_store, repeat=3)
+        report("write ColumnStore", n, t)
+
+        t, df = best_time(lambda: pd.read_csv(csv, index_col=0), repeat=3)
+        report("read CSV", n, t)
+        def read_store():
+            st = ColumnStore.open(path)
+            # Touch every row, since memory maps are read lazily.
+            return st.to_dict(), int(st["sample"].sum())
+        t, (cols, total) = best_time(read_store, repeat=3)
+        report("read ColumnStore (mmap)", n, t)
+        assert (cols["dac"] == df["dac"].to_numpy()).all()
+        assert (cols["sample"] == df["sample"].to_numpy()).all()
+        assert total == int(sample.sum())
+        print(f"CSV {dir_size(csv)} bytes, ColumnStore {dir_size(path)} bytes")
+    finally:
+        shutil.rmtree(d)
+
+benchmarks = {
+    "codec": bench_codec,
+    "frames": bench_frames,
+    "fixedpoint": bench_fixedpoint,
+    "columns": bench_columns,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upsilon client benchmarks")
+    parser.add_argument("name", choices=benchmarks.keys())
+    parser.add_argument("-n", type=int, default=1000000,
+                        help="number of samples")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    benchmarks[args.name](args)
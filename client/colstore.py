@@ -0,0 +1,214 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Columnar on-disk store for results of the client scripts, instead of
+# CSV files written at the end of a run.
+#
+# A store is a directory:
+#
+#   meta.json      columns and their types, and run parameters
+#   NAME.bin       raw little-endian array of column NAME
+#   rows.bin       int64 number of rows after each chunk
+#
+# Rows are buffered and written in chunks. All columns of a chunk are
+# written before its row count, so the store always has every chunk up to
+# the last row count, even if the run was aborted. Columns are memory
+# mapped when read.
+
+import json
+import os
+import time
+import numpy as np
+
+STORE_VERSION = 1
+
+class ColumnStore:
+    """
+    Table of typed columns stored on disk. Create with :meth:`create` or
+    open with :meth:`open`.
+    """
+
+    def __init__(self, path, meta, writable, chunk_rows=65536,
+                 flush_interval=1.0):
+        self.path = path
+        self.meta = meta
+        self.dtypes = {n: np.dtype(t) for n, t in meta['columns'].items()}
+        self.writable = writable
+        self.chunk_rows = chunk_rows
+        self.flush_interval = flush_interval
+        self.files = {}
+        # Rows waiting to be written, as lists of arrays for each column.
+        self.pending = {n: [] for n in self.dtypes}
+        self.pending_rows = 0
+        self.last_flush = time.monotonic()
+        self.written = self._stored_rows()
+        if writable:
+            self._open_files()
+
+    @classmethod
+    def create(cls, path, columns, chunk_rows=65536, flush_interval=1.0,
+               **params):
+        """
+        Create a new store.
+
+        :param path: Directory of the store. It must not exist.
+        :param columns: Dictionary from column name to NumPy type, e.g.
+          ``{'dac': 'i4', 'sample': 'i4'}``. Types are stored
+          little-endian.
+        :param chunk_rows: Rows buffered before a chunk is written.
+        :param flush_interval: Seconds after which buffered rows are
+          written even if there are less than ``chunk_rows``. ``None``
+          only writes full chunks.
+        :param params: Run parameters to keep in the metadata. They must
+          be JSON serializable.
+        """
+        os.makedirs(path)
+        meta = {
+            'version': STORE_VERSION,
+            'columns': {n: np.dtype(t).newbyteorder('<').str
+                        for n, t in columns.items()},
+            'created': time.time(),
+            'params': params,
+        }
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return cls(path, meta, True, chunk_rows, flush_interval)
+
+    @classmethod
+    def open(cls, path, append=False, **kwargs):
+        """
+        Open an existing store.
+
+        :param append: Open for appending rows. Column data after the
+          last complete chunk (from an aborted run) is dropped.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != STORE_VERSION:
+            raise Exception(f"unknown store version {meta['version']}")
+        st = cls(path, meta, append, **kwargs)
+        if append:
+            for n, f in st.files.items():
+                if n == 'rows.bin':
+                    f.truncate(f.tell() // 8 * 8)
+                else:
+                    f.truncate(st.written * st.dtypes[n[:-4]].itemsize)
+        return st
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _open_files(self):
+        for n in list(self.dtypes) + ['rows']:
+            self.files[n + '.bin'] = open(self._file(n + '.bin'), 'ab')
+
+    def _stored_rows(self):
+        try:
+            with open(self._file('rows.bin'), 'rb') as f:
+                size = os.fstat(f.fileno()).st_size // 8 * 8
+                if size == 0:
+                    return 0
+                f.seek(size - 8)
+                return int(np.frombuffer(f.read(8), dtype='<i8')[0])
+        except FileNotFoundError:
+            return 0
+
+    @property
+    def params(self):
+        return self.meta['params']
+
+    @property
+    def columns(self):
+        """ Names of the columns. """
+        return list(self.dtypes)
+
+    @property
+    def rows(self):
+        """ Number of rows in complete chunks. """
+        return self._stored_rows()
+
+    def __len__(self):
+        return self.rows
+
+    def append(self, **cols):
+        """
+        Add rows. Every column must be given, as an array or a scalar.
+        Scalars are repeated to the length of the arrays, e.g.
+        ``append(dac=5, sample=samples)``.
+        """
+        if not self.writable:
+            raise Exception("store is not open for appending")
+        if set(cols) != set(self.dtypes):
+            raise Exception(f"expected columns {self.columns}, "
+                            f"got {sorted(cols)}")
+        arrays = {n: np.asarray(v) for n, v in cols.items()}
+        n = max((a.size for a in arrays.values() if a.ndim > 0), default=1)
+        for name, a in arrays.items():
+            if a.ndim == 0:
+                a = np.full(n, a)
+            elif a.size != n:
+                raise Exception(f"column {name} has {a.size} rows, not {n}")
+            self.pending[name].append(a.ravel())
+        self.pending_rows += n
+
+        if self.pending_rows >= self.chunk_rows or \
+           (self.flush_interval is not None and
+            time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """ Write the buffered rows as a chunk. """
+        self.last_flush = time.monotonic()
+        if self.pending_rows == 0:
+            return
+        for name, parts in self.pending.items():
+            data = np.concatenate(parts).astype(self.dtypes[name], copy=False)
+            f = self.files[name + '.bin']
+            f.write(data.tobytes())
+            f.flush()
+            parts.clear()
+        self.written += self.pending_rows
+        self.pending_rows = 0
+        f = self.files['rows.bin']
+        f.write(np.array([self.written], dtype='<i8').tobytes())
+        f.flush()
+
+    def column(self, name):
+        """
+        :return: Read-only memory map of a column. Rows appended after
+          this call are not in the map.
+        """
+        n = self.rows
+        if n == 0:
+            return np.zeros(0, dtype=self.dtypes[name])
+        return np.memmap(self._file(name + '.bin'), dtype=self.dtypes[name],
+                         mode='r', shape=(n,))
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+    def to_dict(self):
+        """
+        :return: Dictionary from column name to memory map. This can be
+          passed directly to ``pandas.DataFrame``.
+        """
+        return {n: self.column(n) for n in self.dtypes}
+
+    def close(self):
+        if self.writable:
+            self.flush()
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.writable = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
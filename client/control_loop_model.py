@@ -0,0 +1,401 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Bit-exact model of the control loop arithmetic, for trying P, I and
+# delay settings without hardware.
+#
+# The model follows control_loop_math.v. Each function works on NumPy
+# arrays, so a whole batch of parameter sets is stepped at once.
+#
+#     python3 control_loop_model.py check     compare with the C++ model
+#     python3 control_loop_model.py bench     iterations per second
+#
+# 64 bit fixed point products need 128 bits, which NumPy does not have.
+# They are computed from 32 bit limbs in unsigned 64 bit arithmetic.
+
+import os
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from util import float_to_fixed_point
+
+# Parameters of control_loop_math.v.
+CONSTS_WHOLE = 21
+CONSTS_FRAC = 43
+ADC_WID = 18
+DAC_WID = 20
+CYCLE_COUNT_WID = 18
+SEC_PER_CYCLE = 0b10101011110011000
+ADC_TO_DAC = 0b0110010000000000000000000000000000000000000
+
+INT64_MIN = np.int64(-(1 << 63))
+INT64_MAX = np.int64((1 << 63) - 1)
+# The C++ model saturates negative numbers to -2**62 (see mul()).
+CPP_NEG_SAT = np.int64(-(1 << 62))
+_M32 = np.uint64(0xFFFFFFFF)
+
+Math = namedtuple('Math', ['e', 'dt', 'idt', 'epidt', 'ep', 'adj', 'dac'])
+
+def _i64(x):
+    return np.asarray(x, dtype=np.int64)
+
+def mul128(a, b):
+    """
+    Full signed product of two ``int64`` arrays.
+
+    :return: Tuple ``(hi, lo)`` of the high (``int64``) and low
+      (``uint64``) words of the 128 bit product.
+    """
+    a = _i64(a)
+    b = _i64(b)
+    ua = a.view(np.uint64)
+    ub = b.view(np.uint64)
+    s32 = np.uint64(32)
+    a0, a1 = ua & _M32, ua >> s32
+    b0, b1 = ub & _M32, ub >> s32
+    p00 = a0 * b0
+    p01 = a0 * b1
+    p10 = a1 * b0
+    mid = (p00 >> s32) + (p01 & _M32) + (p10 & _M32)
+    lo = (mid << s32) | (p00 & _M32)
+    hi = a1 * b1 + (p01 >> s32) + (p10 >> s32) + (mid >> s32)
+    # Unsigned to signed product: subtract b*2**64 if a < 0 and the
+    # other way around.
+    hi = hi - np.where(a < 0, ub, np.uint64(0)) \
+            - np.where(b < 0, ua, np.uint64(0))
+    return hi.view(np.int64), lo
+
+def mul(a, b, cpp=False):
+    """
+    Fixed point multiplication, as done by ``boothmul`` followed by
+    ``intsat`` in control_loop_math.v: the product is shifted right by
+    ``CONSTS_FRAC`` (rounding down) and saturated to 64 bits.
+
+    :param cpp: Saturate like ``mulsat`` in
+      control_loop_math_implementation.cpp instead. It saturates negative
+      numbers to ``-2**62`` instead of ``-2**63``, and also saturates
+      the two smallest representable results.
+    """
+    hi, lo = mul128(a, b)
+    r = (hi.view(np.uint64) << np.uint64(64 - CONSTS_FRAC)) \
+        | (lo >> np.uint64(CONSTS_FRAC))
+    r = r.view(np.int64)
+    # The result fits if bits 127 to 106 of the product are the same.
+    top = hi >> np.int64(CONSTS_FRAC - 1)
+    over = (top != 0) & (top != -1)
+    neg = hi < 0
+    if not cpp:
+        return np.where(over, np.where(neg, INT64_MIN, INT64_MAX), r)
+    pos_sat = (over & ~neg) | (r == INT64_MAX)
+    neg_sat = (over & neg) | (r <= INT64_MIN + 1)
+    return np.where(pos_sat, INT64_MAX, np.where(neg_sat, CPP_NEG_SAT, r))
+
+def add(a, b):
+    """ Saturating 64 bit addition (``intsat`` of a 65 bit sum). """
+    a = _i64(a)
+    b = _i64(b)
+    s = (a.view(np.uint64) + b.view(np.uint64)).view(np.int64)
+    over = ((a < 0) == (b < 0)) & ((s < 0) != (a < 0))
+    return np.where(over, np.where(a < 0, INT64_MIN, INT64_MAX), s)
+
+def sub(a, b):
+    """ Saturating 64 bit subtraction. """
+    a = _i64(a)
+    b = _i64(b)
+    s = (a.view(np.uint64) - b.view(np.uint64)).view(np.int64)
+    over = ((a < 0) != (b < 0)) & ((s < 0) != (a < 0))
+    return np.where(over, np.where(a < 0, INT64_MIN, INT64_MAX), s)
+
+def saturate(x, bits):
+    """ Saturate to a ``bits`` bit signed integer. """
+    lim = 1 << (bits - 1)
+    return np.clip(x, -lim, lim - 1)
+
+def wrapping_add(a, b):
+    return (_i64(a).view(np.uint64) + _i64(b).view(np.uint64)).view(np.int64)
+
+def loop_math(setpt, measured, P, I, cycles, e_prev, adj_prev, stored,
+              cpp=False):
+    """
+    One run of ``control_loop_math``. All arguments are integers or
+    integer arrays, with the same meaning as the ports of the module.
+
+    :param P: Proportional constant, 21.43 fixed point.
+    :param I: Integral constant, 21.43 fixed point.
+    :param cycles: Clock cycles of the last iteration (unsigned).
+    :param e_prev: ``e`` of the last iteration.
+    :param adj_prev: ``adj`` of the last iteration.
+    :param stored: Current DAC value.
+    :param cpp: Follow ``calculate()`` of control_loop_math_sim.cpp
+      instead of the Verilog: ``mulsat`` saturation, and additions that
+      wrap around instead of saturating. ``dac`` is then
+      ``stored + adj`` rounded towards zero, without saturation.
+    :return: ``Math`` of the intermediate values. ``e``, ``adj`` and
+      ``dac`` are the outputs ``e_cur``, ``adj_val`` and
+      ``new_dac_val``.
+    """
+    setpt = _i64(setpt)
+    measured = _i64(measured)
+    cycles = _i64(cycles) & ((1 << CYCLE_COUNT_WID) - 1)
+    e_prev = _i64(e_prev)
+
+    e = mul((setpt - measured) << CONSTS_FRAC, ADC_TO_DAC, cpp) \
+        >> np.int64(CONSTS_FRAC)
+    dt = mul(SEC_PER_CYCLE, cycles << CONSTS_FRAC, cpp)
+    idt = mul(dt, I, cpp)
+    if cpp:
+        pidt = wrapping_add(P, idt)
+    else:
+        pidt = add(P, idt)
+    epidt = mul(pidt, e << CONSTS_FRAC, cpp)
+    ep = mul(P, e_prev << CONSTS_FRAC, cpp)
+    if cpp:
+        adj = wrapping_add(wrapping_add(adj_prev, epidt), -ep)
+        whole = np.where(adj > 0, adj >> np.int64(CONSTS_FRAC),
+                         -(-adj >> np.int64(CONSTS_FRAC)))
+        dac = stored + whole
+    else:
+        adj = add(sub(epidt, ep), adj_prev)
+        whole = saturate(adj >> np.int64(CONSTS_FRAC), DAC_WID)
+        dac = saturate(whole + stored, DAC_WID)
+    return Math(e, dt, idt, epidt, ep, adj, dac)
+
+class Plant:
+    """
+    First-order plant: the ADC reading relaxes to ``gain*z + offset``
+    with time constant ``tau``, plus Gaussian noise. This is the same
+    plant as ``ControlLoopModel`` in ``linux/emu/regmodel.py``.
+    """
+
+    CYCLE_TIME = 10e-9
+
+    def __init__(self, gain=(20 / 2**20) / (20.48 / 2**18), offset=0.0,
+                 tau=1e-3, noise=2.0):
+        self.gain = gain
+        self.offset = offset
+        self.tau = tau
+        self.noise = noise
+
+    def measure(self, y, z, cycles, rng):
+        """
+        Advance the plant by one loop iteration.
+
+        :param y: Plant outputs, updated in place.
+        :return: ADC readings.
+        """
+        alpha = -np.expm1(-cycles * self.CYCLE_TIME / self.tau)
+        y += (self.gain * z + self.offset - y) * alpha
+        m = y
+        if self.noise:
+            m = y + rng.normal(0, self.noise, y.shape)
+        return saturate(np.rint(m).astype(np.int64), ADC_WID)
+
+def simulate(P, I, setpt, delay=0, steps=1000, z0=0, plant=None,
+             base_cycles=1000, seed=None, record=False):
+    """
+    Run the loop on a plant for a batch of parameter sets.
+
+    :param P: Array of P values in 21.43 fixed point.
+    :param I: Array of I values in 21.43 fixed point.
+    :param setpt: Setpoint(s) in ADC units.
+    :param delay: ``cl_delay_in`` value(s). Each iteration takes
+      ``base_cycles + delay`` clock cycles.
+    :param steps: Number of loop iterations.
+    :param z0: Initial DAC value(s).
+    :param plant: ``Plant``. Defaults to ``Plant()``.
+    :param record: Also return the DAC and ADC value of every
+      iteration.
+    :return: Dictionary of arrays with one entry per parameter set:
+      ``z`` (last DAC value), ``rms`` (RMS error of the ADC reading over
+      the second half of the run) and ``bias`` (mean error over the
+      second half). If ``record`` is set, also ``z_trace`` and
+      ``measured_trace`` of shape ``[steps][batch]``.
+    """
+    P, I, setpt, delay, z0 = np.broadcast_arrays(
+            _i64(P), _i64(I), _i64(setpt), _i64(delay), _i64(z0))
+    if plant is None:
+        plant = Plant()
+    rng = np.random.default_rng(seed)
+    n = P.shape
+
+    cycles = _i64(base_cycles) + delay
+    z = z0.copy()
+    y = plant.gain * z + plant.offset
+    e_prev = np.zeros(n, dtype=np.int64)
+    adj_prev = np.zeros(n, dtype=np.int64)
+    err_sum = np.zeros(n)
+    err_sq = np.zeros(n)
+    half = steps // 2
+    if record:
+        z_trace = np.empty((steps,) + n, dtype=np.int64)
+        m_trace = np.empty((steps,) + n, dtype=np.int64)
+
+    for i in range(steps):
+        measured = plant.measure(y, z, cycles, rng)
+        r = loop_math(setpt, measured, P, I, cycles, e_prev, adj_prev, z)
+        z = r.dac
+        e_prev = r.e
+        adj_prev = r.adj
+        if i >= half:
+            err = measured - setpt
+            err_sum += err
+            err_sq += err * err.astype(np.float64)
+        if record:
+            z_trace[i] = z
+            m_trace[i] = measured
+
+    cnt = steps - half
+    res = {'z': z, 'rms': np.sqrt(err_sq / cnt), 'bias': err_sum / cnt}
+    if record:
+        res['z_trace'] = z_trace
+        res['measured_trace'] = m_trace
+    return res
+
+def _simulate_chunk(args):
+    kw, seed = args
+    return simulate(seed=seed, **kw)
+
+def sweep(P, I, setpt, delay=0, chunk=16384, workers=None, seed=0,
+          **kw):
+    """
+    Simulate a grid of floating point P and I values in a process pool.
+
+    :param P: Array of P values (floating point).
+    :param I: Array of I values (floating point).
+    :param setpt: Setpoint in ADC units.
+    :param delay: Delay value(s).
+    :param chunk: Parameter sets per job.
+    :param workers: Number of processes. ``None`` uses all CPUs.
+    :param kw: Other arguments of ``simulate``.
+    :return: Dictionary like ``simulate``, with ``P``, ``I`` and
+      ``delay`` of each parameter set, flattened over the grid.
+    """
+    Pg, Ig, Dg = np.meshgrid(np.asarray(P, dtype=float),
+                             np.asarray(I, dtype=float), _i64(delay),
+                             indexing='ij')
+    Pg, Ig, Dg = Pg.ravel(), Ig.ravel(), Dg.ravel()
+    Pf = float_to_fixed_point(Pg, CONSTS_FRAC)
+    If = float_to_fixed_point(Ig, CONSTS_FRAC)
+
+    jobs = []
+    for k, s in enumerate(range(0, len(Pg), chunk)):
+        sl = slice(s, s + chunk)
+        jobs.append((dict(P=Pf[sl], I=If[sl], setpt=setpt, delay=Dg[sl],
+                          **kw), seed + k))
+    if workers == 1 or len(jobs) == 1:
+        parts = [_simulate_chunk(j) for j in jobs]
+    else:
+        with ProcessPoolExecutor(workers) as ex:
+            parts = list(ex.map(_simulate_chunk, jobs))
+
+    res = {k: np.concatenate([p[k] for p in parts], axis=-1)
+           for k in parts[0]}
+    res.update(P=Pg, I=Ig, delay=Dg)
+    return res
+
+# Comparison with the C++ model.
+
+CPP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'gateware', 'rtl', 'control_loop')
+
+def build_cpp_ref():
+    """
+    Build ``control_loop_math_ref`` with the ``obj_dir/control_loop_math_ref``
+    rule of the control loop Makefile, if it is missing or out of date.
+
+    :return: Path of the executable.
+    """
+    target = os.path.join('obj_dir', 'control_loop_math_ref')
+    subprocess.run(['make', '-C', CPP_DIR, target], check=True,
+                   stdout=subprocess.DEVNULL)
+    return os.path.join(CPP_DIR, target)
+
+def random_inputs(rng, n):
+    """ Random ports of ``control_loop_math``, including extreme values. """
+    def pick(lo, hi, extreme):
+        v = rng.integers(lo, hi, n, dtype=np.int64, endpoint=True)
+        # Replace some values by extremes to exercise saturation.
+        k = rng.random(n) < 0.1
+        v[k] = rng.choice(np.array(extreme, dtype=np.int64), k.sum())
+        return v
+    i64 = (int(INT64_MIN), int(INT64_MAX))
+    adc = (-(1 << 17), (1 << 17) - 1)
+    e = (-(1 << 20), (1 << 20) - 1)
+    # Most parameters in the documented ranges (P up to 1, I up to 100),
+    # some anywhere.
+    small = rng.random(n) < 0.7
+    P = np.where(small, pick(0, 1 << CONSTS_FRAC, [0]), pick(*i64, i64))
+    I = np.where(small, pick(0, 100 << CONSTS_FRAC, [0]), pick(*i64, i64))
+    return dict(setpt=pick(*adc, adc), measured=pick(*adc, adc), P=P, I=I,
+                cycles=pick(0, (1 << CYCLE_COUNT_WID) - 1,
+                            [0, (1 << CYCLE_COUNT_WID) - 1]),
+                e_prev=pick(*e, e),
+                adj_prev=np.where(small, pick(-(1 << 62), 1 << 62, [0]),
+                                  pick(*i64, i64)),
+                stored=pick(-(1 << 19), (1 << 19) - 1,
+                            [-(1 << 19), (1 << 19) - 1]))
+
+ORDER = ['setpt', 'measured', 'P', 'I', 'cycles', 'e_prev', 'adj_prev',
+         'stored']
+
+def check(n=100000, seed=0):
+    """
+    Compare ``loop_math(cpp=True)`` with the C++ model on random inputs,
+    and count where the C++ model and the Verilog semantics differ.
+
+    :return: ``True`` if the model agrees with the C++ model.
+    """
+    exe = build_cpp_ref()
+    inp = random_inputs(np.random.default_rng(seed), n)
+    text = '\n'.join(' '.join(str(v) for v in row)
+                     for row in zip(*(inp[k].tolist() for k in ORDER)))
+    out = subprocess.run([exe], input=text + '\n', capture_output=True,
+                         text=True, check=True).stdout
+    ref = np.array([l.split() for l in out.splitlines()],
+                   dtype=np.int64).reshape(n, 7)
+
+    py = loop_math(**inp, cpp=True)
+    ok = True
+    for i, name in enumerate(Math._fields):
+        bad = np.count_nonzero(py[i] != ref[:, i])
+        print(f'{name:<6} {bad} of {n} differ from C++')
+        ok = ok and bad == 0
+
+    hw = loop_math(**inp)
+    for i, name in enumerate(Math._fields):
+        d = np.count_nonzero(hw[i] != py[i])
+        print(f'{name:<6} Verilog and C++ semantics differ in {d} of {n}')
+    return ok
+
+def bench(batch=100000, steps=100):
+    P = np.full(batch, float_to_fixed_point([0.01], CONSTS_FRAC)[0])
+    I = np.full(batch, float_to_fixed_point([10], CONSTS_FRAC)[0])
+    simulate(P, I, 1000, steps=2)
+    start = time.perf_counter()
+    simulate(P, I, 1000, steps=steps)
+    t = time.perf_counter() - start
+    print(f'simulate: {batch*steps/t/1e6:.2f} M iterations/s '
+          f'(batch {batch}, {steps} steps)')
+
+    start = time.perf_counter()
+    res = sweep(np.linspace(0, 0.1, 100), np.linspace(0, 100, 1000), 1000,
+                steps=steps)
+    t = time.perf_counter() - start
+    print(f'sweep: {len(res["P"])*steps/t/1e6:.2f} M iterations/s '
+          f'({len(res["P"])} sets, {os.cpu_count()} CPUs)')
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in ('check', 'bench'):
+        print('usage: control_loop_model.py check|bench', file=sys.stderr)
+        sys.exit(1)
+    if sys.argv[1] == 'check':
+        sys.exit(0 if check() else 1)
+    bench()
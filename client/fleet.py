@@ -0,0 +1,326 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Run a script on several controllers at once.
+#
+#     python3 fleet.py -H 192.168.2.50 -H 192.168.2.51 noise_test.py
+#
+# Each controller is driven by its own OpenSSH process (with connection
+# sharing, like ``Session.stream``) under asyncio, so one slow or dead
+# controller does not hold up the others. Output of all controllers is
+# merged in the order it arrives and tagged with the host it came from.
+
+import argparse
+import asyncio
+import sys
+import time
+from collections import namedtuple
+from util import *
+
+# ``data`` is a line of text (without the newline), or a ``Frame`` if
+# the run decodes frames.
+Output = namedtuple('Output', ['host', 'attempt', 'data'])
+
+class HostReport:
+    """ Result of a run on one controller. """
+    __slots__ = ('host', 'attempts', 'ok', 'error', 'items', 'nbytes',
+                 'seconds')
+
+    def __init__(self, host):
+        self.host = host
+        self.attempts = 0
+        self.ok = False
+        self.error = None
+        # Lines or frames received in the last attempt.
+        self.items = 0
+        self.nbytes = 0
+        self.seconds = 0.0
+
+class Fleet:
+    """
+    A group of controllers that run the same scripts.
+    """
+
+    def __init__(self, hosts, user=CONTROLLER_USER, pkey=CONTROLLER_KEY,
+                 remote_dir='/root/', timeout=60, retries=2, retry_delay=1.0,
+                 verbose=True):
+        """
+        :param hosts: List of controller hostnames.
+        :param timeout: Seconds to wait for each step of an upload, and
+          for output from a running script. A script that keeps writing
+          output may run for as long as it needs. ``None`` waits forever.
+        :param retries: Number of times a failed attempt is repeated.
+        :param retry_delay: Seconds to wait before repeating an attempt.
+          The wait doubles after each failure.
+        :param verbose: Print failures and retries.
+        """
+        self.hosts = list(hosts)
+        self.user = user
+        self.pkey = pkey
+        self.remote_dir = remote_dir
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.verbose = verbose
+        self.ssh_options = ssh_options(pkey, batch=True)
+        self.uploads = UploadCache(remote_dir)
+        self.reports = {}
+        self.wall_seconds = 0.0
+
+    def _log(self, *args):
+        if self.verbose:
+            print(*args, file=sys.stderr)
+
+    def _ssh(self, host, command):
+        return ['ssh', *self.ssh_options, f'{self.user}@{host}', command]
+
+    def _scp(self, host, local, remote):
+        return ['scp', '-q', *self.ssh_options, local,
+                f'{self.user}@{host}:{remote}']
+
+    async def _check_output(self, args):
+        proc = await asyncio.create_subprocess_exec(
+                *args, stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+        try:
+            out, err = await asyncio.wait_for(proc.communicate(),
+                                              self.timeout)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+        if proc.returncode != 0:
+            raise Exception(f'{args[0]} exited with {proc.returncode}: '
+                            f'{err.decode(errors="replace").strip()}')
+        return out
+
+    async def upload(self, host, f):
+        """
+        Upload a script from ``../linux`` to one controller, unless it
+        already has the same file.
+
+        :return: ``True`` if the file was copied.
+        """
+        plan = self.uploads.plan(f, host)
+        if plan is None:
+            return False
+        local, remote, h = plan
+
+        out = await self._check_output(self._ssh(
+                host, UploadCache.hash_command(remote)))
+        copied = UploadCache.parse_hash(out) != h
+        if copied:
+            await self._check_output(self._scp(host, local, remote))
+        self.uploads.uploaded(remote, h, host)
+        return copied
+
+    async def _attempt(self, host, f, arg, depends, frames, put, rep):
+        for d in depends:
+            await self.upload(host, d)
+        await self.upload(host, f)
+
+        command = f'cd {self.remote_dir} && micropython {f} ' \
+                  + ' '.join(str(s) for s in arg)
+        proc = await asyncio.create_subprocess_exec(
+                *self._ssh(host, command), stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE)
+        # Read stderr at the same time as stdout. Otherwise a script that
+        # fills the stderr pipe blocks until the attempt times out.
+        err_task = asyncio.create_task(proc.stderr.read())
+        try:
+            if frames:
+                dec = FrameDecoder()
+                while True:
+                    data = await asyncio.wait_for(proc.stdout.read(65536),
+                                                  self.timeout)
+                    if not data:
+                        break
+                    rep.nbytes += len(data)
+                    for fr in dec.feed(data):
+                        rep.items += 1
+                        await put(fr)
+            else:
+                while True:
+                    line = await asyncio.wait_for(proc.stdout.readline(),
+                                                  self.timeout)
+                    if not line:
+                        break
+                    rep.nbytes += len(line)
+                    rep.items += 1
+                    await put(line.decode(errors='replace').rstrip('\n'))
+            err = await asyncio.wait_for(err_task, self.timeout)
+            await asyncio.wait_for(proc.wait(), self.timeout)
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+                await proc.wait()
+            if not err_task.done():
+                err_task.cancel()
+                await asyncio.gather(err_task, return_exceptions=True)
+        if proc.returncode != 0:
+            raise Exception(f'exited with {proc.returncode}: '
+                            f'{err.decode(errors="replace").strip()}')
+
+    async def _run_host(self, host, f, arg, depends, frames, queue):
+        rep = self.reports[host]
+        delay = self.retry_delay
+        while True:
+            rep.attempts += 1
+            rep.items = 0
+            rep.nbytes = 0
+            attempt = rep.attempts
+
+            async def put(data):
+                await queue.put(Output(host, attempt, data))
+
+            start = time.perf_counter()
+            try:
+                # The timeout applies to each step of the attempt (see
+                # ``_attempt``), not to the whole run.
+                await self._attempt(host, f, arg, depends, frames, put, rep)
+                rep.ok = True
+                rep.error = None
+            except (Exception, asyncio.TimeoutError) as e:
+                rep.error = 'timed out' if isinstance(e, asyncio.TimeoutError) \
+                            else str(e)
+            rep.seconds = time.perf_counter() - start
+            if rep.ok or rep.attempts > self.retries:
+                break
+            self._log(f'{host}: attempt {attempt} failed ({rep.error}), '
+                      f'retrying in {delay:.1f} s')
+            await asyncio.sleep(delay)
+            delay *= 2
+        if not rep.ok:
+            self._log(f'{host}: failed ({rep.error})')
+
+    async def stream(self, f, *arg, frames=False, depends=()):
+        """
+        Upload (if needed) and run a script on all controllers.
+
+        A failed attempt on a host is started again from the beginning,
+        so output from a failed attempt may be followed by the complete
+        output of the next attempt. Use ``Output.attempt`` to tell them
+        apart.
+
+        :param f: Script name in ``../linux``.
+        :param arg: Command line arguments of the script.
+        :param frames: Decode the output into ``Frame``s instead of lines.
+        :param depends: Other files in ``../linux`` that the script
+          imports (e.g. ``COMM_FILES``), uploaded first.
+        :return: Asynchronous generator of ``Output``. The per-host
+          results are in ``reports`` when it is exhausted. To stop
+          early, close it (e.g. with ``contextlib.aclosing``) so that
+          the remote scripts are stopped right away.
+        """
+        self.reports = {h: HostReport(h) for h in self.hosts}
+        # The queue is bounded, so a slow consumer slows down the reads
+        # instead of buffering without limit.
+        queue = asyncio.Queue(maxsize=1024)
+        start = time.perf_counter()
+        tasks = [asyncio.create_task(self._run_host(h, f, arg, depends,
+                                                    frames, queue))
+                 for h in self.hosts]
+        done = asyncio.gather(*tasks)
+        # Retrieve the result of ``done`` as soon as it is set, also when
+        # the consumer stops early and the tasks are cancelled, so that
+        # it is not reported as never retrieved.
+        done.add_done_callback(lambda d: d.cancelled() or d.exception())
+        try:
+            while True:
+                get = asyncio.ensure_future(queue.get())
+                await asyncio.wait([get, done],
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if get.done():
+                    yield get.result()
+                    continue
+                get.cancel()
+                while not queue.empty():
+                    yield queue.get_nowait()
+                break
+        finally:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.wall_seconds = time.perf_counter() - start
+
+    async def run(self, f, *arg, frames=False, depends=()):
+        """
+        Like ``stream``, but collect the output.
+
+        :return: Dictionary from host to the list of output of its last
+          attempt.
+        """
+        out = {h: [] for h in self.hosts}
+        attempt = {}
+        async for o in self.stream(f, *arg, frames=frames, depends=depends):
+            if attempt.get(o.host) != o.attempt:
+                attempt[o.host] = o.attempt
+                out[o.host] = []
+            out[o.host].append(o.data)
+        return out
+
+    def report(self):
+        """
+        Print the result and throughput of each host of the last run, and
+        the throughput of all hosts together.
+        """
+        total_items = 0
+        total_bytes = 0
+        for r in self.reports.values():
+            status = 'ok' if r.ok else f'FAILED ({r.error})'
+            rate = r.nbytes / r.seconds / 1e3 if r.seconds > 0 else 0
+            print(f'{r.host:<20} {status:<10} attempts {r.attempts} '
+                  f'{r.items:8d} items {r.nbytes:10d} B '
+                  f'{r.seconds:7.2f} s {rate:9.1f} kB/s')
+            total_items += r.items
+            total_bytes += r.nbytes
+        t = self.wall_seconds
+        ok = sum(r.ok for r in self.reports.values())
+        if t > 0:
+            print(f'{ok}/{len(self.reports)} hosts ok, {total_items} items, '
+                  f'{total_bytes} B in {t:.2f} s: '
+                  f'{total_items / t:.1f} items/s, '
+                  f'{total_bytes / t / 1e3:.1f} kB/s')
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Run a script on several controllers")
+    parser.add_argument('-H', '--host', action='append', required=True,
+                        help="controller hostname (repeat for each host)")
+    parser.add_argument('--timeout', type=float, default=60,
+                        help="seconds to wait for an upload step or for "
+                             "output from the script")
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--frames', action='store_true',
+                        help="decode binary frames instead of lines")
+    parser.add_argument('--depends', action='append', default=None,
+                        help="file in ../linux to upload before the script "
+                             "(repeat for each file; default: "
+                             f"{' '.join(COMM_FILES)})")
+    parser.add_argument('script', help="script in ../linux")
+    parser.add_argument('args', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    if args.depends is None:
+        args.depends = list(COMM_FILES)
+
+    fleet = Fleet(args.host, timeout=args.timeout, retries=args.retries)
+
+    async def show():
+        async for o in fleet.stream(args.script, *args.args,
+                                    frames=args.frames, depends=args.depends):
+            if args.frames:
+                fr = o.data
+                print(f'{o.host}: channel {fr.channel} seq {fr.seq} '
+                      f'{len(fr.samples)} samples')
+            else:
+                print(f'{o.host}: {o.data}')
+    asyncio.run(show())
+    fleet.report()
+
+if __name__ == '__main__':
+    main()
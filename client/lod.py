@@ -0,0 +1,218 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Level of detail for plotting long acquisitions.
+#
+# ``MinMaxPyramid`` keeps the minimum and maximum of bins of samples at
+# several bin sizes, and is updated as samples arrive. A plot of the
+# minimum and maximum of each bin looks the same as a plot of every
+# sample in it (peaks are kept), so a view only draws the level that has
+# about as many bins as the plot has pixels. The samples themselves are
+# not kept.
+#
+# ``LiveView`` shows a pyramid in a matplotlib window, redrawing the
+# level that matches the current zoom at a fixed frame rate. Samples can
+# be appended from another thread.
+
+import threading
+import numpy as np
+
+class _Growable:
+    """ Array that is appended to, with amortized doubling. """
+
+    def __init__(self, dtype):
+        self.data = np.zeros(64, dtype=dtype)
+        self.n = 0
+
+    def extend(self, a):
+        need = self.n + len(a)
+        if need > len(self.data):
+            new = np.zeros(max(need, 2 * len(self.data)), self.data.dtype)
+            new[:self.n] = self.data[:self.n]
+            self.data = new
+        self.data[self.n:need] = a
+        self.n = need
+
+    def view(self):
+        return self.data[:self.n]
+
+class MinMaxPyramid:
+    """
+    Minimum and maximum of bins of a stream of samples. Level ``k`` has
+    bins of ``base * factor**k`` samples.
+    """
+
+    def __init__(self, base=16, factor=4, levels=8, fs=1.0):
+        """
+        :param base: Samples per bin of level 0.
+        :param factor: Bins of a level in each bin of the next level.
+        :param levels: Number of levels.
+        :param fs: Sample rate, to give positions in seconds. The default
+          gives positions in samples.
+        """
+        self.base = base
+        self.factor = factor
+        self.fs = fs
+        self.count = 0
+        self.mins = [_Growable(np.float64) for _ in range(levels)]
+        self.maxs = [_Growable(np.float64) for _ in range(levels)]
+        # Minimum and maximum of the incomplete bin of each level, and
+        # the number of units (samples or bins of the level below) in it.
+        self.part_min = [np.inf] * levels
+        self.part_max = [-np.inf] * levels
+        self.part_n = [0] * levels
+        self.lock = threading.Lock()
+
+    def bin_size(self, level):
+        """ :return: Samples in a bin of ``level``. """
+        return self.base * self.factor ** level
+
+    def _reduce(self, level, lo, hi):
+        size = self.base if level == 0 else self.factor
+        n = len(lo)
+        # Finish the incomplete bin.
+        i = min(n, size - self.part_n[level])
+        if i > 0:
+            self.part_min[level] = min(self.part_min[level], lo[:i].min())
+            self.part_max[level] = max(self.part_max[level], hi[:i].max())
+            self.part_n[level] += i
+        new_lo = []
+        new_hi = []
+        if self.part_n[level] == size:
+            new_lo.append(self.part_min[level])
+            new_hi.append(self.part_max[level])
+            whole = (n - i) // size * size
+            new_lo.extend(lo[i:i + whole].reshape(-1, size).min(axis=1))
+            new_hi.extend(hi[i:i + whole].reshape(-1, size).max(axis=1))
+            rest = slice(i + whole, n)
+            self.part_n[level] = n - i - whole
+            self.part_min[level] = lo[rest].min() if self.part_n[level] \
+                                   else np.inf
+            self.part_max[level] = hi[rest].max() if self.part_n[level] \
+                                   else -np.inf
+        if not new_lo:
+            return
+        new_lo = np.array(new_lo)
+        new_hi = np.array(new_hi)
+        self.mins[level].extend(new_lo)
+        self.maxs[level].extend(new_hi)
+        if level + 1 < len(self.mins):
+            self._reduce(level + 1, new_lo, new_hi)
+
+    def append(self, samples):
+        """ Add a chunk of samples. """
+        s = np.asarray(samples, dtype=np.float64).ravel()
+        if s.size == 0:
+            return
+        with self.lock:
+            self._reduce(0, s, s)
+            self.count += s.size
+
+    def level_for(self, start, stop, width):
+        """
+        :return: The finest level with at most ``width`` bins between
+          sample ``start`` and ``stop``.
+        """
+        span = max(stop - start, 1)
+        for k in range(len(self.mins)):
+            if span / self.bin_size(k) <= width:
+                return k
+        return len(self.mins) - 1
+
+    def query(self, x0=None, x1=None, width=1000):
+        """
+        Get the bins to draw a range of the stream.
+
+        :param x0: Start of the range, in the units of ``fs``. Defaults
+          to the start of the stream.
+        :param x1: End of the range. Defaults to the end of the stream.
+        :param width: Width of the plot in pixels.
+        :return: Tuple of the level, and the ``x`` and ``y`` arrays of a
+          line that goes through the minimum and the maximum of each bin.
+        """
+        with self.lock:
+            start = 0 if x0 is None else max(int(x0 * self.fs), 0)
+            stop = self.count if x1 is None \
+                   else min(int(np.ceil(x1 * self.fs)), self.count)
+            k = self.level_for(start, stop, width)
+            size = self.bin_size(k)
+            i0 = start // size
+            i1 = min(-(-stop // size), self.mins[k].n)
+            lo = self.mins[k].view()[i0:i1].copy()
+            hi = self.maxs[k].view()[i0:i1].copy()
+        x = (np.arange(i0, i0 + len(lo)) + 0.5) * size / self.fs
+        return k, np.repeat(x, 2), np.column_stack((lo, hi)).ravel()
+
+class LiveView:
+    """
+    matplotlib window showing a ``MinMaxPyramid`` while it grows.
+
+    Until the plot is zoomed or panned, it follows the whole stream.
+    Press ``f`` to follow the stream again.
+    """
+
+    def __init__(self, pyramid, fps=10, ax=None, **line_args):
+        """
+        :param fps: Redraws per second.
+        :param ax: Axes to draw in. Defaults to a new figure.
+        """
+        import matplotlib.pyplot as plt
+        self.pyramid = pyramid
+        if ax is None:
+            _, ax = plt.subplots()
+        self.ax = ax
+        self.line, = ax.plot([], [], linewidth=0.8, **line_args)
+        self.follow = True
+        self.drawn_xlim = None
+        self.shown = (None, 0)
+        fig = ax.figure
+        fig.canvas.mpl_connect('key_press_event', self._key)
+        self.timer = fig.canvas.new_timer(interval=int(1000 / fps))
+        self.timer.add_callback(self.redraw)
+        self.timer.start()
+
+    def _key(self, event):
+        if event.key == 'f':
+            self.follow = True
+            self.redraw()
+
+    def redraw(self):
+        """ Draw the level matching the current zoom, if anything changed. """
+        ax = self.ax
+        # A view limit different from the one set here means the user
+        # zoomed or panned.
+        if self.drawn_xlim is not None and ax.get_xlim() != self.drawn_xlim:
+            self.follow = False
+        if self.follow:
+            x0 = x1 = None
+        else:
+            x0, x1 = ax.get_xlim()
+        width = max(int(ax.bbox.width), 1)
+        count = self.pyramid.count
+        key = (None if self.follow else (x0, x1), count)
+        if key == self.shown:
+            return
+        k, x, y = self.pyramid.query(x0, x1, width)
+        self.line.set_data(x, y)
+        if self.follow and len(x):
+            ax.set_xlim(0, max(count / self.pyramid.fs, x[-1]))
+            lo, hi = np.nanmin(y), np.nanmax(y)
+            pad = (hi - lo) * 0.05 or 1
+            ax.set_ylim(lo - pad, hi + pad)
+        ax.set_title(f"{count} samples, level {k} "
+                     f"({self.pyramid.bin_size(k)} samples/bin)",
+                     fontsize='small')
+        self.drawn_xlim = ax.get_xlim()
+        self.shown = key
+        ax.figure.canvas.draw_idle()
+
+    def show(self):
+        """ Show the window until it is closed. """
+        import matplotlib.pyplot as plt
+        plt.show()
+        self.timer.stop()
@@ -6,76 +6,92 @@ For license terms, refer to the files in `doc/copying` in the Upsilon
 source distribution.
 """
 
-from pssh.clients import SSHClient # require parallel-ssh
 import numpy as np
 import matplotlib.pyplot as plt
-import pandas as pd
 import sys
-
-def sign_extend(value, bits):
-    """
-    Interpret ``value`` as a twos-complement integer of ``bits`` length.
-
-    :param value: Twos-complement integer with finite bit width.
-    :param bits: Bit length of ``value``.
-    :return: ``value`` converted to a Python integer.
-    """
-
-    # Check the sign bit of the integer.
-    is_signed = (value >> (bits - 1)) & 1 == 1
-    # If not signed, just return the integer.
-    if not is_signed:
-        return value
-    # Otherwise,
-    # 1. Do an explicit twos-complement negation
-    # 2. Mask all the non-sign bits
-    # This returns the positive value as a standard Python integer.
-    # Then the function negates the positive integer to get the negative
-    # one back.
-    return -((~value + 1) & ((1 << (bits - 1)) - 1))
+import threading
+from util import *
+from stats import SetpointStats
+from colstore import ColumnStore
+from lod import MinMaxPyramid, LiveView
 
 ###################
 # Boilerplate
 ###################
 
-# Start a SSH connection to the server.
-print('connecting')
-client = SSHClient('192.168.2.50', user='root', pkey='~/.ssh/upsilon_key')
-# Upload the script.
-print('connected')
-client.scp_send('../linux/noise_test.py', '/root/noise_test.py')
-# Run the script.
-out = client.run_command('micropython noise_test.py')
+proc = connect_stream('noise_test.py')
 
 ################
 # Script Handler
 ################
 """
-The ramp script outputs a list of lines, each with two values separated by one
-space. The first value is the DAC setting, the second value is the ADC setting.
-This script gets all of those values, averages them by DAC value, and plots
+The ramp script outputs binary frames. Channel 0 frames contain the DAC
+setting, and channel 1 frames contain the ADC samples taken at that
+setting. This script averages the ADC samples by DAC value, and plots
 it.
+
+Every sample is saved as it arrives in the store NAME.samples (columns
+``dac`` and ``sample``), and the averages in the store NAME.summary,
+where NAME is the first argument. Load them with ``ColumnStore.open``.
+
+With ``live`` as the second argument, the samples are shown in a window
+as they arrive. Only the decimated samples (see ``lod.py``) are kept for
+the plot. Close the window to stop the run.
 """
 
-current_dac = None
-current_adc = []
-x_ax = []
-y_ax = []
-for line in out.stdout:
-    l = line.split(' ')
-    if l[0] != current_dac:
-        if current_dac is not None:
-            m = np.mean(current_adc)
-            sdev = np.std(current_adc)
-            print(current_dac, m, sdev)
-            x_ax.append(current_dac)
-            y_ax.append(m)
-        current_adc = [sign_extend(int(l[1]), 18)]
-        current_dac = l[0]
+def print_result(dac, st):
+    print(dac, st.count, st.mean, st.std())
+
+# Statistics are accumulated as frames arrive, so memory use does not
+# grow with the length of the ramp. Press Ctrl-C to stop a run early and
+# keep the results so far.
+stats = SetpointStats(on_result=print_result)
+samples = ColumnStore.create(f"{sys.argv[1]}.samples",
+                             {"dac": "i4", "sample": "i4"})
+live = len(sys.argv) > 2 and sys.argv[2] == "live"
+pyramid = MinMaxPyramid() if live else None
+
+# Sample frames that arrived before the first DAC frame. They have no
+# DAC value, so they are skipped.
+skipped = 0
+
+def acquire():
+    global skipped
+    current_dac = None
+    for frame in read_frames(proc.stdout):
+        if frame.channel == 0:
+            current_dac = int(frame.samples[0])
+        elif current_dac is None:
+            skipped += len(frame.samples)
+        else:
+            stats.update(current_dac, frame.samples)
+            samples.append(dac=current_dac, sample=frame.samples)
+            if pyramid is not None:
+                pyramid.append(frame.samples)
+
+try:
+    if live:
+        reader = threading.Thread(target=acquire, daemon=True)
+        reader.start()
+        LiveView(pyramid).show()
+        if reader.is_alive():
+            proc.terminate()
+        reader.join()
     else:
-        current_adc.append(sign_extend(int(l[1]),18))
+        acquire()
+except KeyboardInterrupt:
+    proc.terminate()
+samples.close()
+stats.finish()
+proc.wait()
+if skipped:
+    print(f"skipped {skipped} samples received before the first DAC value")
 
-df = pd.DataFrame({"x": x_ax, "y": y_ax})
-df.to_csv(f"{sys.argv[1]}.csv")
-plt.plot(df.x, df.y)
+t = stats.table()
+with ColumnStore.create(f"{sys.argv[1]}.summary",
+                        {"x": "i4", "y": "f8", "std": "f8", "min": "f8",
+                         "max": "f8", "count": "i8"}) as summary:
+    summary.append(x=t["setpoint"], y=t["mean"], std=t["std"],
+                   min=t["min"], max=t["max"], count=t["count"])
+plt.plot(t["setpoint"], t["mean"])
 plt.show()
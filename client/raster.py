@@ -0,0 +1,177 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Read raster scans out of memory written by ``ram_shim``.
+#
+# The scan buffer is memory mapped (``/dev/mem`` or a UIO device on the
+# controller, or a file anywhere) and viewed as a NumPy array, so no
+# sample is copied until it is used.
+#
+# Layout (see ``gateware/rtl/raster/raster.v`` and ``ram_shim.v``):
+#
+# * ``raster`` measures every ADC in ``used_adcs`` at each point, and
+#   sends the samples to ``ram_shim`` from the highest ADC to the
+#   lowest.
+# * ``ram_shim`` writes each ``MAX_ADC_DATA_WID`` bit sample as two
+#   ``SAMPLEWID`` bit words, low word first, with the high word sign
+#   extended. Each sample is therefore a little-endian ``int32``.
+# * Each line is ``max_samples`` points forward, followed by
+#   ``max_samples`` points in reverse.
+#
+# A scan of ``max_lines`` lines is thus an array
+# ``[max_lines][2][max_samples][len(used_adcs)]`` of ``<i4``.
+
+import mmap
+import os
+import time
+import numpy as np
+
+# From raster_cmds.vh.
+ADCNUM = 9
+MAX_ADC_DATA_WID = 24
+SAMPLEWID = 16
+
+# ram_shim writes two SAMPLEWID words per sample.
+SAMPLE_BYTES = 2 * SAMPLEWID // 8
+
+FORWARD = 0
+REVERSE = 1
+
+def adc_order(used_adcs):
+    """
+    :param used_adcs: ``RASTER_USED_ADCS`` bitmask.
+    :return: List of ADC numbers in the order their samples are written.
+    """
+    return [i for i in reversed(range(ADCNUM)) if used_adcs >> i & 1]
+
+def map_memory(source, length, offset=0, writable=False):
+    """
+    Memory map a scan buffer.
+
+    :param source: Path of a file, ``/dev/mem`` or ``/dev/uioN``. For
+      ``/dev/mem``, ``offset`` is the physical address of the buffer.
+      For UIO devices, ``offset`` is the offset into map 0.
+    :param length: Length of the buffer in bytes.
+    :return: Tuple of the ``mmap`` and the offset of the buffer in it.
+    """
+    page = mmap.PAGESIZE
+    base = offset - offset % page
+    flags = os.O_RDWR if writable else os.O_RDONLY
+    if source == '/dev/mem':
+        flags |= os.O_SYNC
+    fd = os.open(source, flags)
+    try:
+        mm = mmap.mmap(fd, length + offset - base, mmap.MAP_SHARED,
+                       mmap.PROT_READ | (mmap.PROT_WRITE if writable else 0),
+                       offset=base)
+    finally:
+        os.close(fd)
+    return mm, offset - base
+
+class RasterScan:
+    """
+    View of a raster scan in memory.
+    """
+
+    def __init__(self, buf, max_samples, max_lines, used_adcs, offset=0):
+        """
+        :param buf: Object supporting the buffer protocol (``mmap``,
+          ``bytearray``, ...) containing the scan.
+        :param max_samples: ``RASTER_MAX_SAMPLES`` of the scan.
+        :param max_lines: ``RASTER_MAX_LINES`` of the scan.
+        :param used_adcs: ``RASTER_USED_ADCS`` of the scan.
+        :param offset: Byte offset of the scan in ``buf``.
+        """
+        self.max_samples = max_samples
+        self.max_lines = max_lines
+        self.used_adcs = used_adcs
+        self.adcs = adc_order(used_adcs)
+        if len(self.adcs) == 0:
+            raise Exception("no ADCs used")
+
+        self.point_bytes = SAMPLE_BYTES * len(self.adcs)
+        self.line_bytes = 2 * max_samples * self.point_bytes
+        self.nbytes = max_lines * self.line_bytes
+        self.data = np.frombuffer(buf, dtype='<i4',
+                                  count=self.nbytes // SAMPLE_BYTES,
+                                  offset=offset) \
+                      .reshape(max_lines, 2, max_samples, len(self.adcs))
+
+    @classmethod
+    def open(cls, source, max_samples, max_lines, used_adcs, offset=0):
+        """
+        Memory map a scan. See :func:`map_memory` for ``source`` and
+        ``offset``.
+        """
+        nbytes = max_lines * 2 * max_samples * SAMPLE_BYTES \
+                 * len(adc_order(used_adcs))
+        mm, off = map_memory(source, nbytes, offset)
+        scan = cls(mm, max_samples, max_lines, used_adcs, off)
+        scan.mmap = mm
+        return scan
+
+    def channel(self, adc):
+        """ :return: Index of ``adc`` in the last axis of ``data``. """
+        return self.adcs.index(adc)
+
+    def image(self, adc, direction=FORWARD, lines=None):
+        """
+        :param adc: ADC number.
+        :param direction: ``FORWARD`` or ``REVERSE``. Reverse lines are
+          flipped so that both images have the same orientation.
+        :param lines: Slice of lines. Defaults to all lines.
+        :return: ``[lines][max_samples]`` view of the scan. This is not a
+          copy, so it changes while the scan is running.
+        """
+        if lines is None:
+            lines = slice(None)
+        img = self.data[lines, direction, :, self.channel(adc)]
+        if direction == REVERSE:
+            img = img[:, ::-1]
+        return img
+
+    def lines_done(self, written):
+        """
+        :param written: Number of bytes the scan has written, i.e. the
+          ``ram_shim`` write pointer minus the start of the buffer.
+        :return: Number of complete lines.
+        """
+        return min(written // self.line_bytes, self.max_lines)
+
+    def lines(self, written, poll=0.01, timeout=None):
+        """
+        Yield lines as the scan finishes them.
+
+        :param written: Function returning the number of bytes the scan
+          has written (see :meth:`lines_done`).
+        :param poll: Seconds between checks of ``written()``.
+        :param timeout: Seconds to wait for a new line before raising an
+          exception. ``None`` waits forever.
+        :return: Generator of ``(line, view)``, where ``view`` is the
+          ``[2][max_samples][adcs]`` view of the line.
+        """
+        nxt = 0
+        last = time.monotonic()
+        while nxt < self.max_lines:
+            done = self.lines_done(written())
+            if done <= nxt:
+                if timeout is not None and time.monotonic() - last > timeout:
+                    raise Exception(f"no new line after {timeout} s")
+                time.sleep(poll)
+                continue
+            for i in range(nxt, done):
+                yield i, self.data[i]
+            nxt = done
+            last = time.monotonic()
+
+    def close(self):
+        """ Unmap the scan. Views of the scan must not be used after. """
+        mm = getattr(self, 'mmap', None)
+        self.data = None
+        if mm is not None:
+            mm.close()
@@ -0,0 +1,272 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Client of the resident RPC server (linux/rpcd.py). See that file for
+# the protocol.
+#
+# Usage: python3 rpc.py [host] [requests] [port]
+#
+# prints the time of requests sent one at a time against pipelined
+# requests.
+#
+# Every request method returns a ``Reply`` right after the request is
+# sent. Its ``result()`` waits for the answer. Up to ``window`` requests
+# are in flight at once, so a loop like
+#
+#     replies = [cl.dac_write(0, v) for v in range(0, 1000, 10)]
+#     for r in replies:
+#         r.result()
+#
+# pays the round trip to the controller about once instead of for every
+# request.
+
+import socket
+import struct
+import sys
+import time
+from collections import deque
+import numpy as np
+from util import *
+
+# The constants below are repeated in linux/rpcd.py and must match it.
+RPC_PORT = 5018
+
+REQ_MAGIC = b'UR'
+REPLY_MAGIC = b'UA'
+HEADER = struct.Struct('<2sBBII')
+
+OP_PING = 0
+OP_DAC_WRITE = 1
+OP_ADC_READ = 2
+OP_ADC_READ_MANY = 3
+OP_RAMP = 4
+OP_CL_START = 5
+OP_CL_SET = 6
+OP_CL_STOP = 7
+OP_CL_STATUS = 8
+
+ADC_BITS = 18
+DAC_BITS = 20
+
+class Reply:
+    """ Answer to a request, which may not have arrived yet. """
+
+    def __init__(self, client, rid, op, decode):
+        self.client = client
+        self.id = rid
+        self.op = op
+        self.decode = decode
+        self.arrived = False
+        self.error = None
+        self.value = None
+
+    def done(self):
+        return self.arrived
+
+    def _set(self, status, payload):
+        self.arrived = True
+        if status != 0:
+            self.error = payload.decode(errors='replace')
+        elif self.decode is not None:
+            self.value = self.decode(np.frombuffer(payload, dtype='<i4'))
+
+    def result(self):
+        """
+        Wait for the answer.
+
+        :return: The decoded result of the request.
+        :raises Exception: If the request failed on the controller.
+        """
+        while not self.arrived:
+            self.client.receive()
+        if self.error is not None:
+            raise Exception(f"rpc op {self.op}: {self.error}")
+        return self.value
+
+class RPCClient:
+    """ Connection to ``rpcd.py``. """
+
+    def __init__(self, host=CONTROLLER_HOST, port=RPC_PORT, window=32,
+                 timeout=10):
+        """
+        :param window: Maximum number of requests without an answer.
+          Sending another request first waits for the oldest answer.
+        :param timeout: Seconds to wait for the controller.
+        """
+        self.host = host
+        self.port = port
+        self.window = window
+        self.timeout = timeout
+        self.sock = None
+        self.next_id = 0
+        # Replies in the order their requests were sent.
+        self.pending = deque()
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port),
+                                             self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _recv(self, n):
+        buf = bytearray(n)
+        mv = memoryview(buf)
+        got = 0
+        while got < n:
+            k = self.sock.recv_into(mv[got:])
+            if k == 0:
+                raise Exception("rpc server closed the connection")
+            got += k
+        return buf
+
+    def receive(self):
+        """ Wait for the answer of the oldest request in flight. """
+        magic, op, status, rid, length = HEADER.unpack(self._recv(HEADER.size))
+        if magic != REPLY_MAGIC:
+            raise Exception("bad rpc reply header")
+        payload = self._recv(length)
+        r = self.pending.popleft()
+        if r.id != rid:
+            raise Exception(f"rpc reply {rid} out of order, expected {r.id}")
+        r._set(status, payload)
+
+    def flush(self):
+        """ Wait for the answers of all requests in flight. """
+        while self.pending:
+            self.receive()
+
+    def request(self, op, *args, decode=None):
+        """
+        Send a request.
+
+        :param args: Integer arguments.
+        :param decode: Function from the ``int32`` array of the answer to
+          the result of the ``Reply``. By default the result is ``None``.
+        :return: ``Reply`` of the request.
+        """
+        while len(self.pending) >= self.window:
+            self.receive()
+        rid = self.next_id
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        body = struct.pack(f'<{len(args)}q', *args)
+        self.sock.sendall(HEADER.pack(REQ_MAGIC, op, 0, rid, len(body))
+                          + body)
+        r = Reply(self, rid, op, decode)
+        self.pending.append(r)
+        return r
+
+    def ping(self):
+        return self.request(OP_PING)
+
+    def dac_write(self, dac, val):
+        """ Write a twos-complement value to a DAC (``dac_write_volt``). """
+        return self.request(OP_DAC_WRITE, dac, val)
+
+    def adc_read(self, adc, n):
+        """ :return: ``Reply`` of ``n`` sign extended samples. """
+        return self.request(OP_ADC_READ, adc, n,
+                            decode=lambda a: sign_extend_array(a, ADC_BITS))
+
+    def adc_read_many(self, adcs, n):
+        """
+        Read ``n`` samples from each ADC in ``adcs`` at the same time.
+
+        :return: ``Reply`` of an array with a row for each sample and a
+          column for each ADC.
+        """
+        adcs = list(adcs)
+        return self.request(OP_ADC_READ_MANY, n, *adcs,
+                            decode=lambda a: sign_extend_array(a, ADC_BITS)
+                                             .reshape(n, len(adcs)))
+
+    def ramp(self, dac, adc, start, stop, step, per_step):
+        """
+        Sweep a DAC over ``range(start, stop, step)`` and read
+        ``per_step`` samples at each value.
+
+        :return: ``Reply`` of an array with a row for each DAC value.
+        """
+        return self.request(OP_RAMP, dac, adc, start, stop, step, per_step,
+                            decode=lambda a: sign_extend_array(a, ADC_BITS)
+                                             .reshape(-1, per_step))
+
+    def cl_start(self, setpt, P, I, delay):
+        """
+        Give DAC 0 and ADC 0 to the control loop and start it.
+
+        :param P: Proportional constant in 21.43 fixed point.
+        :param I: Integral constant in 21.43 fixed point.
+        """
+        return self.request(OP_CL_START, setpt, P, I, delay)
+
+    def cl_set(self, setpt, P, I, delay):
+        """ Change all parameters of the running control loop. """
+        return self.request(OP_CL_SET, setpt, P, I, delay)
+
+    def cl_stop(self):
+        """ Stop the control loop and give DAC 0 and ADC 0 back. """
+        return self.request(OP_CL_STOP)
+
+    def cl_status(self):
+        """
+        :return: ``Reply`` of a tuple of ``z_pos``, ``z_measured`` and
+          ``cl_cycle_count``.
+        """
+        def decode(a):
+            return (int(sign_extend_array(a[:1], DAC_BITS)[0]),
+                    int(sign_extend_array(a[1:2], ADC_BITS)[0]),
+                    int(a[2]) & ((1 << ADC_BITS) - 1))
+        return self.request(OP_CL_STATUS, decode=decode)
+
+def start_server(session, port=RPC_PORT, dacs=(0,)):
+    """
+    Upload ``rpcd.py`` and the files it imports, and start it in the
+    background on the controller.
+
+    :param session: ``util.Session`` to the controller.
+    """
+    for f in COMM_FILES + ('rpcd.py',):
+        session.upload(f)
+    args = ' '.join(str(d) for d in dacs)
+    session.client.run_command(f'cd {session.remote_dir} && '
+                               f'nohup micropython rpcd.py {port} {args} '
+                               f'> /tmp/rpcd.log 2>&1 &')
+
+if __name__ == "__main__":
+    host = sys.argv[1] if len(sys.argv) > 1 else CONTROLLER_HOST
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else RPC_PORT
+
+    with RPCClient(host, port) as cl:
+        for name, f in [("ping", cl.ping),
+                        ("dac_write", lambda: cl.dac_write(0, 0)),
+                        ("adc_read 16", lambda: cl.adc_read(0, 16))]:
+            start = time.perf_counter()
+            for i in range(n):
+                f().result()
+            serial = time.perf_counter() - start
+
+            start = time.perf_counter()
+            replies = [f() for i in range(n)]
+            cl.flush()
+            for r in replies:
+                r.result()
+            piped = time.perf_counter() - start
+            print(f"{name}: serial {serial / n * 1e6:.0f} us/request, "
+                  f"pipelined {piped / n * 1e6:.0f} us/request")
@@ -0,0 +1,229 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# On-disk store for raster scans.
+#
+# A store is a directory:
+#
+#   meta.json      scan parameters (see ScanStore.create)
+#   times.bin      float64 time of each line (seconds since the epoch)
+#   adcN.bin       int32 samples of ADC N, [lines][2][max_samples]
+#   adcN.Lk.bin    float32 level k of ADC N, [lines>>k][2][max_samples>>k]
+#
+# All files are raw little-endian arrays that are only appended to, so a
+# scan can be read (memory mapped) while it is being written, and a scan
+# that was interrupted keeps every line that was written. Level k is the
+# mean of 2**k by 2**k blocks of samples, for viewing large scans.
+
+import json
+import os
+import time
+import numpy as np
+from raster import FORWARD, REVERSE
+
+STORE_VERSION = 1
+
+class ScanStore:
+    """
+    Raster scan stored on disk. Create with :meth:`create` or open with
+    :meth:`open`.
+    """
+
+    def __init__(self, path, meta, writable):
+        self.path = path
+        self.meta = meta
+        self.max_samples = meta['max_samples']
+        self.adcs = meta['adcs']
+        self.levels = meta['levels']
+        self.writable = writable
+        # Unpaired line of each level, (adc, level) -> array, for
+        # building the next level.
+        self.pending = {}
+        self.files = {}
+        if writable:
+            self._open_files()
+
+    @classmethod
+    def create(cls, path, max_samples, adcs, levels=4, **params):
+        """
+        Create a new store.
+
+        :param path: Directory of the store. It must not exist.
+        :param max_samples: Points in each direction of a line.
+        :param adcs: List of ADC numbers that are stored.
+        :param levels: Number of downsampled levels to keep.
+        :param params: Scan parameters to keep in the metadata, e.g.
+          ``dx``, ``dy``, ``settle_time``, ``P``, ``I``, ``max_lines``.
+          They must be JSON serializable.
+        """
+        os.makedirs(path)
+        meta = {
+            'version': STORE_VERSION,
+            'max_samples': max_samples,
+            'adcs': list(adcs),
+            'levels': levels,
+            'created': time.time(),
+            'params': params,
+        }
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        return cls(path, meta, True)
+
+    @classmethod
+    def open(cls, path, append=False):
+        """
+        Open an existing store.
+
+        :param append: Open for appending lines.
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != STORE_VERSION:
+            raise Exception(f"unknown store version {meta['version']}")
+        st = cls(path, meta, append)
+        if append:
+            st._load_pending()
+        return st
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _name(self, adc, level=0):
+        return f'adc{adc}.bin' if level == 0 else f'adc{adc}.L{level}.bin'
+
+    def _open_files(self):
+        names = ['times.bin'] + [self._name(a, k) for a in self.adcs
+                                 for k in range(self.levels + 1)]
+        for n in names:
+            self.files[n] = open(self._file(n), 'ab')
+
+    @property
+    def params(self):
+        return self.meta['params']
+
+    @property
+    def lines(self):
+        """ Number of complete lines. """
+        # The time is written last, so every line with a time is complete.
+        try:
+            return os.path.getsize(self._file('times.bin')) // 8
+        except FileNotFoundError:
+            return 0
+
+    def _level_shape(self, level):
+        return (self.lines >> level, 2, self.max_samples >> level)
+
+    def _load_pending(self):
+        # An aborted write can leave part of a time at the end of the
+        # times file. Drop it.
+        self.files['times.bin'].truncate(self.lines * 8)
+        # Levels of a line are written before its time, so the level
+        # files can have lines past the last complete line. Drop them.
+        for a in self.adcs:
+            for k in range(self.levels + 1):
+                n = self._name(a, k)
+                rows, _, cols = self._level_shape(k)
+                self.files[n].truncate(rows * 2 * cols * 4)
+            for k in range(self.levels):
+                rows = self.lines >> k
+                if rows % 2 == 1:
+                    self.pending[(a, k)] = np.array(self.level(a, k)[-1])
+
+    def _downsample(self, a, b):
+        """ Mean of the 2x2 blocks of two lines ``[2][n]``. """
+        n = a.shape[-1] // 2 * 2
+        s = a[:, :n].astype(np.float32) + b[:, :n]
+        return (s[:, 0::2] + s[:, 1::2]) / 4
+
+    def append(self, line, timestamp=None):
+        """
+        Append a line.
+
+        :param line: Either the ``[2][max_samples][adcs]`` view given by
+          ``RasterScan.lines()`` (with ADCs in the order of ``adcs``), or
+          a dictionary from ADC number to a ``[2][max_samples]`` array.
+        :param timestamp: Time of the line. Defaults to now.
+        """
+        if not self.writable:
+            raise Exception("store is not open for appending")
+        if timestamp is None:
+            timestamp = time.time()
+        for i, a in enumerate(self.adcs):
+            d = line[a] if isinstance(line, dict) else line[..., i]
+            d = np.ascontiguousarray(d, dtype='<i4')
+            if d.shape != (2, self.max_samples):
+                raise Exception(f"bad line shape {d.shape}")
+            self.files[self._name(a)].write(d.tobytes())
+
+            # Build the levels. Each pair of lines of level k is one line
+            # of level k+1.
+            cur = d
+            for k in range(self.levels):
+                prev = self.pending.pop((a, k), None)
+                if prev is None:
+                    self.pending[(a, k)] = cur
+                    break
+                cur = self._downsample(prev, cur)
+                self.files[self._name(a, k + 1)].write(
+                        cur.astype('<f4').tobytes())
+        for n, f in self.files.items():
+            if n != 'times.bin':
+                f.flush()
+        f = self.files['times.bin']
+        f.write(np.array([timestamp], dtype='<f8').tobytes())
+        f.flush()
+
+    def times(self):
+        """ :return: Time of each line. """
+        n = self.lines
+        if n == 0:
+            return np.zeros(0)
+        return np.memmap(self._file('times.bin'), dtype='<f8', mode='r',
+                         shape=(n,))
+
+    def level(self, adc, level=0):
+        """
+        :return: Read-only memory map of a level of an ADC, with shape
+          ``[lines][2][samples]``. Lines appended after this call are not
+          in the map.
+        """
+        shape = self._level_shape(level)
+        if shape[0] == 0 or shape[2] == 0:
+            return np.zeros(shape, dtype='<i4' if level == 0 else '<f4')
+        return np.memmap(self._file(self._name(adc, level)),
+                         dtype='<i4' if level == 0 else '<f4', mode='r',
+                         shape=shape)
+
+    def tile(self, adc, rows=slice(None), cols=slice(None),
+             direction=FORWARD, level=0):
+        """
+        Read part of an image. Only the pages of the files containing the
+        tile are read.
+
+        :param rows: Slice of lines, in units of the level.
+        :param cols: Slice of points, in units of the level.
+        :param direction: ``FORWARD`` or ``REVERSE``. Reverse lines are
+          flipped so that both images have the same orientation.
+        :return: Array ``[rows][cols]``.
+        """
+        img = self.level(adc, level)[:, direction, :]
+        if direction == REVERSE:
+            img = img[:, ::-1]
+        return np.array(img[rows, cols])
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+        self.writable = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
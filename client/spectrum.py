@@ -0,0 +1,447 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Noise analysis of long sample streams: Welch power spectral density,
+# overlapping Allan deviation and drift.
+#
+#     python3 spectrum.py --fs 10000 [-j JOBS] [--plot] run1.bin run2.bin ...
+#
+# Samples are consumed in chunks, and each estimator keeps a fixed
+# amount of state, so hours of samples can be analyzed as they arrive
+# or from files larger than memory. Files are analyzed in parallel, one
+# process per file.
+#
+# Files are either binary frames (as written by ``FrameWriter``; the
+# samples are on --channel, by default the sample channel of
+# noise_test.py), ``ColumnStore`` directories (the ``sample`` column, as
+# written by noise_test.py), NumPy ``.npy`` arrays, or raw arrays of
+# little-endian ``int32`` samples.
+#
+# Recordings of a DAC ramp (frame files with DAC frames, or stores with a
+# ``dac`` column) must not be analyzed across DAC steps: the ramp would
+# dominate the spectrum. Select one DAC value with --dac, or analyze
+# each one separately with --split-dac.
+
+import argparse
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from util import FRAME_MAGIC, read_frames
+from stats import RunningStats
+from colstore import ColumnStore
+
+# Channels of noise_test.py frame files.
+DAC_CHANNEL = 0
+SAMPLE_CHANNEL = 1
+
+def hann(n):
+    """
+    Periodic Hann window, the default window of ``scipy.signal.welch``.
+    ``np.hanning`` is the symmetric window, which is meant for filter
+    design and gives a slightly different estimate.
+    """
+    return 0.5 - 0.5 * np.cos(2 * np.pi * np.arange(n) / n)
+
+class WelchPSD:
+    """
+    Welch estimate of the one-sided power spectral density of a stream.
+
+    The stream is split into segments of ``nperseg`` samples that overlap
+    by ``noverlap`` samples. Each segment has its mean removed, is
+    windowed, and the squared magnitudes of their FFTs are summed. This
+    is the same estimate as ``scipy.signal.welch`` with
+    ``detrend='constant'`` and ``scaling='density'``.
+    """
+
+    def __init__(self, fs, nperseg=4096, noverlap=None, window=hann,
+                 batch=64):
+        """
+        :param fs: Sample rate in Hz.
+        :param nperseg: Samples per segment.
+        :param noverlap: Samples of overlap. Defaults to half a segment.
+        :param window: Function returning a window of the given length.
+        :param batch: Segments transformed at once. This bounds memory.
+        """
+        self.fs = fs
+        self.nperseg = nperseg
+        self.noverlap = nperseg // 2 if noverlap is None else noverlap
+        if not 0 <= self.noverlap < nperseg:
+            raise Exception(f"bad overlap {self.noverlap}")
+        self.step = nperseg - self.noverlap
+        self.window = window(nperseg).astype(np.float64)
+        self.batch = batch
+        self.sum = np.zeros(nperseg // 2 + 1)
+        self.segments = 0
+        # Samples not yet part of a full segment.
+        self.tail = np.zeros(0)
+
+    def update(self, samples):
+        """ Add a chunk of samples. """
+        buf = np.concatenate((self.tail, np.asarray(samples, np.float64)))
+        nseg = 0 if len(buf) < self.nperseg \
+               else (len(buf) - self.nperseg) // self.step + 1
+        for start in range(0, nseg, self.batch):
+            n = min(self.batch, nseg - start)
+            off = start * self.step
+            segs = np.lib.stride_tricks.sliding_window_view(
+                    buf[off:off + (n - 1) * self.step + self.nperseg],
+                    self.nperseg)[::self.step]
+            segs = segs - segs.mean(axis=1, keepdims=True)
+            spec = np.fft.rfft(segs * self.window, axis=1)
+            self.sum += np.square(np.abs(spec)).sum(axis=0)
+        self.segments += nseg
+        self.tail = buf[nseg * self.step:]
+
+    def merge(self, other):
+        """ Add the segments of another estimate with the same settings. """
+        self.sum += other.sum
+        self.segments += other.segments
+
+    def psd(self):
+        """
+        :return: Tuple of the frequencies (Hz) and the density (units**2
+          per Hz). The density is all NaN before the first segment.
+        """
+        f = np.fft.rfftfreq(self.nperseg, 1 / self.fs)
+        if self.segments == 0:
+            return f, np.full_like(f, math.nan)
+        p = self.sum / (self.segments * self.fs * np.square(self.window).sum())
+        # One-sided: fold the negative frequencies except DC and Nyquist.
+        if self.nperseg % 2 == 0:
+            p[1:-1] *= 2
+        else:
+            p[1:] *= 2
+        return f, p
+
+class AllanDeviation:
+    """
+    Overlapping Allan deviation of a stream of samples, at averaging
+    times of ``2**k`` samples up to ``max_m`` samples.
+
+    The samples are integrated into a phase, and the deviation at ``m``
+    samples is computed from the second differences ``x[i+2m] -
+    2 x[i+m] + x[i]`` of the phase. Only the last ``2 max_m`` phase values
+    are kept. Integer samples are integrated exactly in ``int64``.
+    """
+
+    def __init__(self, fs, max_m=1 << 20):
+        self.fs = fs
+        self.ms = [1 << k for k in range(max(max_m, 1).bit_length())]
+        self.keep = 2 * self.ms[-1]
+        self.sums = np.zeros(len(self.ms))
+        self.counts = np.zeros(len(self.ms), dtype=np.int64)
+        self.phase = None
+
+    def update(self, samples):
+        """ Add a chunk of samples. """
+        samples = np.asarray(samples)
+        if samples.size == 0:
+            return
+        dtype = np.int64 if samples.dtype.kind in 'iu' else np.float64
+        if self.phase is None:
+            self.phase = np.zeros(1, dtype=dtype)
+        elif self.phase.dtype != dtype:
+            self.phase = self.phase.astype(np.float64)
+            dtype = np.float64
+        x = np.concatenate((self.phase,
+                            self.phase[-1] + np.cumsum(samples, dtype=dtype)))
+        n = samples.size
+        for j, m in enumerate(self.ms):
+            if len(x) <= 2 * m:
+                break
+            d = x[2 * m:] - 2 * x[m:-m] + x[:-2 * m]
+            # Only the differences that end in the new samples.
+            d = d[-n:].astype(np.float64)
+            self.sums[j] += np.dot(d, d)
+            self.counts[j] += len(d)
+        self.phase = x[-self.keep:]
+
+    def deviation(self):
+        """
+        :return: Tuple of the averaging times (s), the Allan deviations
+          (in units of the samples) and the number of terms of each.
+          Averaging times without terms are left out.
+        """
+        ok = self.counts > 0
+        m = np.array(self.ms, dtype=np.float64)[ok]
+        avar = self.sums[ok] / (2 * m * m * self.counts[ok])
+        return m / self.fs, np.sqrt(avar), self.counts[ok]
+
+class Drift:
+    """
+    Linear drift of a stream, from a least-squares line through all
+    samples, and the means of blocks of ``block`` samples (for plotting
+    drift over a long run).
+    """
+
+    def __init__(self, fs, block=None):
+        """
+        :param block: Samples per block mean. Defaults to one second
+          (at least one sample).
+        """
+        self.fs = fs
+        self.block = max(int(fs), 1) if block is None else block
+        if self.block < 1:
+            raise Exception(f"block must be at least 1 sample, not {block}")
+        self.n = 0
+        # Means of t (in samples) and y, and the sums of squares and
+        # products of their deviations, merged with the same pairwise
+        # update as RunningStats to keep precision.
+        self.mean_t = 0.0
+        self.mean_y = 0.0
+        self.stt = 0.0
+        self.sty = 0.0
+        self.block_sum = 0.0
+        self.block_n = 0
+        self.means = []
+
+    def update(self, samples):
+        y = np.asarray(samples, dtype=np.float64)
+        n = y.size
+        if n == 0:
+            return
+        t = np.arange(self.n, self.n + n, dtype=np.float64)
+        mt, my = t.mean(), y.mean()
+        stt = np.square(t - mt).sum()
+        sty = np.dot(t - mt, y - my)
+        total = self.n + n
+        dt, dy = mt - self.mean_t, my - self.mean_y
+        self.stt += stt + dt * dt * self.n * n / total
+        self.sty += sty + dt * dy * self.n * n / total
+        self.mean_t += dt * n / total
+        self.mean_y += dy * n / total
+        self.n = total
+
+        # Block means. Finish the open block, add the whole blocks of the
+        # chunk at once, and keep the rest open.
+        i = min(n, self.block - self.block_n)
+        self.block_sum += y[:i].sum()
+        self.block_n += i
+        if self.block_n < self.block:
+            return
+        self.means.append(self.block_sum / self.block)
+        whole = (n - i) // self.block * self.block
+        self.means.extend(y[i:i + whole].reshape(-1, self.block)
+                          .mean(axis=1).tolist())
+        self.block_sum = y[i + whole:].sum()
+        self.block_n = n - i - whole
+
+    def slope(self):
+        """ :return: Drift in units of the samples per second. """
+        if self.n < 2 or self.stt == 0:
+            return math.nan
+        return self.sty / self.stt * self.fs
+
+    def block_means(self):
+        """ :return: Tuple of the block center times (s) and means. """
+        t = (np.arange(len(self.means)) + 0.5) * self.block / self.fs
+        return t, np.array(self.means)
+
+class NoiseAnalysis:
+    """ All of the estimators above, and ``RunningStats``, on one stream. """
+
+    def __init__(self, fs, nperseg=4096, max_m=1 << 20, block=None):
+        self.fs = fs
+        self.stats = RunningStats()
+        self.welch = WelchPSD(fs, nperseg)
+        self.allan = AllanDeviation(fs, max_m)
+        self.drift = Drift(fs, block)
+
+    def update(self, samples):
+        self.stats.update(samples)
+        self.welch.update(samples)
+        self.allan.update(samples)
+        self.drift.update(samples)
+
+    def result(self):
+        """ :return: Dictionary of the results, as NumPy arrays. """
+        f, p = self.welch.psd()
+        tau, adev, terms = self.allan.deviation()
+        bt, bm = self.drift.block_means()
+        return {
+            'count': self.stats.count,
+            'mean': self.stats.mean,
+            'std': self.stats.std(),
+            'min': self.stats.min,
+            'max': self.stats.max,
+            'freq': f,
+            'psd': p,
+            'segments': self.welch.segments,
+            'tau': tau,
+            'adev': adev,
+            'adev_terms': terms,
+            'drift': self.drift.slope(),
+            'block_time': bt,
+            'block_mean': bm,
+        }
+
+def _store_dacs(st):
+    return 'dac' in st.columns and st.rows > 0
+
+def dac_values(path, channel=SAMPLE_CHANNEL, chunk=1 << 20):
+    """
+    :return: Sorted DAC values with samples in a recorded file. Empty if
+      the file has no DAC values.
+    """
+    if os.path.isdir(path):
+        st = ColumnStore.open(path)
+        return np.unique(st['dac']).tolist() if _store_dacs(st) else []
+    if path.endswith('.npy'):
+        return []
+    with open(path, 'rb') as f:
+        if f.read(len(FRAME_MAGIC)) != FRAME_MAGIC:
+            return []
+        f.seek(0)
+        found = set()
+        dac = None
+        for fr in read_frames(f, chunk):
+            if fr.channel == DAC_CHANNEL and channel != DAC_CHANNEL:
+                dac = int(fr.samples[0])
+            elif fr.channel == channel and dac is not None:
+                found.add(dac)
+        return sorted(found)
+
+def read_chunks(path, channel=SAMPLE_CHANNEL, chunk=1 << 20, dac=None):
+    """
+    Read the samples of a recorded file in chunks.
+
+    :param channel: For files of frames, the channel to read.
+    :param dac: For recordings of a DAC ramp, the DAC value whose
+      samples are read.
+    :return: Generator of arrays of samples.
+    :raises Exception: If ``dac`` is ``None`` and the file has samples of
+      more than one DAC value.
+    """
+    def several():
+        return Exception(f"{path} has samples of several DAC values, "
+                         f"select one with dac (see dac_values)")
+
+    if os.path.isdir(path):
+        st = ColumnStore.open(path)
+        a = st['sample']
+        d = st['dac'] if _store_dacs(st) else None
+        if d is not None and dac is None and d.min() != d.max():
+            raise several()
+        for i in range(0, len(a), chunk):
+            if d is None or dac is None:
+                yield np.asarray(a[i:i + chunk])
+            else:
+                yield np.asarray(a[i:i + chunk])[d[i:i + chunk] == dac]
+        return
+    if path.endswith('.npy'):
+        a = np.load(path, mmap_mode='r')
+        for i in range(0, len(a), chunk):
+            yield np.asarray(a[i:i + chunk])
+        return
+    with open(path, 'rb') as f:
+        frames = f.read(len(FRAME_MAGIC)) == FRAME_MAGIC
+        f.seek(0)
+        if frames:
+            cur = None
+            seen = None
+            for fr in read_frames(f, chunk):
+                if fr.channel == DAC_CHANNEL and channel != DAC_CHANNEL:
+                    cur = int(fr.samples[0])
+                    continue
+                if fr.channel != channel:
+                    continue
+                if dac is None:
+                    if cur is not None and seen is not None and cur != seen:
+                        raise several()
+                    seen = cur
+                    yield fr.samples
+                elif cur == dac:
+                    yield fr.samples
+            return
+        while True:
+            data = f.read(4 * chunk)
+            if not data:
+                break
+            yield np.frombuffer(data[:len(data) // 4 * 4], dtype='<i4')
+
+def analyze_file(path, fs, channel=SAMPLE_CHANNEL, dac=None,
+                 split_dac=False, **kwargs):
+    """
+    :param split_dac: Analyze the samples of each DAC value separately.
+    :return: ``NoiseAnalysis.result()`` of a recorded file, or with
+      ``split_dac`` a dictionary from DAC value to the result.
+    """
+    if split_dac:
+        return {d: analyze_file(path, fs, channel, d, **kwargs)
+                for d in dac_values(path, channel)}
+    a = NoiseAnalysis(fs, **kwargs)
+    for samples in read_chunks(path, channel, dac=dac):
+        a.update(samples)
+    return a.result()
+
+def analyze_files(paths, fs, channel=SAMPLE_CHANNEL, jobs=None, dac=None,
+                  split_dac=False, **kwargs):
+    """
+    Analyze recorded files in parallel.
+
+    :param jobs: Number of processes. Defaults to the number of CPUs.
+    :return: Dictionary from path to the result of ``analyze_file``.
+    """
+    with ProcessPoolExecutor(max_workers=jobs) as ex:
+        futs = {p: ex.submit(analyze_file, p, fs, channel, dac, split_dac,
+                             **kwargs)
+                for p in paths}
+        return {p: f.result() for p, f in futs.items()}
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="PSD, Allan deviation and drift of recorded samples")
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--fs', type=float, required=True,
+                        help="sample rate in Hz")
+    parser.add_argument('--channel', type=int, default=SAMPLE_CHANNEL,
+                        help="frame channel to read (default: %(default)s)")
+    dac = parser.add_mutually_exclusive_group()
+    dac.add_argument('--dac', type=int,
+                     help="analyze only the samples of this DAC value")
+    dac.add_argument('--split-dac', action='store_true',
+                     help="analyze the samples of each DAC value separately")
+    parser.add_argument('--nperseg', type=int, default=4096,
+                        help="samples per Welch segment")
+    parser.add_argument('--max-m', type=int, default=1 << 20,
+                        help="longest Allan averaging time in samples")
+    parser.add_argument('-j', '--jobs', type=int, help="parallel processes")
+    parser.add_argument('--plot', action='store_true')
+    args = parser.parse_args()
+
+    results = analyze_files(args.files, args.fs, args.channel, args.jobs,
+                            args.dac, args.split_dac,
+                            nperseg=args.nperseg, max_m=args.max_m)
+    if args.split_dac:
+        results = {f'{p} dac {d}': r for p, rs in results.items()
+                   for d, r in rs.items()}
+    for path, r in results.items():
+        print(f"{path}: {r['count']} samples, mean {r['mean']:.3f} "
+              f"std {r['std']:.3f}, drift {r['drift']:.3g}/s, "
+              f"{r['segments']} segments")
+        print(f"{'tau (s)':>12} {'adev':>12} {'terms':>12}")
+        for t, d, n in zip(r['tau'], r['adev'], r['adev_terms']):
+            print(f"{t:12.6g} {d:12.6g} {n:12d}")
+
+    if args.plot:
+        import matplotlib.pyplot as plt
+        fig, (ax1, ax2) = plt.subplots(1, 2)
+        for path, r in results.items():
+            name = os.path.basename(path)
+            ax1.loglog(r['freq'][1:], r['psd'][1:], label=name)
+            ax2.loglog(r['tau'], r['adev'], marker='o', label=name)
+        ax1.set_xlabel('frequency (Hz)')
+        ax1.set_ylabel('PSD (units^2/Hz)')
+        ax2.set_xlabel('tau (s)')
+        ax2.set_ylabel('Allan deviation')
+        ax1.legend()
+        plt.show()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Online statistics for long acquisitions. Samples are reduced as they
+# arrive, so memory use does not grow with the length of the run.
+
+import math
+import time
+import numpy as np
+
+class RunningStats:
+    """
+    Count, mean, variance, minimum and maximum of a stream of samples.
+
+    Each chunk of samples is reduced with NumPy, and then merged into the
+    running totals with the pairwise update of Chan et al. For single
+    samples this is Welford's algorithm.
+    """
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.mean = 0.0
+        # Sum of squares of differences from the mean.
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _merge(self, count, mean, m2, lo, hi):
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self.m2 += m2 + delta * delta * self.count * count / total
+        self.count = total
+        self.min = min(self.min, lo)
+        self.max = max(self.max, hi)
+
+    def update(self, samples):
+        """
+        Add a chunk of samples.
+
+        :param samples: Array-like of numbers.
+        """
+        samples = np.asarray(samples, dtype=np.float64)
+        if samples.size == 0:
+            return
+        mean = samples.mean()
+        m2 = np.square(samples - mean).sum()
+        self._merge(samples.size, float(mean), float(m2),
+                    float(samples.min()), float(samples.max()))
+
+    def merge(self, other):
+        """
+        Add the samples summarized by another ``RunningStats``.
+        """
+        self._merge(other.count, other.mean, other.m2, other.min, other.max)
+
+    def variance(self, ddof=0):
+        """
+        :param ddof: Delta degrees of freedom, like ``np.var``.
+        :return: Variance of the samples, or NaN if there are not enough
+          samples.
+        """
+        if self.count - ddof <= 0:
+            return math.nan
+        return self.m2 / (self.count - ddof)
+
+    def std(self, ddof=0):
+        return math.sqrt(self.variance(ddof))
+
+class SetpointStats:
+    """
+    ``RunningStats`` for each setpoint (e.g. DAC value) of a ramp.
+
+    Partial results are passed to a callback while the run is going, so
+    a run can be watched and stopped early.
+    """
+
+    def __init__(self, on_result=None, interval=None):
+        """
+        :param on_result: Function called as ``on_result(setpoint, stats)``
+          when the ramp moves on from a setpoint, and for the current
+          setpoint every ``interval`` seconds.
+        :param interval: Seconds between updates for the current
+          setpoint. ``None`` only reports finished setpoints.
+        """
+        self.stats = {}
+        self.on_result = on_result
+        self.interval = interval
+        self.current = None
+        self.last_report = time.monotonic()
+
+    def _report(self, setpoint):
+        if self.on_result is not None:
+            self.on_result(setpoint, self.stats[setpoint])
+        self.last_report = time.monotonic()
+
+    def update(self, setpoint, samples):
+        """
+        Add samples taken at a setpoint.
+
+        :param setpoint: Hashable setpoint, e.g. the DAC value. It must
+          not be ``None``.
+        :param samples: Array-like of samples.
+        :raises Exception: If ``setpoint`` is ``None``.
+        """
+        if setpoint is None:
+            raise Exception("samples without a setpoint")
+        if setpoint != self.current:
+            if self.current is not None:
+                self._report(self.current)
+            self.current = setpoint
+
+        st = self.stats.get(setpoint)
+        if st is None:
+            st = self.stats[setpoint] = RunningStats()
+        st.update(samples)
+
+        if self.interval is not None \
+           and time.monotonic() - self.last_report >= self.interval:
+            self._report(setpoint)
+
+    def finish(self):
+        """ Report the last setpoint. Call this at the end of a run. """
+        if self.current is not None:
+            self._report(self.current)
+            self.current = None
+
+    def table(self, ddof=0):
+        """
+        :return: Dictionary of arrays ``setpoint``, ``count``, ``mean``,
+          ``std``, ``min`` and ``max``, sorted by setpoint. This can be
+          passed directly to ``pandas.DataFrame``.
+        """
+        keys = sorted(self.stats)
+        st = [self.stats[k] for k in keys]
+        return {
+            "setpoint": np.array(keys),
+            "count": np.array([s.count for s in st], dtype=np.int64),
+            "mean": np.array([s.mean for s in st]),
+            "std": np.array([s.std(ddof) for s in st]),
+            "min": np.array([s.min for s in st]),
+            "max": np.array([s.max for s in st]),
+        }
@@ -0,0 +1,152 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Client of the control loop telemetry service (linux/telemetryd.py).
+#
+# Usage: python3 telemetry.py [host] [seconds]
+
+import asyncio
+import sys
+import time
+from collections import namedtuple
+import numpy as np
+from util import *
+
+TELEMETRY_PORT = 5017
+
+# Channels sent by telemetryd.py.
+CH_INDEX = 0
+CH_Z_POS = 1
+CH_Z_MEASURED = 2
+CH_CYCLE_COUNT = 3
+CHANNELS = (CH_INDEX, CH_Z_POS, CH_Z_MEASURED, CH_CYCLE_COUNT)
+
+# cl_cycle_count is an 18 bit unsigned register.
+CYCLE_COUNT_BITS = 18
+
+Batch = namedtuple('Batch', ['index', 'z_pos', 'z_measured', 'cycle_count'])
+
+class TelemetryClient:
+    """
+    Receives control loop samples from telemetryd.py.
+
+    Samples are numbered by their sampling slot on the controller. Gaps
+    in the numbering (slots the controller missed, or samples it dropped
+    because the client fell behind) are counted in ``dropped``.
+    """
+
+    def __init__(self, host=CONTROLLER_HOST, port=TELEMETRY_PORT):
+        self.host = host
+        self.port = port
+        self.decoder = FrameDecoder()
+        self.reader = None
+        self.writer = None
+        self.next_index = None
+        self.received = 0
+        self.dropped = 0
+        # Frames of the batch being received, by channel.
+        self.partial = {}
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+    async def __aenter__(self):
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    def _check(self, index):
+        """ Count the samples missing before and within ``index``. """
+        if len(index) == 0:
+            return
+        if self.next_index is not None:
+            self.dropped += int(index[0]) - self.next_index
+        self.dropped += int((np.diff(index) - 1).sum())
+        self.next_index = int(index[-1]) + 1
+        self.received += len(index)
+
+    def _batches(self, frames):
+        batches = []
+        for fr in frames:
+            if fr.channel == CH_INDEX:
+                self.partial = {}
+            self.partial[fr.channel] = fr.samples
+            if len(self.partial) == len(CHANNELS):
+                b = Batch(*(self.partial[c] for c in CHANNELS))
+                # The cycle count is unsigned. Mask it again in case the
+                # frame was sent signed.
+                b = b._replace(cycle_count=b.cycle_count
+                               & ((1 << CYCLE_COUNT_BITS) - 1))
+                self._check(b.index)
+                batches.append(b)
+                self.partial = {}
+        return batches
+
+    async def batches(self, chunk=65536):
+        """
+        Receive batches until the connection is closed.
+
+        :return: Asynchronous generator of ``Batch``es of NumPy arrays.
+          ``z_pos`` and ``z_measured`` are sign extended, and
+          ``cycle_count`` is the unsigned length in clock cycles of the
+          loop iteration before the sample.
+        """
+        while True:
+            data = await self.reader.read(chunk)
+            if not data:
+                return
+            for b in self._batches(self.decoder.feed(data)):
+                yield b
+
+async def collect(seconds, host=CONTROLLER_HOST, port=TELEMETRY_PORT,
+                  on_batch=None):
+    """
+    Receive telemetry for ``seconds`` seconds.
+
+    :param on_batch: Function called with each ``Batch`` as it arrives.
+    :return: Tuple of a ``Batch`` of all received samples and the
+      ``TelemetryClient``.
+    """
+    got = []
+    async with TelemetryClient(host, port) as cl:
+        async def receive():
+            async for b in cl.batches():
+                got.append(b)
+                if on_batch is not None:
+                    on_batch(b)
+        try:
+            await asyncio.wait_for(receive(), seconds)
+        except asyncio.TimeoutError:
+            pass
+    if not got:
+        return Batch(*(np.zeros(0, dtype=np.int32) for _ in CHANNELS)), cl
+    return Batch(*(np.concatenate(a) for a in zip(*got))), cl
+
+if __name__ == "__main__":
+    host = sys.argv[1] if len(sys.argv) > 1 else CONTROLLER_HOST
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    def on_batch(b):
+        print(f"{b.index[-1]:10d} z_pos {b.z_pos.mean():10.1f} "
+              f"z_measured {b.z_measured.mean():10.1f} "
+              f"cycles {b.cycle_count.mean():8.1f}")
+
+    start = time.monotonic()
+    data, cl = asyncio.run(collect(seconds, host, on_batch=on_batch))
+    t = time.monotonic() - start
+    print(f"received {cl.received} samples in {t:.1f} s "
+          f"({cl.received / t:.0f}/s), dropped {cl.dropped}")
@@ -0,0 +1,128 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Properties of the exact fixed point conversions in util.py.
+#
+#     python3 -m pytest client/test_fixedpoint.py
+#
+# The properties are checked with hypothesis if it is installed, and on
+# a seeded random sweep (plus edge cases) otherwise.
+
+from decimal import Decimal
+from fractions import Fraction
+import numpy as np
+from util import *
+
+try:
+    from hypothesis import given, strategies as st
+except ImportError:
+    given = None
+
+FRACNUM = 43
+INT64_MIN = -(1 << 63)
+INT64_MAX = (1 << 63) - 1
+
+# Values in (-1, 0) lost their sign in string_to_fixed_point, since the
+# whole part "-0" is 0.
+SIGN_EDGES = ['-0.5', '-0.0006', '-0.999', '-0', '0', '0.5', '-1.5', '-1']
+FXP_EDGES = [0, 1, -1, 1 << FRACNUM, -(1 << FRACNUM), 1 << (FRACNUM - 1),
+             -(1 << (FRACNUM - 1)), INT64_MAX, INT64_MIN]
+
+def random_decimal_string(rng):
+    """ Random decimal string accepted by string_to_fixed_point. """
+    sign = "-" if rng.random() < 0.5 else ""
+    whole = str(rng.integers(0, 1 << 20)) if rng.random() < 0.7 else "0"
+    if rng.random() < 0.1:
+        return sign + whole
+    # string_to_fixed_point uses the default Decimal precision of 28
+    # digits, so it is only exact up to there.
+    digits = rng.integers(1, 28 - len(whole) + 1)
+    frac = "".join(str(d) for d in rng.integers(0, 10, digits))
+    return f"{sign}{whole}.{frac}"
+
+def sweep_strings(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    return SIGN_EDGES + [random_decimal_string(rng) for _ in range(n)]
+
+def sweep_fxps(n=5000, seed=0):
+    rng = np.random.default_rng(seed)
+    return FXP_EDGES + [int(v) for v in rng.integers(INT64_MIN, INT64_MAX,
+                                                    n, dtype=np.int64)]
+
+def check_string(s):
+    ref = string_to_fixed_point(s, FRACNUM)
+    assert to_fixed_point(s, FRACNUM) == ref, s
+    assert to_fixed_point(Decimal(s), FRACNUM) == ref, s
+    # Truncated towards zero, so the sign is kept.
+    exact = Fraction(s)
+    assert abs(Fraction(ref, 1 << FRACNUM)) <= abs(exact), s
+    assert (ref < 0) == (exact <= -Fraction(1, 1 << FRACNUM)), s
+
+def check_fxp(v):
+    s = format_fixed_point(v, FRACNUM)
+    assert s == fixed_point_to_string(v, FRACNUM), v
+    assert to_fixed_point(fixed_point_to_fraction(v, FRACNUM), FRACNUM) == v
+    # The strings are the floor of the value followed by the fraction
+    # above it (-0.5 is "-1.5"), so only non-negative values are plain
+    # decimals.
+    whole, _, frac = s.partition('.')
+    assert Fraction(int(whole)) + Fraction('0.' + (frac or '0')) \
+           == fixed_point_to_fraction(v, FRACNUM), v
+    if v >= 0:
+        assert to_fixed_point(s, FRACNUM) == v, v
+
+def check_float(x):
+    assert to_fixed_point(x, FRACNUM) == \
+           float_to_fixed_point([x], FRACNUM)[0], x
+
+def test_sign_edges():
+    assert string_to_fixed_point('-0.5', FRACNUM) == -(1 << (FRACNUM - 1))
+    assert to_fixed_point('-0.5', FRACNUM) == -(1 << (FRACNUM - 1))
+    assert format_fixed_point(-(1 << (FRACNUM - 1)), FRACNUM) \
+           == '-1.5' + '0' * (FRACNUM - 1)
+    for s in SIGN_EDGES:
+        check_string(s)
+
+def test_sign_extend_edges():
+    assert sign_extend(1 << 17, 18) == -(1 << 17)
+    assert sign_extend(0xFFFFFFFF, 18) == -1
+    vals = [0, 1, (1 << 17) - 1, 1 << 17, (1 << 18) - 1, 0xFFFFFFFF]
+    assert sign_extend_array(vals, 18).tolist() == \
+           [sign_extend(v, 18) for v in vals]
+
+if given is not None:
+    decimal_strings = st.builds(
+            lambda sign, whole, frac: f"{sign}{whole}.{frac}" if frac
+                                      else f"{sign}{whole}",
+            st.sampled_from(['', '-']), st.integers(0, (1 << 20) - 1),
+            st.text('0123456789', max_size=20))
+
+    @given(decimal_strings)
+    def test_string(s):
+        check_string(s)
+
+    @given(st.integers(INT64_MIN, INT64_MAX))
+    def test_round_trip(v):
+        check_fxp(v)
+
+    @given(st.floats(-1e6, 1e6))
+    def test_float(x):
+        check_float(x)
+else:
+    def test_string():
+        for s in sweep_strings():
+            check_string(s)
+
+    def test_round_trip():
+        for v in sweep_fxps():
+            check_fxp(v)
+
+    def test_float():
+        rng = np.random.default_rng(0)
+        for x in [0.0, -0.0, 0.5, -0.5] + rng.normal(0, 1e3, 5000).tolist():
+            check_float(x)
@@ -7,41 +7,422 @@ source distribution.
 """
 from math import log10, floor
 from decimal import *
+from collections import namedtuple
+from fractions import Fraction
+from functools import lru_cache
+import hashlib
+import struct
+import subprocess
+import time
+import numpy as np
+
+CONTROLLER_HOST = '192.168.2.50'
+CONTROLLER_USER = 'root'
+CONTROLLER_KEY = '~/.ssh/upsilon_key'
+
+# Files in ``../linux`` that a script importing ``comm`` needs on the
+# controller. ``comm.py`` imports ``comm_block.py``.
+COMM_FILES = ('comm.py', 'comm_block.py')
 
 def sign_extend(value, bits):
     """
     Interpret ``value`` as a twos-complement integer of ``bits`` length.
 
-    :param value: Twos-complement integer with finite bit width.
+    :param value: Twos-complement integer with finite bit width. Bits
+      above ``bits`` are ignored.
     :param bits: Bit length of ``value``.
     :return: ``value`` converted to a Python integer.
     """
 
+    # Ignore bits above ``bits``, like sign_extend_array does.
+    value &= (1 << bits) - 1
     # Check the sign bit of the integer.
     is_signed = (value >> (bits - 1)) & 1 == 1
     # If not signed, just return the integer.
     if not is_signed:
         return value
-    # Otherwise,
-    # 1. Do an explicit twos-complement negation
-    # 2. Mask all the non-sign bits
-    # This returns the positive value as a standard Python integer.
-    # Then the function negates the positive integer to get the negative
-    # one back.
-    return -((~value + 1) & ((1 << (bits - 1)) - 1))
+    # Otherwise, subtract the weight of the sign bit. This also handles
+    # the most negative number (only the sign bit set), which the old
+    # negate-and-mask method mapped to 0.
+    return value - (1 << bits)
+
+def sign_extend_array(values, bits, dtype=np.int32):
+    """
+    Vectorized version of :func:`sign_extend`.
+
+    :param values: Array-like of twos-complement integers, or a raw
+      bytes-like buffer of little-endian 32 bit words (the format of
+      ``machine.mem32`` reads). Bits above ``bits`` are ignored.
+    :param bits: Bit length of each value (at most 64).
+    :param dtype: Integer type of the returned array. It must be able to
+      hold ``bits`` signed bits.
+    :return: Array of ``dtype`` with each value sign extended.
+    """
+    if isinstance(values, (bytes, bytearray, memoryview)):
+        values = np.frombuffer(values, dtype='<u4')
+    values = np.asarray(values)
+    if values.dtype.kind not in 'iu':
+        raise TypeError(f"cannot sign extend array of {values.dtype}")
+
+    # Work in unsigned 64 bit arithmetic, which wraps around, so that
+    # the result is the twos-complement bit pattern of the signed value.
+    v = values.astype(np.uint64)
+    if bits < 64:
+        v &= np.uint64((1 << bits) - 1)
+        sign = np.uint64(1 << (bits - 1))
+        v = (v ^ sign) - sign
+    return v.view(np.int64).astype(dtype, copy=False)
+
+def fixed_point_to_float(fxp, fracnum, bits=64):
+    """
+    Convert an array of twos-complement fixed point words to floating point.
+
+    Values with more than 53 significant bits are rounded to the nearest
+    ``float64``.
+
+    :param fxp: Array-like or bytes-like buffer of fixed point words.
+      See :func:`sign_extend_array`.
+    :param fracnum: Number of fractional bits (43 for control loop
+      parameters).
+    :param bits: Total bit length of each word.
+    :return: ``float64`` array.
+    """
+    return np.ldexp(sign_extend_array(fxp, bits, np.int64).astype(np.float64),
+                    -fracnum)
+
+def float_to_fixed_point(x, fracnum):
+    """
+    Convert an array of floating point numbers to twos-complement fixed
+    point.
+
+    Like :func:`string_to_fixed_point`, fractional bits that do not fit
+    are truncated towards zero. The exact binary value of each float is
+    converted, so no decimal rounding takes place.
+
+    :param x: Array-like of floats.
+    :param fracnum: Number of fractional bits.
+    :return: ``int64`` array of fixed point words.
+    """
+    # Scaling by a power of two is exact, and so is truncation.
+    return np.trunc(np.ldexp(np.asarray(x, dtype=np.float64), fracnum)) \
+             .astype(np.int64)
+
+def ssh_options(pkey=CONTROLLER_KEY, batch=False):
+    """
+    :return: Options of the OpenSSH client for a controller. Connection
+      sharing keeps one connection open to each controller between
+      calls.
+    :param batch: Fail instead of asking for a password.
+    """
+    from os.path import expanduser
+    opts = ['-i', expanduser(pkey),
+            '-o', 'ControlMaster=auto',
+            '-o', 'ControlPath=/tmp/upsilon-ssh-%r@%h:%p',
+            '-o', 'ControlPersist=60']
+    if batch:
+        opts += ['-o', 'BatchMode=yes']
+    return opts
+
+class UploadCache:
+    """
+    SHA-256 of the scripts known to be on the controllers, so that a
+    script is only copied when the controller does not have the same
+    file. This assumes nothing else modifies the uploaded scripts.
+
+    The caller checks the controller with ``hash_command`` and copies
+    the file; this class only keeps track of what was checked.
+    """
+
+    def __init__(self, remote_dir='/root/'):
+        """
+        :param remote_dir: Directory on the controllers to upload
+          scripts to.
+        """
+        self.remote_dir = remote_dir
+        self.hashes = {}
+
+    def plan(self, f, host=None):
+        """
+        :param f: Script name in ``../linux``.
+        :return: Tuple of the local path, the remote path and the SHA-256
+          of the script, or ``None`` if ``host`` is known to have it.
+        """
+        local = f'../linux/{f}'
+        remote = f'{self.remote_dir}{f}'
+        with open(local, 'rb') as fp:
+            h = hashlib.sha256(fp.read()).hexdigest()
+        if self.hashes.get((host, remote)) == h:
+            return None
+        return local, remote, h
+
+    @staticmethod
+    def hash_command(remote):
+        """ :return: Shell command printing the SHA-256 of ``remote``. """
+        return f'sha256sum {remote} 2>/dev/null || true'
+
+    @staticmethod
+    def parse_hash(out):
+        """
+        :param out: Output of ``hash_command``, as text or bytes.
+        :return: Hex SHA-256, or ``None`` if the file does not exist.
+        """
+        if isinstance(out, bytes):
+            out = out.decode(errors='replace')
+        words = out.split()
+        return words[0] if words else None
+
+    def uploaded(self, remote, h, host=None):
+        """ Record that ``host`` has the file with SHA-256 ``h``. """
+        self.hashes[(host, remote)] = h
+
+class Session:
+    """
+    Persistent connection to the controller.
+
+    Opening an SSH connection and copying a script takes most of the
+    time of a short run. A session keeps the connection open between
+    runs, and only uploads a script when the copy on the controller
+    differs from the local one.
+    """
+
+    def __init__(self, host=CONTROLLER_HOST, user=CONTROLLER_USER,
+                 pkey=CONTROLLER_KEY, remote_dir='/root/', verbose=True):
+        """
+        :param remote_dir: Directory on the controller to upload scripts
+          to.
+        :param verbose: Print each operation and how long it took.
+        """
+        from pssh.clients import SSHClient # require parallel-ssh
+
+        self.host = host
+        self.user = user
+        self.pkey = pkey
+        self.remote_dir = remote_dir
+        self.verbose = verbose
+        # List of (operation, seconds) for every timed operation.
+        self.latencies = []
+        self.uploads = UploadCache(remote_dir)
+
+        start = time.perf_counter()
+        self.client = SSHClient(host, user=user, pkey=pkey)
+        self._timed('connect', start)
+
+    def _timed(self, what, start):
+        t = time.perf_counter() - start
+        self.latencies.append((what, t))
+        if self.verbose:
+            print(f'{what}: {t*1e3:.1f} ms')
+
+    def remote_hash(self, path):
+        """
+        :return: Hex SHA-256 of a file on the controller, or ``None`` if
+          it does not exist.
+        """
+        out = self.client.run_command(UploadCache.hash_command(path))
+        return UploadCache.parse_hash('\n'.join(out.stdout))
+
+    def upload(self, f):
+        """
+        Upload a script from ``../linux`` if the controller does not
+        already have the same file.
+
+        :return: ``True`` if the file was copied.
+        """
+        plan = self.uploads.plan(f)
+        if plan is None:
+            return False
+        local, remote, h = plan
+
+        start = time.perf_counter()
+        copied = self.remote_hash(remote) != h
+        if copied:
+            self.client.scp_send(local, remote)
+        self.uploads.uploaded(remote, h)
+        self._timed(f'upload {f}' if copied else f'check {f}', start)
+        return copied
+
+    def _command(self, f, arg):
+        return f'micropython {f} {" ".join([str(s) for s in arg])}'
+
+    def execute(self, f, *arg, wait=False):
+        """
+        Upload (if needed) and run a script on the controller.
+
+        ``run_command`` returns as soon as the command is sent, so
+        without ``wait`` only the time to send it is recorded (as
+        ``dispatch``). With ``wait``, the time until the script exits is
+        recorded (as ``run``).
+
+        :param f: Script name in ``../linux``.
+        :param arg: Command line arguments of the script.
+        :param wait: Wait for the script to exit before returning. Its
+          output is kept and can still be read from the result.
+        :return: Parallel-ssh ``HostOutput`` of the command.
+        """
+        self.upload(f)
+        args = self._command(f, arg)
+        start = time.perf_counter()
+        out = self.client.run_command(args)
+        if wait:
+            self.client.wait_finished(out)
+            self._timed(f'run {args}', start)
+        else:
+            self._timed(f'dispatch {args}', start)
+        return out
+
+    def stream(self, f, *arg):
+        """
+        Upload (if needed) and run a script, but keep its output binary.
+
+        Parallel-ssh decodes output into lines of text, which corrupts
+        binary frames, so the script is run through the OpenSSH client
+        instead. OpenSSH connection sharing keeps its connection open
+        between calls as well.
+
+        :return: ``subprocess.Popen`` whose ``stdout`` is the raw output
+          of the script. Read it with :func:`read_frames`.
+        """
+        self.upload(f)
+        args = self._command(f, arg)
+        start = time.perf_counter()
+        proc = subprocess.Popen(['ssh', *ssh_options(self.pkey),
+                                 f'{self.user}@{self.host}', args],
+                                stdout=subprocess.PIPE)
+        # Like ``execute``, this only covers starting the command.
+        self._timed(f'dispatch {args}', start)
+        return proc
+
+    def close(self):
+        self.client.disconnect()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+# Session shared by connect_execute() and connect_stream().
+_session = None
+
+def default_session():
+    """
+    :return: A ``Session`` to the controller that is shared by all
+      callers in this process.
+    """
+    global _session
+    if _session is None:
+        _session = Session()
+    return _session
 
 def connect_execute(f, *arg):
-    from pssh.clients import SSHClient # require parallel-ssh
-
-    print('connecting')
-    client = SSHClient('192.168.2.50', user='root', pkey='~/.ssh/upsilon_key')
-    # Upload the script.
-    print('connected')
-    client.scp_send(f'../linux/{f}', '/root/')
-    # Run the script.
-    args = f'micropython {f} {" ".join([str(s) for s in arg])}'
-    print(f"running {args}")
-    return client.run_command(args)
+    """
+    Run a script from ``../linux`` on the controller. See
+    ``Session.execute``.
+    """
+    return default_session().execute(f, *arg)
+
+def connect_stream(f, *arg):
+    """
+    Run a script from ``../linux`` on the controller with binary output.
+    See ``Session.stream``.
+    """
+    return default_session().stream(f, *arg)
+
+# Binary sample frames. See ``FrameWriter`` in ``linux/comm.py`` for
+# the layout.
+
+FRAME_MAGIC = b'UP'
+FRAME_HEADER = struct.Struct('<2sBBBBHI')
+FRAME_SIGNED = 1
+
+Frame = namedtuple('Frame', ['channel', 'bits', 'seq', 'samples'])
+
+class FrameDecoder:
+    """
+    Incremental decoder for binary sample frames.
+
+    Data can be fed in arbitrary pieces: partial frames are kept until
+    the rest of the frame arrives.
+    """
+
+    def __init__(self):
+        self.pending = b''
+        self.next_seq = None
+        # Number of frames missing from the sequence.
+        self.dropped = 0
+        # Number of bytes skipped while looking for a frame header.
+        self.skipped = 0
+
+    def feed(self, data):
+        """
+        Decode frames.
+
+        :param data: Bytes-like object received from the controller.
+        :return: List of complete ``Frame``s in ``data`` and previously
+          fed data. Samples are decoded into ``int32`` arrays, so
+          unsigned samples must have less than 32 bits.
+        """
+        buf = self.pending + bytes(data)
+        off = 0
+        frames = []
+
+        while len(buf) - off >= FRAME_HEADER.size:
+            magic, channel, bits, flags, _, count, seq = \
+                    FRAME_HEADER.unpack_from(buf, off)
+            if magic != FRAME_MAGIC:
+                # Out of sync (e.g. text printed by the script). Skip
+                # to the next possible header.
+                nxt = buf.find(FRAME_MAGIC, off + 1)
+                if nxt < 0:
+                    nxt = len(buf) - 1
+                self.skipped += nxt - off
+                off = nxt
+                continue
+
+            end = off + FRAME_HEADER.size + 4*count
+            if end > len(buf):
+                break
+
+            raw = np.frombuffer(buf, dtype='<i4', count=count,
+                                offset=off + FRAME_HEADER.size)
+            # Frames are usually small, so this avoids the overhead of
+            # sign_extend_array and does the extension with two shifts.
+            shift = 32 - bits
+            if flags & FRAME_SIGNED:
+                samples = (raw << shift) >> shift
+            elif bits < 32:
+                samples = raw & ((1 << bits) - 1)
+            else:
+                samples = raw.copy()
+
+            if self.next_seq is not None and seq != self.next_seq:
+                self.dropped += (seq - self.next_seq) & 0xFFFFFFFF
+            self.next_seq = (seq + 1) & 0xFFFFFFFF
+
+            frames.append(Frame(channel, bits, seq, samples))
+            off = end
+
+        self.pending = buf[off:]
+        return frames
+
+def read_frames(stream, chunk=65536):
+    """
+    Decode frames from a binary stream until end of file.
+
+    :param stream: Binary file-like object, e.g. the ``stdout`` of the
+      process returned by :func:`connect_stream`.
+    :param chunk: Maximum amount of bytes to read at once.
+    :return: Generator of ``Frame``s.
+    """
+    dec = FrameDecoder()
+    # Prefer read1() so that frames are decoded as they arrive instead
+    # of when a full chunk is buffered.
+    read = getattr(stream, 'read1', stream.read)
+    while True:
+        data = read(chunk)
+        if not data:
+            break
+        yield from dec.feed(data)
 
 # Functions for converting to and from fixed point in Python.
 
@@ -76,7 +457,8 @@ def string_to_fixed_point(s, fracnum):
 		frac_decimal = frac_decimal - div
 
 	whole = int(l[0])
-	if whole < 0:
+	# Check the string and not the integer, since "-0.5" has whole == 0.
+	if l[0].strip().startswith('-'):
 		return -((-whole) << fracnum | frac)
 	else:
 		return whole << fracnum | frac
@@ -105,3 +487,50 @@ def fixed_point_to_string(fxp, fracnum):
 		frac = frac + str(fracbit >> fracnum)
 		fracbit = fracbit & mask
 	return whole + "." + frac
+
+# Exact fixed point conversion.
+#
+# The functions above convert one bit or digit at a time. These do the
+# same conversions with integer arithmetic on exact rationals, and cache
+# their results since parameter sweeps convert the same values many
+# times.
+
+@lru_cache(maxsize=4096)
+def to_fixed_point(x, fracnum):
+    """
+    Convert a number to twos-complement fixed point.
+
+    Fractional bits that do not fit are truncated towards zero, like
+    :func:`string_to_fixed_point`. The conversion is exact for all
+    inputs.
+
+    :param x: Decimal string (e.g. ``"0.0006"`` or ``"6e-4"``), ``int``,
+      ``float``, ``Fraction`` or ``Decimal``.
+    :param fracnum: Number of fractional bits.
+    :return: Fixed point integer.
+    """
+    x = Fraction(x)
+    v = (abs(x.numerator) << fracnum) // x.denominator
+    return -v if x.numerator < 0 else v
+
+def fixed_point_to_fraction(fxp, fracnum):
+    """
+    :param fxp: Fixed point integer.
+    :param fracnum: Number of fractional bits.
+    :return: Exact value of ``fxp`` as a ``Fraction``.
+    """
+    return Fraction(fxp, 1 << fracnum)
+
+@lru_cache(maxsize=4096)
+def format_fixed_point(fxp, fracnum):
+    """
+    Same output as :func:`fixed_point_to_string`, without a loop.
+
+    The fractional part ``f/2**fracnum`` has exactly ``fracnum`` decimal
+    digits, which are the digits of ``f*5**fracnum``.
+    """
+    whole = fxp >> fracnum
+    frac = fxp & ((1 << fracnum) - 1)
+    if frac == 0:
+        return str(whole)
+    return f"{whole}.{frac * 5**fracnum:0{fracnum}d}"
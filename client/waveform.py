@@ -0,0 +1,210 @@
+"""
+Copyright 2023 (C) Peter McGoron
+
+This file is a part of Upsilon, a free and open source software project.
+For license terms, refer to the files in `doc/copying` in the Upsilon
+source distribution.
+"""
+
+# Compile waveforms into RAM images for the waveform module.
+#
+#     python3 waveform.py compile '{"shape": "sine", "amplitude": 1000}' sine.bin
+#     python3 waveform.py check sine.bin
+#
+# ``waveform.v`` (through ``bram_interface.v``) reads ``WORD_AMNT + 1``
+# words of ``WORD_WID`` bits from RAM, each as two ``RAM_WORD_WID`` bit
+# reads: the low bits first, then the high bits. An image is therefore
+# an array of little-endian 32 bit words, one per DAC value, with each
+# value sign extended to 32 bits (the layout ``waveform_sim.cpp`` writes
+# into its simulated RAM). The module plays the words in order, sending
+# ``1 << 20 | word`` to the DAC, and starts again after the last one.
+#
+# ``check`` decodes an image the way the hardware does and, if
+# ``waveform_sim`` was built, plays it in the simulation as well.
+# ``upload_image`` loads an image on the controller with
+# ``linux/waveform.py``.
+
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+from util import sign_extend_array
+
+# Parameters of waveform.v.
+WORD_WID = 20
+RAM_WORD_WID = 16
+# The WORD_AMNT parameter is the last index, so an image has one more.
+WORD_AMNT = 2048
+IMAGE_BYTES = 4 * WORD_AMNT
+
+MIN_CODE = -(1 << (WORD_WID - 1))
+MAX_CODE = (1 << (WORD_WID - 1)) - 1
+
+SIM = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..',
+                   'gateware', 'rtl', 'waveform', 'obj_dir', 'Vwaveform_sim')
+
+def phase(n=WORD_AMNT):
+    """ :return: Phase in ``[0, 1)`` of each word of a period. """
+    return np.arange(n) / n
+
+def resample(values, n=WORD_AMNT):
+    """
+    Linearly resample one period of a waveform to ``n`` points. The
+    waveform is periodic, so the last point is followed by the first.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    if len(values) == n:
+        return values
+    x = np.arange(len(values) + 1) / len(values)
+    return np.interp(phase(n), x, np.append(values, values[0]))
+
+def compile_array(values, clip=False):
+    """
+    Make an image from DAC values.
+
+    :param values: ``WORD_AMNT`` DAC values (twos-complement codes, as
+      for ``dac_write_volt``). Other lengths are resampled to
+      ``WORD_AMNT`` points. Floats are rounded to the nearest code.
+    :param clip: Clip values to the range of the DAC instead of raising
+      an exception.
+    :return: Image as an array of ``<i4``. Use ``.tobytes()`` for the
+      raw image.
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f' or len(values) != WORD_AMNT:
+        values = np.rint(resample(values))
+    if clip:
+        values = np.clip(values, MIN_CODE, MAX_CODE)
+    elif len(values) and (values.min() < MIN_CODE or values.max() > MAX_CODE):
+        raise Exception(f"values outside of [{MIN_CODE}, {MAX_CODE}]")
+    return values.astype('<i4')
+
+def compile_function(f, periods=1, clip=False):
+    """
+    Make an image from a function.
+
+    :param f: Function from an array of phases (in periods, starting at
+      0) to DAC values.
+    :param periods: Number of periods of ``f`` in the image.
+    """
+    return compile_array(f(phase() * periods), clip)
+
+SHAPES = {
+    'sine': lambda x: np.sin(2 * np.pi * x),
+    'triangle': lambda x: 1 - 4 * np.abs((x + 0.25) % 1 - 0.5),
+    'square': lambda x: np.where(x % 1 < 0.5, 1.0, -1.0),
+    'ramp': lambda x: 2 * (x % 1) - 1,
+}
+
+def compile_description(desc):
+    """
+    Make an image from a description, e.g. read from JSON:
+
+    * ``{"shape": "sine", "amplitude": 1000, "offset": 0, "periods": 1,
+      "phase": 0}``. Shapes are ``sine``, ``triangle``, ``square`` and
+      ``ramp`` (all from -1 to 1 over one period, before scaling).
+    * ``{"points": [...]}``: one period, resampled to ``WORD_AMNT``
+      points.
+
+    Both take ``"clip": true`` to clip values to the DAC range.
+    """
+    clip = desc.get('clip', False)
+    if 'points' in desc:
+        return compile_array(np.asarray(desc['points'], dtype=np.float64),
+                             clip)
+    shape = SHAPES.get(desc.get('shape'))
+    if shape is None:
+        raise Exception(f"unknown shape {desc.get('shape')}")
+    amp = desc.get('amplitude', 1)
+    off = desc.get('offset', 0)
+    ph = desc.get('phase', 0)
+    return compile_function(lambda x: off + amp * shape(x + ph),
+                            desc.get('periods', 1), clip)
+
+def decode_image(image):
+    """
+    Decode an image the way ``bram_interface.v`` does: the low
+    ``RAM_WORD_WID`` bits of each word and the low bits of its high
+    half make a ``WORD_WID`` bit value.
+
+    :param image: Raw image or array of 32 bit words.
+    :return: Array of the DAC values.
+    """
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        image = np.frombuffer(image, dtype='<u4')
+    w = np.asarray(image).astype(np.uint32)
+    if len(w) != WORD_AMNT:
+        raise Exception(f"image has {len(w)} words, not {WORD_AMNT}")
+    low = w & ((1 << RAM_WORD_WID) - 1)
+    high = (w >> 16) & ((1 << (WORD_WID - RAM_WORD_WID)) - 1)
+    return sign_extend_array(low | high << RAM_WORD_WID, WORD_WID)
+
+def dac_words(image):
+    """ :return: The words ``waveform.v`` sends to the DAC. """
+    return (1 << 20) | (decode_image(image) & 0xFFFFF)
+
+def simulate(path):
+    """
+    Play an image file in ``waveform_sim``, which checks every word the
+    DAC receives against the image.
+
+    :return: ``True`` if the simulation passed, ``None`` if it was not
+      built (``make -C ../gateware/rtl/waveform``).
+    """
+    if not os.path.exists(SIM):
+        return None
+    env = dict(os.environ, WAVEFORM_IMAGE=os.path.abspath(path))
+    r = subprocess.run([SIM], env=env, cwd=os.path.dirname(SIM))
+    return r.returncode == 0
+
+def upload_image(session, image, addr, remote='/tmp/waveform.bin'):
+    """
+    Copy an image to the controller and load it into RAM with
+    ``linux/waveform.py``.
+
+    :param session: ``util.Session`` to the controller.
+    :param image: Image from one of the ``compile_`` functions.
+    :param addr: Physical address of the waveform buffer (the
+      ``start_addr`` of the waveform module).
+    """
+    import tempfile
+    with tempfile.NamedTemporaryFile(suffix='.bin') as f:
+        f.write(np.asarray(image, dtype='<i4').tobytes())
+        f.flush()
+        session.client.scp_send(f.name, remote)
+    return session.execute('waveform.py', 'load', remote, addr)
+
+def check(path):
+    with open(path, 'rb') as f:
+        image = f.read()
+    if len(image) != IMAGE_BYTES:
+        print(f'{path}: {len(image)} bytes, not {IMAGE_BYTES}')
+        return False
+    words = np.frombuffer(image, dtype='<i4')
+    vals = decode_image(image)
+    if not np.array_equal(vals, words):
+        bad = np.flatnonzero(vals != words)
+        print(f'{path}: {len(bad)} words are not sign extended '
+              f'{WORD_WID} bit values, first at {bad[0]}')
+        return False
+    print(f'{path}: min {vals.min()} max {vals.max()}')
+    ok = simulate(path)
+    if ok is None:
+        print('waveform_sim not built, not simulated')
+    elif not ok:
+        print('waveform_sim failed')
+        return False
+    return True
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == 'compile':
+        img = compile_description(json.loads(sys.argv[2]))
+        with open(sys.argv[3], 'wb') as f:
+            f.write(img.tobytes())
+    elif len(sys.argv) == 3 and sys.argv[1] == 'check':
+        sys.exit(0 if check(sys.argv[2]) else 1)
+    else:
+        print('usage: waveform.py compile DESCRIPTION IMAGE\n'
+              '       waveform.py check IMAGE', file=sys.stderr)
+        sys.exit(1)
@@ -7,7 +7,9 @@
 #######################################################################
 #
 # This file generates a Micropython module "mmio" with functions that
-# do raw reads and writes to MMIO registers.
+# do raw reads and writes to MMIO registers. The module can also be
+# generated as a MicroPython C module ("--mode micropython-c"), and the
+# register addresses as a C header ("--mode c-header").
 #
 # TODO: Devicetree?
 
@@ -22,16 +24,22 @@ class CSRHandler:
     Class that wraps the CSR file and fills in registers with information
     from those files.
     """
-    def __init__(self, csrjson, registers):
+    def __init__(self, csrjson, registers, snapshots=None):
         """
         Reads in the CSR files.
 
-        :param csrjson: Filename of a LiteX "csr.json" file.
+        :param csrjson: Filename of a LiteX "csr.json" file, or its
+          already loaded contents.
         :param registers: A list of ``mmio_descr`` ``Descr``s.
-        :param outf: Output file.
+        :param snapshots: Dictionary of groups of registers that are read
+          together. See ``mmio_descr.snapshots``.
         """
         self.registers = registers
-        self.csrs = json.load(open(csrjson))
+        self.snapshots = snapshots if snapshots is not None else {}
+        if isinstance(csrjson, dict):
+            self.csrs = csrjson
+        else:
+            self.csrs = json.load(open(csrjson))
 
     def update_reg(self, reg):
         """
@@ -69,6 +77,16 @@ class CSRHandler:
             regname = f"base_{reg.name}_{num}"
         return self.csrs["csr_registers"][regname]["addr"]
 
+    def get_reg(self, name):
+        """
+        :param name: Name of the register without numerical suffix.
+        :return: The ``Descr`` of the register.
+        """
+        for r in self.registers:
+            if r.name == name:
+                return r
+        raise Exception(f"unknown register {name}")
+
 class InterfaceGenerator:
     """
     Interface for file generation. Implement the unimplemented functions
@@ -96,13 +114,32 @@ class InterfaceGenerator:
     def header(self):
         """ Print header of file. """
         pass
+    def constants(self, reg):
+        """ Print data used by the functions of a register. """
+        return ""
+    def bulk(self, reg, optype):
+        """ Print function for reads/writes to all instances of a register. """
+        return ""
+    def snapshot(self, name, regs):
+        """ Print function that reads a group of registers. """
+        return ""
 
     def print_file(self):
         self.print(self.header())
         for r in self.csr.registers:
+            self.print(self.constants(r))
             self.print(self.fun(r, "read"))
-            if not r.rwperm != "read-only":
+            if r.rwperm != "read-only":
                 self.print(self.fun(r, "write"))
+        for r in self.csr.registers:
+            if r.num == 1:
+                continue
+            self.print(self.bulk(r, "read"))
+            if r.rwperm != "read-only":
+                self.print(self.bulk(r, "write"))
+        for name, regnames in self.csr.snapshots.items():
+            self.print(self.snapshot(name,
+                       [self.csr.get_reg(n) for n in regnames]))
 
 class MicropythonGenerator(InterfaceGenerator):
     def __init__(self, *args, **kwargs):
@@ -120,17 +157,21 @@ class MicropythonGenerator(InterfaceGenerator):
             return f'{indent}{acc[0]} = {varname}\n'
         else:
             assert len(acc) == 2
-            # Little Endian. See linux kernel, include/linux/litex.h
-            return f'{indent}{acc[1]} = {varname} & 0xFFFFFFFF\n' + \
-                   f'{indent}{acc[0]} = {varname} >> 32\n'
+            # The SoC uses big CSR ordering: the high word is at the lower
+            # address. See linux kernel, include/linux/litex.h
+            return f'{indent}{acc[0]} = {varname} & 0xFFFFFFFF\n' + \
+                   f'{indent}{acc[1]} = {varname} >> 32\n'
 
-    def print_read_register(self, indent, varname, reg, num):
+    def read_expression(self, reg, num):
         acc = self.get_accessor(reg, num)
         if len(acc) == 1:
-            return f'{indent}return {acc[0]}\n'
+            return acc[0]
         else:
             assert len(acc) == 2
-            return f'{indent}return {acc[0]} | ({acc[1]} << 32)\n'
+            return f'{acc[0]} | ({acc[1]} << 32)'
+
+    def print_read_register(self, indent, varname, reg, num):
+        return f'{indent}return {self.read_expression(reg, num)}\n'
 
     def fun(self, reg, optype):
         rs = ""
@@ -164,16 +205,678 @@ class MicropythonGenerator(InterfaceGenerator):
                 a(f'num == {i}:\n')
                 a(pfun('\t\t', 'val', reg, i))
             a(f'\telse:\n')
-            a(f'\t\traise Exception(regnum)\n')
+            a(f'\t\traise Exception(num)\n')
         a('\n')
 
         return rs
 
+    def bulk(self, reg, optype):
+        # Unrolled, so that each instance costs one memory access and no
+        # function call.
+        if optype == 'read':
+            rs = f'def read_{reg.name}_all(buf):\n'
+            for i in range(0, reg.num):
+                rs += f'\tbuf[{i}] = {self.read_expression(reg, i)}\n'
+            rs += '\treturn buf\n'
+        else:
+            rs = f'def write_{reg.name}_all(vals):\n'
+            for i in range(0, reg.num):
+                rs += self.print_write_register('\t', f'vals[{i}]', reg, i)
+        return rs + '\n'
+
+    def snapshot(self, name, regs):
+        # One straight-line tuple of loads: cheaper than a call per
+        # register, and than storing into a buffer.
+        rs = f'def read_{name}():\n\treturn (\n'
+        for r in regs:
+            rs += f'\t\t{self.read_expression(r, None)},\n'
+        return rs + '\t)\n\n'
+
     def header(self):
         return "import machine\n"
 
+class MicropythonTableGenerator(MicropythonGenerator):
+    """
+    Generate accessors that look up the address of a register instance
+    in a tuple, instead of comparing ``num`` against each instance
+    number. Each access is then one index and one ``machine.memNN``
+    operation.
+
+    Out of range instance numbers raise ``IndexError``.
+    """
+
+    def table_name(self, reg):
+        return f"_{reg.name}"
+
+    # Passed as ``num`` to get an accessor that indexes the address table
+    # with the ``num`` argument of the generated function.
+    INDEXED = object()
+
+    def get_accessor(self, reg, num):
+        if num is self.INDEXED:
+            addr = f"{self.table_name(reg)}[num]"
+        else:
+            addr = self.csr.get_reg_addr(reg, num)
+        if reg.regsize in [8, 16, 32]:
+            return [f"mem{reg.regsize}[{addr}]"]
+        if num is self.INDEXED:
+            return [f"mem32[a + 4]", f"mem32[a]"]
+        return [f"mem32[{addr + 4}]", f"mem32[{addr}]"]
+
+    def constants(self, reg):
+        if reg.num == 1:
+            return ""
+        addrs = [str(self.csr.get_reg_addr(reg, i)) for i in range(reg.num)]
+        return f'{self.table_name(reg)} = ({", ".join(addrs)})\n'
+
+    def fun(self, reg, optype):
+        args = []
+        if optype == 'write':
+            args.append('val')
+            pfun = self.print_write_register
+        else:
+            pfun = self.print_read_register
+        if reg.num != 1:
+            args.append('num')
+
+        rs = f'def {optype}_{reg.name}({", ".join(args)}):\n'
+        num = None
+        if reg.num != 1:
+            num = self.INDEXED
+            if reg.regsize == 64:
+                rs += f'\ta = {self.table_name(reg)}[num]\n'
+        rs += pfun('\t', 'val', reg, num)
+        return rs + '\n'
+
+    def header(self):
+        return "from machine import mem8, mem16, mem32\n"
+
+class MicropythonCompactGenerator(InterfaceGenerator):
+    """
+    Generate a small module that builds its accessors when it is
+    imported. The addresses of all registers are in one constant table,
+    and each accessor is a closure made by one of a few shared
+    functions, so the module has a handful of code objects instead of
+    one per accessor. This makes the module (and its ``.mpy``) smaller
+    and faster to load, at the cost of a closure call per access.
+    Snapshot functions are written out in full, as in the other modes.
+
+    The functions have the same names and arguments as the other modes.
+    Out of range instance numbers raise ``IndexError``.
+    """
+
+    # Shared functions that make the accessors. ``m`` is a ``machine.memNN``
+    # object, ``a`` an address and ``t`` a tuple of addresses. 64 bit
+    # registers take the addresses of the high and low words, which are
+    # computed once here so that an access never does arithmetic on an
+    # address (addresses do not fit in a small int on the controller).
+    FACTORIES = """\
+def _r(m, a):
+	return lambda: m[a]
+
+def _rn(m, t):
+	return lambda num: m[t[num]]
+
+def _w(m, a):
+	def f(val):
+		m[a] = val
+	return f
+
+def _wn(m, t):
+	def f(val, num):
+		m[t[num]] = val
+	return f
+
+def _r64(h, l):
+	return lambda: mem32[l] | (mem32[h] << 32)
+
+def _rn64(h, l):
+	return lambda num: mem32[l[num]] | (mem32[h[num]] << 32)
+
+def _w64(h, l):
+	def f(val):
+		mem32[l] = val & 0xFFFFFFFF
+		mem32[h] = val >> 32
+	return f
+
+def _wn64(h, l):
+	def f(val, num):
+		mem32[l[num]] = val & 0xFFFFFFFF
+		mem32[h[num]] = val >> 32
+	return f
+
+def _ra(m, t):
+	def f(buf):
+		i = 0
+		for a in t:
+			buf[i] = m[a]
+			i += 1
+		return buf
+	return f
+
+def _wa(m, t):
+	def f(vals):
+		i = 0
+		for a in t:
+			m[a] = vals[i]
+			i += 1
+	return f
+
+def _wa64(w, n):
+	def f(vals):
+		for i in range(n):
+			w(vals[i], i)
+	return f
+
+def _snap(fs):
+	def f(buf):
+		i = 0
+		for g in fs:
+			buf[i] = g()
+			i += 1
+		return buf
+	return f
+
+def _make():
+	g = globals()
+	mem = {8: mem8, 16: mem16, 32: mem32}
+	for n, size, rw, t in _REGS:
+		one = type(t) is int
+		if size == 64:
+			l = t + 4 if one else tuple(a + 4 for a in t)
+			r = _r64(t, l) if one else _rn64(t, l)
+			w = (_w64(t, l) if one else _wn64(t, l)) if rw else None
+		else:
+			m = mem[size]
+			r = _r(m, t) if one else _rn(m, t)
+			w = (_w(m, t) if one else _wn(m, t)) if rw else None
+		g['read_' + n] = r
+		if w:
+			g['write_' + n] = w
+		if one:
+			continue
+		if size == 64:
+			g['read_' + n + '_all'] = _snap(tuple(lambda i=i: r(i)
+			                                      for i in range(len(t))))
+			if w:
+				g['write_' + n + '_all'] = _wa64(w, len(t))
+		else:
+			g['read_' + n + '_all'] = _ra(m, t)
+			if w:
+				g['write_' + n + '_all'] = _wa(m, t)
+
+"""
+
+    def header(self):
+        return "from machine import mem8, mem16, mem32\n\n" + self.FACTORIES
+
+    def snapshot(self, name, regs):
+        # Written out like in the other modes. A closure that calls the
+        # accessor of each register costs more than the separate calls.
+        rs = f'\ndef read_{name}():\n\treturn (\n'
+        for r in regs:
+            a = self.csr.get_reg_addr(r, None)
+            if r.regsize == 64:
+                rs += f'\t\tmem32[{a + 4}] | (mem32[{a}] << 32),\n'
+            else:
+                rs += f'\t\tmem{r.regsize}[{a}],\n'
+        return rs + '\t)\n'
+
+    def constants(self, reg):
+        if reg.num == 1:
+            addrs = str(self.csr.get_reg_addr(reg, None))
+        else:
+            addrs = "(" + ", ".join(str(self.csr.get_reg_addr(reg, i))
+                                    for i in range(reg.num)) + ")"
+        rw = int(reg.rwperm != "read-only")
+        return f"\t('{reg.name}', {reg.regsize}, {rw}, {addrs}),\n"
+
+    def print_file(self):
+        # Name, size, writable, address (or tuple of addresses of each
+        # instance).
+        self.print(self.header())
+        self.print("_REGS = (\n")
+        for r in self.csr.registers:
+            self.print(self.constants(r))
+        self.print(")\n\n")
+        # The tables and factories are only needed while importing.
+        self.print("_make()\n"
+                   "del _REGS, _make, _r, _rn, _w, _wn, _r64, "
+                   "_rn64, _w64, _wn64, _ra, _wa, _wa64, _snap\n")
+        for name, regnames in self.csr.snapshots.items():
+            self.print(self.snapshot(name,
+                       [self.csr.get_reg(n) for n in regnames]))
+
+class CHeaderGenerator(InterfaceGenerator):
+    """
+    Generate a C header with the address, instance count and width of
+    each register. For a register ``name`` with ``num`` instances:
+
+    * ``CSR_NAME_NUM``: the number of instances.
+    * ``CSR_NAME_BITS``: the width of the register.
+    * ``CSR_NAME_SIZE``: the width of the access (8, 16, 32 or 64).
+    * ``CSR_NAME_ADDR`` (single instance), or ``CSR_NAME_0_ADDR``, ...
+    """
+
+    GUARD = "UPSILON_CSR_H"
+
+    def macro(self, reg, suffix, num=None):
+        name = reg.name.upper()
+        if num is not None:
+            name = f"{name}_{num}"
+        return f"CSR_{name}_{suffix}"
+
+    def addresses(self, reg):
+        """ :return: List of the addresses of each instance of ``reg``. """
+        if reg.num == 1:
+            return [self.csr.get_reg_addr(reg, None)]
+        return [self.csr.get_reg_addr(reg, i) for i in range(reg.num)]
+
+    def bounds(self):
+        """ :return: Tuple of the lowest and one past the highest address. """
+        lo = min(min(self.addresses(r)) for r in self.csr.registers)
+        hi = max(max(self.addresses(r)) + r.regsize // 8
+                 for r in self.csr.registers)
+        return lo, hi
+
+    def base_defines(self):
+        lo, hi = self.bounds()
+        return (f"#define CSR_BASE 0x{lo:08X}UL\n"
+                f"#define CSR_END 0x{hi:08X}UL\n\n")
+
+    def header(self):
+        return ("/* Generated by csr2mp.py. Do not edit. */\n"
+                f"#ifndef {self.GUARD}\n"
+                f"#define {self.GUARD}\n\n" + self.base_defines())
+
+    def constants(self, reg):
+        rs = f"#define {self.macro(reg, 'NUM')} {reg.num}\n" \
+             f"#define {self.macro(reg, 'BITS')} {reg.blen}\n" \
+             f"#define {self.macro(reg, 'SIZE')} {reg.regsize}\n"
+        if reg.num == 1:
+            rs += f"#define {self.macro(reg, 'ADDR')} " \
+                  f"0x{self.addresses(reg)[0]:08X}UL\n"
+        else:
+            for i, a in enumerate(self.addresses(reg)):
+                rs += f"#define {self.macro(reg, 'ADDR', i)} 0x{a:08X}UL\n"
+        return rs + "\n"
+
+    def fun(self, reg, optype):
+        return ""
+
+    def print_file(self):
+        super().print_file()
+        self.print(f"#endif /* {self.GUARD} */\n")
+
+class MicropythonCGenerator(CHeaderGenerator):
+    """
+    Generate a MicroPython user C module "mmio" with the same functions
+    as the Python modules, so that each access is one native call. See
+    ``usermod/mmio`` for how to build it into MicroPython.
+
+    Under Linux the registers are mapped from ``/dev/mem`` on the first
+    access; elsewhere the addresses are used directly. Out of range
+    instance numbers raise ``IndexError``.
+    """
+
+    # Shared helpers. ``mmio_get_u64`` converts a Python int to its low 64
+    # bits like ``int.to_bytes`` does, so negative values are written in
+    # twos complement like in the Python modules.
+    HELPERS = """\
+#include <stdint.h>
+#include "py/runtime.h"
+#include "py/objint.h"
+
+#if defined(__linux__) && !defined(MMIO_NO_DEV_MEM)
+#include <errno.h>
+#include <fcntl.h>
+#include <sys/mman.h>
+#include <unistd.h>
+
+/* Virtual address of the register at physical address 0. */
+static uintptr_t mmio_off;
+
+static void mmio_map(void) {
+	long page = sysconf(_SC_PAGESIZE);
+	uintptr_t base = CSR_BASE & ~(uintptr_t)(page - 1);
+	int fd = open("/dev/mem", O_RDWR | O_SYNC);
+	if (fd < 0) {
+		mp_raise_OSError(errno);
+	}
+	void *p = mmap(NULL, CSR_END - base, PROT_READ | PROT_WRITE, MAP_SHARED,
+	               fd, base);
+	close(fd);
+	if (p == MAP_FAILED) {
+		mp_raise_OSError(errno);
+	}
+	mmio_off = (uintptr_t)p - base;
+}
+
+static inline volatile void *mmio_ptr(uintptr_t addr) {
+	if (MP_UNLIKELY(mmio_off == 0)) {
+		mmio_map();
+	}
+	return (volatile void *)(addr + mmio_off);
+}
+#else
+static inline volatile void *mmio_ptr(uintptr_t addr) {
+	return (volatile void *)addr;
+}
+#endif
+
+#define MMIO8(a) (*(volatile uint8_t *)mmio_ptr(a))
+#define MMIO16(a) (*(volatile uint16_t *)mmio_ptr(a))
+#define MMIO32(a) (*(volatile uint32_t *)mmio_ptr(a))
+
+static size_t mmio_num(mp_obj_t num_in, size_t num) {
+	mp_int_t i = mp_obj_get_int(num_in);
+	if (i < 0 || (size_t)i >= num) {
+		mp_raise_msg(&mp_type_IndexError,
+		             MP_ERROR_TEXT("register instance out of range"));
+	}
+	return i;
+}
+
+static uint64_t mmio_get_u64(mp_obj_t val) {
+	if (mp_obj_is_small_int(val)) {
+		return (uint64_t)(int64_t)MP_OBJ_SMALL_INT_VALUE(val);
+	}
+	uint8_t buf[8];
+	mp_obj_int_to_bytes_impl(val, false, sizeof(buf), buf);
+	uint64_t v = 0;
+	for (int i = 7; i >= 0; i--) {
+		v = v << 8 | buf[i];
+	}
+	return v;
+}
+
+/* The SoC uses big CSR ordering: the high word is at the lower address.
+ * See linux kernel, include/linux/litex.h */
+static mp_obj_t mmio_read64(uintptr_t a) {
+	uint64_t v = MMIO32(a + 4) | ((uint64_t)MMIO32(a) << 32);
+	return mp_obj_new_int_from_ull(v);
+}
+
+static void mmio_write64(uintptr_t a, mp_obj_t val) {
+	uint64_t v = mmio_get_u64(val);
+	MMIO32(a + 4) = v & 0xFFFFFFFF;
+	MMIO32(a) = v >> 32;
+}
+
+static inline void mmio_set(mp_obj_t buf, size_t i, mp_obj_t v) {
+	mp_obj_subscr(buf, MP_OBJ_NEW_SMALL_INT(i), v);
+}
+
+static inline mp_obj_t mmio_get(mp_obj_t vals, size_t i) {
+	return mp_obj_subscr(vals, MP_OBJ_NEW_SMALL_INT(i), MP_OBJ_SENTINEL);
+}
+
+"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # (Python name, number of arguments) of each function.
+        self.funs = []
+
+    def header(self):
+        return "/* Generated by csr2mp.py. Do not edit. */\n" \
+               + self.base_defines() + self.HELPERS
+
+    def table_name(self, reg):
+        return f"mmio_{reg.name}_addr"
+
+    def constants(self, reg):
+        rs = super().constants(reg)
+        if reg.num != 1:
+            addrs = ", ".join(self.macro(reg, 'ADDR', i)
+                              for i in range(reg.num))
+            rs += f"static const uintptr_t {self.table_name(reg)}" \
+                  f"[{reg.num}] = {{{addrs}}};\n\n"
+        return rs
+
+    def addr_expression(self, reg, num):
+        """ :param num: Instance number, or a C expression selecting it. """
+        if reg.num == 1:
+            return self.macro(reg, 'ADDR')
+        return f"{self.table_name(reg)}[{num}]"
+
+    def read_expression(self, reg, a):
+        """ :return: C expression of the Python object read from ``a``. """
+        if reg.regsize == 64:
+            return f"mmio_read64({a})"
+        if reg.regsize == 32:
+            return f"mp_obj_new_int_from_uint(MMIO32({a}))"
+        return f"MP_OBJ_NEW_SMALL_INT(MMIO{reg.regsize}({a}))"
+
+    def write_statement(self, reg, a, val):
+        if reg.regsize == 64:
+            return f"mmio_write64({a}, {val});"
+        return f"MMIO{reg.regsize}({a}) = mp_obj_get_int_truncated({val});"
+
+    def define(self, name, args, body):
+        """ Make the C function and the function object of ``name``. """
+        self.funs.append(name)
+        params = ", ".join(f"mp_obj_t {a}" for a in args) or "void"
+        rs = f"static mp_obj_t mmio_{name}({params}) {{\n{body}}}\n"
+        rs += f"static MP_DEFINE_CONST_FUN_OBJ_{len(args)}(" \
+              f"mmio_{name}_obj, mmio_{name});\n\n"
+        return rs
+
+    def fun(self, reg, optype):
+        body = ""
+        args = ["val"] if optype == "write" else []
+        if reg.num != 1:
+            args.append("num_in")
+            body += f"\tsize_t num = mmio_num(num_in, {reg.num});\n"
+        a = self.addr_expression(reg, "num")
+        if optype == "read":
+            body += f"\treturn {self.read_expression(reg, a)};\n"
+        else:
+            body += f"\t{self.write_statement(reg, a, 'val')}\n" \
+                    "\treturn mp_const_none;\n"
+        return self.define(f"{optype}_{reg.name}", args, body)
+
+    def bulk(self, reg, optype):
+        a = self.addr_expression(reg, "i")
+        if optype == "read":
+            body = f"\tfor (size_t i = 0; i < {reg.num}; i++) {{\n" \
+                   f"\t\tmmio_set(buf, i, {self.read_expression(reg, a)});\n" \
+                   "\t}\n\treturn buf;\n"
+            return self.define(f"read_{reg.name}_all", ["buf"], body)
+        body = f"\tfor (size_t i = 0; i < {reg.num}; i++) {{\n" \
+               f"\t\t{self.write_statement(reg, a, 'mmio_get(vals, i)')}\n" \
+               "\t}\n\treturn mp_const_none;\n"
+        return self.define(f"write_{reg.name}_all", ["vals"], body)
+
+    def snapshot(self, name, regs):
+        body = "\tmp_obj_t items[] = {\n"
+        for r in regs:
+            a = self.addr_expression(r, None)
+            body += f"\t\t{self.read_expression(r, a)},\n"
+        body += f"\t}};\n\treturn mp_obj_new_tuple({len(regs)}, items);\n"
+        return self.define(f"read_{name}", [], body)
+
+    def print_file(self):
+        InterfaceGenerator.print_file(self)
+        self.print("static const mp_rom_map_elem_t "
+                   "mmio_module_globals_table[] = {\n"
+                   "\t{ MP_ROM_QSTR(MP_QSTR___name__), "
+                   "MP_ROM_QSTR(MP_QSTR_mmio) },\n")
+        for name in self.funs:
+            self.print(f"\t{{ MP_ROM_QSTR(MP_QSTR_{name}), "
+                       f"MP_ROM_PTR(&mmio_{name}_obj) }},\n")
+        self.print("};\n"
+                   "static MP_DEFINE_CONST_DICT(mmio_module_globals, "
+                   "mmio_module_globals_table);\n\n"
+                   "const mp_obj_module_t mmio_user_cmodule = {\n"
+                   "\t.base = { &mp_type_module },\n"
+                   "\t.globals = (mp_obj_dict_t *)&mmio_module_globals,\n"
+                   "};\n\n"
+                   "MP_REGISTER_MODULE(MP_QSTR_mmio, mmio_user_cmodule);\n")
+
+class ProfileGenerator:
+    """
+    Add an access profiler to a module generated by a MicroPython
+    generator. Every ``read_``/``write_`` function of the module is
+    wrapped so that it counts its calls (per instance for registers with
+    several instances) and the ticks each call takes, in a histogram of
+    powers of two. Modules made without it are not changed at all.
+
+    The module gets two more functions:
+
+    * ``profile_dump(path=None, as_json=False)`` prints the table of
+      accesses sorted by total ticks, or writes it as JSON to ``path``.
+    * ``profile_reset()`` clears the counts.
+
+    Ticks are ``time.ticks_cpu()`` where available, otherwise
+    ``time.ticks_us()``. The ticks of a call include the cost of the
+    wrapper and of reading the tick counter.
+    """
+
+    PROFILER = """
+# Access profiler (csr2mp.py --profile).
+import time as _time
+try:
+	_ticks = _time.ticks_cpu
+	_unit = 'cpu'
+except AttributeError:
+	_ticks = _time.ticks_us
+	_unit = 'us'
+_diff = _time.ticks_diff
+_HIST = 24
+# (name, instance or None) -> [calls, ticks, max ticks, histogram]
+_prof = {}
+
+def _wrap(name, f, indexed):
+	def g(*args):
+		t = _ticks()
+		r = f(*args)
+		dt = _diff(_ticks(), t)
+		k = (name, args[-1] if indexed else None)
+		s = _prof.get(k)
+		if s is None:
+			s = _prof[k] = [0, 0, 0, [0] * _HIST]
+		s[0] += 1
+		s[1] += dt
+		if dt > s[2]:
+			s[2] = dt
+		b = 0
+		while dt > 1 and b < _HIST - 1:
+			dt >>= 1
+			b += 1
+		s[3][b] += 1
+		return r
+	return g
+
+def profile_reset():
+	_prof.clear()
+
+def profile_dump(path=None, as_json=False):
+	rows = sorted(_prof.items(), key=lambda kv: -kv[1][1])
+	if as_json:
+		import json
+		d = {'unit': _unit, 'accesses': [
+			{'name': k[0], 'num': k[1], 'calls': s[0], 'ticks': s[1],
+			 'max': s[2], 'hist': s[3]} for k, s in rows]}
+		if path is None:
+			print(json.dumps(d))
+		else:
+			with open(path, 'w') as f:
+				json.dump(d, f)
+		return
+	f = None if path is None else open(path, 'w')
+	def p(*args):
+		if f is None:
+			print(*args)
+		else:
+			f.write(' '.join(str(a) for a in args) + '\\n')
+	p('%-26s %4s %10s %12s %9s %9s  histogram (ticks <= 2**n: calls)' %
+	  ('function', 'num', 'calls', 'ticks/' + _unit, 'mean', 'max'))
+	for k, s in rows:
+		hist = ' '.join('%d:%d' % (b, c) for b, c in enumerate(s[3]) if c)
+		p('%-26s %4s %10d %12d %9.1f %9d  %s' %
+		  (k[0], '-' if k[1] is None else k[1], s[0], s[1], s[1] / s[0],
+		   s[2], hist))
+	if f is not None:
+		f.close()
+
+"""
+
+    def __init__(self, gen):
+        """
+        :param gen: The ``InterfaceGenerator`` of the module to profile.
+        """
+        if not isinstance(gen, (MicropythonGenerator,
+                                MicropythonCompactGenerator)):
+            raise Exception("only MicroPython modules can be profiled")
+        self.gen = gen
+
+    def print_file(self):
+        self.gen.print_file()
+        csr = self.gen.csr
+        indexed = []
+        for r in csr.registers:
+            if r.num == 1:
+                continue
+            indexed.append(f"'read_{r.name}'")
+            if r.rwperm != "read-only":
+                indexed.append(f"'write_{r.name}'")
+        self.gen.print(self.PROFILER)
+        self.gen.print(f"_INDEXED = ({''.join(i + ', ' for i in indexed)})\n"
+                       "for _n in [n for n in globals() if n[:5] == 'read_' "
+                       "or n[:6] == 'write_']:\n"
+                       "\tglobals()[_n] = _wrap(_n, globals()[_n], "
+                       "_n in _INDEXED)\n"
+                       "del _n\n")
+
+def make_csrs(registers, base=0xF0000000):
+    """
+    Make the register part of a LiteX "csr.json" file, with registers
+    laid out one after another like the SoC does. This is used to
+    generate and test modules without building the SoC.
+
+    :param registers: A list of ``mmio_descr`` ``Descr``s.
+    :param base: Address of the first register.
+    :return: Dictionary in the format of "csr.json".
+    """
+    csrs = {}
+    addr = base
+    for reg in registers:
+        names = [reg.name] if reg.num == 1 else \
+                [f"{reg.name}_{i}" for i in range(reg.num)]
+        size = (reg.blen + 31) // 32
+        for name in names:
+            csrs[f"base_{name}"] = {
+                "addr": addr,
+                "size": size,
+                "type": "ro" if reg.rwperm == "read-only" else "rw",
+            }
+            addr += 4*size
+    return {"csr_registers": csrs}
+
+generators = {
+    "micropython": MicropythonGenerator,
+    "micropython-table": MicropythonTableGenerator,
+    "micropython-compact": MicropythonCompactGenerator,
+    "micropython-c": MicropythonCGenerator,
+    "c-header": CHeaderGenerator,
+}
+
 if __name__ == "__main__":
-   csrh = CSRHandler(sys.argv[1], mmio_descr.registers)
+   parser = argparse.ArgumentParser(
+           description="Generate MMIO register accessors from csr.json")
+   parser.add_argument("csrjson", help="LiteX csr.json file")
+   parser.add_argument("--mode", choices=generators.keys(),
+                       default="micropython",
+                       help="kind of module to generate")
+   parser.add_argument("--profile", action="store_true",
+                       help="count and time each access (MicroPython modes)")
+   args = parser.parse_args()
+
+   csrh = CSRHandler(args.csrjson, mmio_descr.registers, mmio_descr.snapshots)
    for r in mmio_descr.registers:
        csrh.update_reg(r)
-   MicropythonGenerator(csrh, sys.stdout).print_file()
+   gen = generators[args.mode](csrh, sys.stdout)
+   if args.profile:
+       gen = ProfileGenerator(gen)
+   gen.print_file()
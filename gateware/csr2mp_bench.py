@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+# Copyright 2023 (C) Peter McGoron
+#
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#######################################################################
+#
+# Compare the size and call cost of the "mmio" modules generated by each
+# csr2mp.py mode.
+#
+#     python3 csr2mp_bench.py [csr.json] [-n CALLS]
+#             [--micropython micropython] [--mpy-cross mpy-cross]
+#
+# Without a csr.json, registers are laid out with csr2mp.make_csrs().
+# If there is no "machine" module (i.e. not on the controller), memory
+# is replaced with a dictionary. This measures the dispatch overhead of
+# the accessors and not the bus.
+#
+# The import cost of each module is measured in this interpreter
+# (compile time, time to run the module, and heap kept by the module),
+# and, with --micropython, by importing the module in a new MicroPython
+# process with linux/import_bench.py. With --mpy-cross the precompiled
+# modules are measured as well.
+
+import argparse
+import gc
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+import csr2mp
+import mmio_descr
+
+class _Mem:
+    """ Stand-in for ``machine.memNN`` backed by a dictionary. """
+    def __init__(self):
+        self.d = {}
+    def __getitem__(self, addr):
+        return self.d.get(addr, 0)
+    def __setitem__(self, addr, val):
+        self.d[addr] = val
+
+def machine_module():
+    try:
+        import machine
+        return machine
+    except ImportError:
+        m = types.ModuleType("machine")
+        m.mem8 = m.mem16 = m.mem32 = _Mem()
+        sys.modules["machine"] = m
+        return m
+
+def generate(csrh, mode):
+    f = io.StringIO()
+    csr2mp.generators[mode](csrh, f).print_file()
+    return f.getvalue()
+
+def load(name, src):
+    mod = types.ModuleType(name)
+    exec(compile(src, name, "exec"), mod.__dict__)
+    return mod
+
+def import_cost(name, src):
+    """
+    :return: Tuple of the milliseconds to compile ``src``, the
+      milliseconds to run it, and the bytes of heap kept by the module
+      (its code and data) when it is done.
+    """
+    mod = types.ModuleType(name)
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    code = compile(src, name, "exec")
+    compile_ms = (time.perf_counter() - start) * 1e3
+    start = time.perf_counter()
+    exec(code, mod.__dict__)
+    run_ms = (time.perf_counter() - start) * 1e3
+    del code
+    gc.collect()
+    kept = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return compile_ms, run_ms, kept
+
+# Used when MicroPython has no "machine" module (e.g. the unix port).
+# Importing a module does not access memory.
+MACHINE_STUB = "mem8 = mem16 = mem32 = {}\n"
+
+def micropython_import(srcs, micropython, mpy_cross=None):
+    """
+    Import each module in a new MicroPython process.
+
+    :param srcs: Dictionary from mode to module source.
+    :return: List of ``(mode, file, output of import_bench.py)``.
+    """
+    bench = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "..", "linux", "import_bench.py")
+    out = []
+    with tempfile.TemporaryDirectory() as d:
+        with open(os.path.join(d, "machine.py"), "w") as f:
+            f.write(MACHINE_STUB)
+        shutil.copy(bench, d)
+        for mode, src in srcs.items():
+            name = "mmio_" + mode.replace("-", "_")
+            files = [(name, name + ".py")]
+            with open(os.path.join(d, name + ".py"), "w") as f:
+                f.write(src)
+            if mpy_cross is not None:
+                # Separate name, since MicroPython prefers the .py file.
+                subprocess.run([mpy_cross, "-o", name + "_c.mpy",
+                                name + ".py"], cwd=d, check=True)
+                files.append((name + "_c", name + "_c.mpy"))
+            for mod, fname in files:
+                r = subprocess.run([micropython, "import_bench.py", mod],
+                                   cwd=d, capture_output=True, text=True)
+                res = r.stdout.strip() if r.returncode == 0 \
+                      else f"failed: {r.stderr.strip()}"
+                out.append((mode, fname, res))
+    return out
+
+def per_call(f, n):
+    """ :return: Nanoseconds per call of ``f()``, with loop overhead removed. """
+    loop = range(n)
+    start = time.perf_counter()
+    for _ in loop:
+        pass
+    empty = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in loop:
+        f()
+    return (time.perf_counter() - start - empty) / n * 1e9
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Benchmark the modules generated by csr2mp.py")
+    parser.add_argument("csrjson", nargs="?", help="LiteX csr.json file")
+    parser.add_argument("-n", type=int, default=200000, help="calls per test")
+    parser.add_argument("--micropython",
+                        help="MicroPython interpreter to measure imports in")
+    parser.add_argument("--mpy-cross", help="also measure .mpy modules")
+    args = parser.parse_args()
+
+    csrjson = args.csrjson
+    if csrjson is None:
+        csrjson = csr2mp.make_csrs(mmio_descr.registers)
+    csrh = csr2mp.CSRHandler(csrjson, mmio_descr.registers,
+                             mmio_descr.snapshots)
+    for r in mmio_descr.registers:
+        csrh.update_reg(r)
+
+    machine_module()
+    mods = {}
+    srcs = {}
+    print(f"{'mode':<20} {'source':>8} {'compile':>10} {'run':>10} {'heap':>9}")
+    for mode, gen in csr2mp.generators.items():
+        # C modules cannot be loaded here.
+        if issubclass(gen, csr2mp.CHeaderGenerator):
+            continue
+        src = generate(csrh, mode)
+        srcs[mode] = src
+        compile_ms, run_ms, kept = import_cost(f"mmio_{mode}", src)
+        mods[mode] = load(f"mmio_{mode}", src)
+        print(f"{mode:<20} {len(src):6d} B {compile_ms:7.2f} ms "
+              f"{run_ms:7.2f} ms {kept:7d} B")
+
+    if args.micropython is not None:
+        for mode, fname, res in micropython_import(srcs, args.micropython,
+                                                   args.mpy_cross):
+            print(f"{args.micropython}: {fname:<28} {res}")
+
+    # The last instance is the worst case for the if/elif chain.
+    tests = [
+        ("read_adc_recv_buf(0)", lambda m: lambda: m.read_adc_recv_buf(0)),
+        ("read_adc_recv_buf(7)", lambda m: lambda: m.read_adc_recv_buf(7)),
+        ("write_dac_arm(1, 7)", lambda m: lambda: m.write_dac_arm(1, 7)),
+        ("read_cl_P_in()", lambda m: lambda: m.read_cl_P_in()),
+        # Bulk accessors against the equivalent single accesses.
+        ("8x read_adc_recv_buf(i)", lambda m: lambda: [m.read_adc_recv_buf(i)
+                                                      for i in range(8)]),
+        ("read_adc_recv_buf_all", lambda m: lambda: m.read_adc_recv_buf_all(buf)),
+        ("3x read_cl_*()", lambda m: lambda: (m.read_cl_z_pos(),
+                                              m.read_cl_z_measured(),
+                                              m.read_cl_cycle_count())),
+        ("read_cl_status", lambda m: lambda: m.read_cl_status()),
+    ]
+    buf = [0] * 8
+    print(f"{'call':<24}" + "".join(f"{mode:>20}" for mode in mods))
+    for name, mk in tests:
+        row = f"{name:<24}"
+        for mode, m in mods.items():
+            row += f"{per_call(mk(m), args.n):17.1f} ns"
+        print(row)
+
+if __name__ == "__main__":
+    main()
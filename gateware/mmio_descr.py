@@ -219,3 +219,10 @@ registers = [
                 Control loop ADC Z position.
                 """),
         ]
+
+# Groups of registers that are read together. For each entry, the
+# generated module has a function ``read_{name}()`` that returns a tuple
+# of the registers in the order given here.
+snapshots = {
+        "cl_status": ["cl_z_pos", "cl_z_measured", "cl_cycle_count"],
+        }
@@ -0,0 +1,56 @@
+/* Copyright 2023 (C) Peter McGoron
+ * This file is a part of Upsilon, a free and open source software project.
+ * For license terms, refer to the files in `doc/copying` in the Upsilon
+ * source distribution.
+ */
+/* Reference values of the control loop arithmetic for other models
+ * (client/control_loop_model.py).
+ *
+ * Each line of standard input is
+ *   setpt measured P I cycles e_prev adjval_prev stored_dac_val
+ * and for each line, this prints
+ *   err_cur dt idt epidt ep new_adjval new_dac_val
+ * computed as in calculate() of control_loop_math_sim.cpp. Additions wrap
+ * around instead of overflowing (which is undefined in C++).
+ */
+#include <cstdio>
+#include <cstdint>
+#include "control_loop_math_implementation.h"
+
+constexpr V per100 = 0b010101011110011000;
+constexpr V adc_to_dac = 0b0110010000000000000000000000000000000000000;
+
+static V wrap_add(V x, V y) {
+	return (V)((uint64_t)x + (uint64_t)y);
+}
+
+static V shl(V x, unsigned n) {
+	return (V)((uint64_t)x << n);
+}
+
+int main(void) {
+	long long setpt, measured, P, I, cycles, e_prev, adjval_prev, stored;
+
+	while (scanf("%lld %lld %lld %lld %lld %lld %lld %lld", &setpt,
+	             &measured, &P, &I, &cycles, &e_prev, &adjval_prev,
+	             &stored) == 8) {
+		V err_cur = mulsat((V)setpt - (V)measured, adc_to_dac, 64, CONSTS_FRAC);
+		V dt = mulsat(per100, shl(cycles, CONSTS_FRAC), 64, CONSTS_FRAC);
+		V idt = mulsat(dt, I, 64, CONSTS_FRAC);
+		V epidt = mulsat(shl(err_cur, CONSTS_FRAC), wrap_add(P, idt), 64, CONSTS_FRAC);
+		V ep = mulsat(shl(e_prev, CONSTS_FRAC), P, 64, CONSTS_FRAC);
+		V new_adjval = wrap_add(wrap_add(adjval_prev, epidt), -(uint64_t)ep);
+
+		V adj;
+		if (new_adjval > 0)
+			adj = new_adjval >> CONSTS_FRAC;
+		else
+			adj = -(uint64_t)((V)(-(uint64_t)new_adjval) >> CONSTS_FRAC);
+
+		printf("%lld %lld %lld %lld %lld %lld %lld\n",
+		       (long long)err_cur, (long long)dt, (long long)idt,
+		       (long long)epidt, (long long)ep, (long long)new_adjval,
+		       (long long)(stored + adj));
+	}
+	return 0;
+}
@@ -0,0 +1,406 @@
+#!/usr/bin/python3
+# Copyright 2023 (C) Peter McGoron
+#
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#######################################################################
+#
+# Build and run all Verilator testbenches in parallel.
+#
+#     python3 run_tests.py [-j JOBS] [--seeds N] [-G TEST:PARAM=v1,v2]
+#                          [--force] [--list] [TEST...]
+#
+# Testbenches are the "*_sim.cpp" files in each subdirectory. The build
+# of each is described in TESTS below (the same commands as the
+# subdirectory Makefiles). Every build is done in its own directory
+# under .tests/, so builds of the same testbench with different
+# parameters can run at the same time.
+#
+# A passing run is remembered in .tests/cache.json, keyed by a hash of
+# the source files of the testbench (every HDL and C++ file in its
+# directory and include directories), the build options, the run
+# parameters and the Verilator version. It is not run again until one of
+# these changes (or --force is given).
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+RTL_DIR = os.path.dirname(os.path.abspath(__file__))
+OUT_DIR = os.path.join(RTL_DIR, ".tests")
+CACHE_FILE = os.path.join(OUT_DIR, "cache.json")
+
+class Test:
+    def __init__(self, name, dir, top, sources, args=None,
+                 codegen=None, params=None, cflags=None, seeds=False,
+                 expect=None, timeout=600):
+        """
+        :param name: Name of the test (and of the testbench, ``{name}.cpp``).
+        :param dir: Subdirectory of the testbench.
+        :param top: Top module.
+        :param sources: Verilog and C++ files passed to Verilator,
+          relative to ``dir``.
+        :param args: Other Verilator arguments.
+        :param codegen: Files generated by ``make`` in ``dir`` before
+          the build.
+        :param params: Verilog parameters, passed with ``-G``.
+        :param cflags: C++ preprocessor defines.
+        :param seeds: The testbench reads ``RANDOM_SEED``, so it is run
+          once for each seed.
+        :param expect: If not ``None``, the output the testbench must
+          print to pass. Otherwise only the exit status is checked.
+        :param timeout: Seconds a run may take.
+        """
+        self.name = name
+        self.dir = dir
+        self.top = top
+        self.sources = sources
+        self.args = list(args or [])
+        self.codegen = list(codegen or [])
+        self.params = dict(params or {})
+        self.cflags = dict(cflags or {})
+        self.seeds = seeds
+        self.expect = expect
+        self.timeout = timeout
+
+CONTROL_LOOP_MATH = ["control_loop_math.v", "boothmul.v", "intsat.v",
+                     "sign_extend.v"]
+CONTROL_LOOP_IMPL = ["control_loop_math_implementation.cpp"]
+
+TESTS = [
+    Test("boothmul_sim", "control_loop", "boothmul",
+         ["boothmul.v", "boothmul_sim.cpp"],
+         # The testbench multiplies int16_t.
+         params={"A1_LEN": 16, "A2_LEN": 16, "A2LEN_SIZ": 5},
+         expect="done\n"),
+    Test("intsat_sim", "control_loop", "intsat",
+         ["intsat.v", "intsat_sim.cpp"],
+         # The testbench saturates int16_t to int8_t.
+         params={"IN_LEN": 16, "LTRUNC": 8},
+         expect=""),
+    Test("control_loop_math_sim", "control_loop", "control_loop_math",
+         CONTROL_LOOP_MATH + ["control_loop_math_sim.cpp"] + CONTROL_LOOP_IMPL,
+         args=["-DDEBUG_CONTROL_LOOP_MATH"],
+         codegen=["control_loop_math.v"],
+         params={"CONSTS_FRAC": 43}, cflags={"CONSTS_FRAC": 43, "E_WID": 21}),
+    Test("control_loop_sim", "control_loop", "control_loop_sim_top",
+         ["control_loop_sim_top.v", "control_loop.v", "control_loop_sim.cpp"]
+         + CONTROL_LOOP_IMPL + ["adc_sim.v", "dac_sim.v",
+                                "../spi/spi_master_ss.v",
+                                "../spi/spi_slave_no_read.v",
+                                "../spi/spi_slave.v"],
+         args=["-I../spi"], codegen=["control_loop.v", "control_loop_math.v"],
+         params={"CONSTS_FRAC": 43}, cflags={"CONSTS_FRAC": 43, "E_WID": 21}),
+    Test("ram_fifo_sim", "raster", "ram_fifo",
+         ["ram_fifo.v", "ram_fifo_dual_port.v", "ram_fifo_sim.cpp"]),
+    Test("ram_shim_sim", "raster", "ram_shim",
+         ["ram_shim.v", "ram_fifo.v", "ram_fifo_dual_port.v",
+          "ram_shim_sim.cpp"],
+         args=["-DRAM_SHIM_DEBUG"],
+         codegen=["ram_shim_cmds.h"], seeds=True),
+    Test("raster_sim", "raster", "raster_sim",
+         ["raster_sim.v", "raster.v", "ram_shim.v", "ram_fifo.v",
+          "ram_fifo_dual_port.v", "raster_sim.cpp"],
+         codegen=["raster_cmds.h", "ram_shim_cmds.h"], seeds=True),
+    Test("spi_switch_sim", "spi", "spi_switch",
+         ["spi_switch.v", "spi_switch_sim.cpp"]),
+    Test("bram_interface_sim", "waveform", "bram_interface_sim",
+         ["bram_interface_sim.v", "dma_sim.v", "bram_interface.v",
+          "bram_interface_sim.cpp"],
+         cflags={"WORD_AMNT": 2048, "RAM_WID": 32}),
+    Test("waveform_sim", "waveform", "waveform_sim",
+         ["waveform_sim.v", "waveform.v", "bram_interface.v", "dma_sim.v",
+          "waveform_sim.cpp", "../spi/spi_slave_no_write.v"],
+         args=["-I../spi", "-DVERILATOR_SIMULATION"],
+         cflags={"WORD_AMNT": 2048, "RAM_WID": 32}),
+]
+
+def discover(tests):
+    """
+    Find the testbenches in the tree and match them with ``tests``.
+
+    :return: Tuple of the tests that were found and the testbench files
+      that have no entry in ``tests``.
+    """
+    by_file = {os.path.join(t.dir, t.name + ".cpp"): t for t in tests}
+    found = []
+    unknown = []
+    for d in sorted(os.listdir(RTL_DIR)):
+        p = os.path.join(RTL_DIR, d)
+        if not os.path.isdir(p) or d.startswith("."):
+            continue
+        for f in sorted(os.listdir(p)):
+            if not f.endswith("_sim.cpp"):
+                continue
+            rel = os.path.join(d, f)
+            if rel in by_file:
+                found.append(by_file[rel])
+            else:
+                unknown.append(rel)
+    return found, unknown
+
+def tool_version():
+    try:
+        return subprocess.run(["verilator", "--version"], capture_output=True,
+                              text=True).stdout.strip()
+    except FileNotFoundError:
+        return None
+
+SOURCE_EXTS = (".v", ".vh", ".m4", ".cpp", ".hpp", ".h")
+
+def source_files(test):
+    """
+    :return: Sorted paths of all files that can affect the build of
+      ``test``: sources in its directory, its include directories and
+      the shared headers in this directory.
+    """
+    dirs = {os.path.join(RTL_DIR, test.dir), RTL_DIR}
+    dirs.update(os.path.normpath(os.path.join(RTL_DIR, test.dir, a[2:]))
+                for a in test.args if a.startswith("-I"))
+    files = {os.path.normpath(os.path.join(RTL_DIR, test.dir, f))
+             for f in test.sources}
+    for d in dirs:
+        files.update(os.path.join(d, f) for f in os.listdir(d)
+                     if f.endswith(SOURCE_EXTS))
+    return sorted(files)
+
+def file_hash(path, memo={}):
+    if path not in memo:
+        with open(path, "rb") as f:
+            memo[path] = hashlib.sha256(f.read()).hexdigest()
+    return memo[path]
+
+class Build:
+    """ One build of a testbench with a set of parameters. """
+
+    def __init__(self, test, params, version):
+        self.test = test
+        self.params = dict(test.params, **params)
+        desc = [test.name, test.top, test.args, sorted(self.params.items()),
+                sorted(test.cflags.items()), version]
+        h = hashlib.sha256(json.dumps(desc).encode())
+        for f in source_files(test):
+            h.update(os.path.relpath(f, RTL_DIR).encode())
+            h.update(file_hash(f).encode())
+        self.key = h.hexdigest()[:16]
+        self.dir = os.path.join(OUT_DIR, test.name, self.key)
+        self.exe = os.path.join(self.dir, "V" + test.top)
+        self.ok = None
+        self.seconds = 0.0
+        self.log = ""
+
+    def command(self):
+        t = self.test
+        cmd = ["verilator", "--cc", "--exe", "-Wall", "--trace",
+               "--trace-fst", "--top-module", t.top, "--Mdir", self.dir,
+               *t.args]
+        cmd += [f"-G{k}={v}" for k, v in self.params.items()]
+        for k, v in t.cflags.items():
+            cmd += ["-CFLAGS", f"-D{k}={v}"]
+        return cmd + t.sources
+
+    def run(self):
+        t = self.test
+        start = time.perf_counter()
+        try:
+            os.makedirs(self.dir, exist_ok=True)
+            p = subprocess.run(self.command(), cwd=os.path.join(RTL_DIR, t.dir),
+                               capture_output=True, text=True)
+            self.log = p.stdout + p.stderr
+            if p.returncode == 0:
+                p = subprocess.run(["make", "-f", f"V{t.top}.mk"],
+                                   cwd=self.dir, capture_output=True,
+                                   text=True)
+                self.log += p.stdout + p.stderr
+            self.ok = p.returncode == 0
+        except FileNotFoundError as e:
+            self.log = str(e)
+            self.ok = False
+        self.seconds = time.perf_counter() - start
+        return self
+
+class Run:
+    """ One run of a build. """
+
+    def __init__(self, build, seed):
+        self.build = build
+        self.seed = seed
+        h = hashlib.sha256(f"{build.key} {seed}".encode())
+        self.key = h.hexdigest()[:16]
+        self.status = None
+        self.seconds = 0.0
+        self.log = ""
+
+    def name(self):
+        b = self.build
+        extra = [f"{k}={v}" for k, v in b.params.items()
+                 if b.test.params.get(k) != v]
+        if self.seed is not None:
+            extra.append(f"seed={self.seed}")
+        return b.test.name + (f" [{' '.join(extra)}]" if extra else "")
+
+    def run(self):
+        t = self.build.test
+        env = dict(os.environ)
+        if self.seed is not None:
+            env["RANDOM_SEED"] = str(self.seed)
+        start = time.perf_counter()
+        try:
+            # Testbenches write their traces into the working directory.
+            p = subprocess.run([self.build.exe], cwd=self.build.dir, env=env,
+                               capture_output=True, text=True,
+                               timeout=t.timeout)
+            self.log = p.stdout + p.stderr
+            ok = p.returncode == 0 and (t.expect is None
+                                        or p.stdout == t.expect)
+            self.status = "pass" if ok else "FAIL"
+        except subprocess.TimeoutExpired:
+            self.status = "TIMEOUT"
+        self.seconds = time.perf_counter() - start
+        return self
+
+def load_cache():
+    try:
+        with open(CACHE_FILE) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+def save_cache(cache):
+    os.makedirs(OUT_DIR, exist_ok=True)
+    tmp = CACHE_FILE + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(cache, f, indent=1)
+    os.replace(tmp, CACHE_FILE)
+
+def parse_sweeps(specs):
+    """
+    :param specs: List of ``TEST:PARAM=v1,v2,...``.
+    :return: Dictionary from test name to a dictionary from parameter to
+      list of values.
+    """
+    sweeps = {}
+    for s in specs:
+        try:
+            test, rest = s.split(":", 1)
+            param, vals = rest.split("=", 1)
+        except ValueError:
+            raise Exception(f"bad sweep {s}, expected TEST:PARAM=v1,v2")
+        sweeps.setdefault(test, {})[param] = vals.split(",")
+    return sweeps
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Build and run the Verilator testbenches")
+    parser.add_argument("tests", nargs="*", help="tests to run (default all)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                        help="parallel builds and runs")
+    parser.add_argument("--seeds", type=int, default=4,
+                        help="seeds of testbenches that use RANDOM_SEED")
+    parser.add_argument("-G", dest="sweeps", action="append", default=[],
+                        help="sweep a Verilog parameter: TEST:PARAM=v1,v2")
+    parser.add_argument("--force", action="store_true",
+                        help="ignore cached results")
+    parser.add_argument("--list", action="store_true",
+                        help="list the testbenches and exit")
+    args = parser.parse_args()
+
+    found, unknown = discover(TESTS)
+    for f in unknown:
+        print(f"warning: {f} has no entry in run_tests.py", file=sys.stderr)
+    if args.tests:
+        names = {t.name for t in found}
+        for n in args.tests:
+            if n not in names:
+                parser.error(f"unknown test {n}")
+        found = [t for t in found if t.name in args.tests]
+    if args.list:
+        for t in found:
+            print(f"{t.name:<24} {t.dir}/{t.name}.cpp"
+                  + (" (seeded)" if t.seeds else ""))
+        return 0
+
+    version = tool_version()
+    if version is None:
+        print("verilator not found", file=sys.stderr)
+        return 1
+
+    # Code generation is done once for each directory, before the
+    # parallel builds, since builds share the generated files.
+    gen = {}
+    for t in found:
+        gen.setdefault(t.dir, set()).update(t.codegen)
+    for d, files in gen.items():
+        if files:
+            subprocess.run(["make", *sorted(files)],
+                           cwd=os.path.join(RTL_DIR, d), check=True,
+                           stdout=subprocess.DEVNULL)
+
+    sweeps = parse_sweeps(args.sweeps)
+    builds = []
+    runs = []
+    for t in found:
+        sw = sweeps.get(t.name, {})
+        for vals in itertools.product(*sw.values()):
+            b = Build(t, dict(zip(sw.keys(), vals)), version)
+            builds.append(b)
+            seeds = range(args.seeds) if t.seeds else [None]
+            runs += [Run(b, s) for s in seeds]
+
+    cache = {} if args.force else load_cache()
+    todo = [r for r in runs if r.key not in cache]
+    for r in runs:
+        if r.key in cache:
+            r.status = "cached"
+            r.seconds = cache[r.key]["seconds"]
+    need = {id(r.build): r.build for r in todo}
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.jobs) as ex:
+        # Runs wait for their build, so submit them as builds finish.
+        pending = [ex.submit(b.run) for b in need.values()]
+        run_futures = []
+        for fut in as_completed(pending):
+            b = fut.result()
+            mine = [r for r in todo if r.build is b]
+            if not b.ok:
+                for r in mine:
+                    r.status = "BUILD FAILED"
+                continue
+            run_futures += [ex.submit(r.run) for r in mine]
+        for fut in run_futures:
+            fut.result()
+    wall = time.perf_counter() - start
+
+    failed = 0
+    for r in runs:
+        if r.status == "pass":
+            cache[r.key] = {"name": r.name(), "seconds": r.seconds,
+                            "time": time.time()}
+        elif r.status != "cached":
+            failed += 1
+            log = os.path.join(OUT_DIR, r.build.test.name, f"{r.key}.log")
+            os.makedirs(os.path.dirname(log), exist_ok=True)
+            with open(log, "w") as f:
+                f.write(r.build.log + r.log)
+            print(f"{r.name()}: {r.status}, log in {os.path.relpath(log)}",
+                  file=sys.stderr)
+    save_cache(cache)
+
+    print(f"{'test':<44} {'status':<13} {'build':>8} {'run':>8}")
+    for r in runs:
+        build = f"{r.build.seconds:7.1f}s" if r.build.ok is not None else ""
+        print(f"{r.name():<44} {r.status:<13} {build:>8} {r.seconds:7.1f}s")
+    print(f"{len(runs)} runs, {len(todo)} not cached, {failed} failed, "
+          f"{wall:.1f} s wall time with {args.jobs} jobs")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
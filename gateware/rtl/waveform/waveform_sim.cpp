@@ -4,6 +4,8 @@
  * source distribution.
  */
 /* TODO: impleement reset for dma and test both separetely */
+#include <cstdio>
+#include <cstdlib>
 #include <vector>
 #include "Vwaveform_sim.h"
 #include "../testbench.hpp"
@@ -17,14 +19,35 @@ public:
 	int cur_ind;
 	void posedge() override;
 	void refresh_data();
+	void load_image(const char *path);
 	WaveformTestbench(int _bailout = 0) : TB<Vwaveform_sim>(_bailout)
 	                                    , ram_refresh_data{}
 	                                    , cur_ind{0} {}
 };
 
+/* Load an image made by client/waveform.py: WORD_AMNT little-endian
+ * 32 bit words, each a sign extended 20 bit value.
+ */
+void WaveformTestbench::load_image(const char *path) {
+	FILE *f = fopen(path, "rb");
+	my_assert(f != NULL, "cannot open %s", path);
+	for (size_t i = 0; i < WORD_AMNT; i++) {
+		unsigned char b[4];
+		my_assert(fread(b, 1, 4, f) == 4, "%s is short", path);
+		ram_refresh_data[i] = b[0] | b[1] << 8 | b[2] << 16
+		                    | (uint32_t)b[3] << 24;
+	}
+	fclose(f);
+}
+
+/* Fill the RAM with WAVEFORM_IMAGE, or with random data if it is not set. */
 void WaveformTestbench::refresh_data() {
+	const char *image = getenv("WAVEFORM_IMAGE");
+	if (image)
+		load_image(image);
 	for (size_t i = 0; i < WORD_AMNT; i++) {
-		uint32_t val = mask_extend(rand(), 20);
+		uint32_t val = image ? ram_refresh_data[i]
+		                     : mask_extend(rand(), 20);
 		ram_refresh_data[i] = val;
 		mod.backing_store[i*2] = val & 0xFFFF;
 		mod.backing_store[i*2+1] = val >> 16;
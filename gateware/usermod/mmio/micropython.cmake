@@ -0,0 +1,19 @@
+# Copyright 2023 (C) Peter McGoron
+#
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Native "mmio" module for CMake based ports. See micropython.mk.
+
+add_library(usermod_mmio INTERFACE)
+
+target_sources(usermod_mmio INTERFACE
+    ${CMAKE_CURRENT_LIST_DIR}/mmio.c
+)
+
+target_include_directories(usermod_mmio INTERFACE
+    ${CMAKE_CURRENT_LIST_DIR}
+)
+
+target_link_libraries(usermod INTERFACE usermod_mmio)
@@ -0,0 +1,17 @@
+# Copyright 2023 (C) Peter McGoron
+#
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Native "mmio" module. Generate mmio.c with "make usermod" in gateware/,
+# then build MicroPython with
+#
+#     make USER_C_MODULES=/path/to/upsilon/gateware/usermod
+#
+# The module replaces mmio.py: do not copy mmio.py to the controller.
+
+MMIO_MOD_DIR := $(USERMOD_DIR)
+
+SRC_USERMOD += $(MMIO_MOD_DIR)/mmio.c
+CFLAGS_USERMOD += -I$(MMIO_MOD_DIR)
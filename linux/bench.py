@@ -0,0 +1,78 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Benchmark of the Upsilon Micropython Standard Library. Prints the
+# operations per second of common operations. Runs on the controller,
+# or on the host with ``emu/run.py bench.py``.
+#
+# Usage: micropython bench.py [iterations]
+
+from comm import *
+from time import ticks_us, ticks_diff
+from sys import argv
+
+def bench(name, f, n, per=1, unit="ops/s"):
+    """
+    Run ``f()`` ``n`` times and print the rate. ``per`` is the number of
+    operations done by one call of ``f``.
+    """
+    start = ticks_us()
+    for i in range(n):
+        f()
+    t = ticks_diff(ticks_us(), start)
+    if t <= 0:
+        t = 1
+    print(name, n * per * 1000000 // t, unit)
+
+n = int(argv[1]) if len(argv) > 1 else 1000
+
+dac_init(0)
+write_adc_sel(0, 0)
+bench("dac_write_volt", lambda: dac_write_volt(0, 0), n)
+bench("adc_read", lambda: adc_read(0), n)
+bench("dac_init", lambda: dac_init(0), n // 10 + 1)
+
+# Sample rates of single reads against block reads.
+from array import array
+buf = array('i', [0] * 100)
+def adc_loop():
+    for i in range(len(buf)):
+        buf[i] = adc_read(0)
+bench("adc_read loop", adc_loop, n // 100 + 1, 100, "samples/s")
+bench("adc_read_block", lambda: adc_read_block(0, len(buf), buf),
+      n // 100 + 1, 100, "samples/s")
+bench("dac_ramp_and_sample", lambda: dac_ramp_and_sample(0, 0, 0, 10, 1, 10, buf),
+      n // 100 + 1, 100, "samples/s")
+
+# Per-channel sample rates of reading all ADCs one after another against
+# reading them at the same time.
+chans = tuple(range(8))
+for c in chans:
+    write_adc_sel(0, c)
+rounds = len(buf) // len(chans)
+def adc_serial():
+    for c in chans:
+        adc_read_block(c, rounds, buf, c * rounds)
+bench("adc_read_block serial 8ch", adc_serial, n // 100 + 1, rounds,
+      "samples/s/ch")
+bench("adc_read_many 8ch", lambda: adc_read_many(chans, buf), n // 10 + 1, 1,
+      "samples/s/ch")
+bench("adc_read_block_many 8ch",
+      lambda: adc_read_block_many(chans, rounds, buf), n // 100 + 1, rounds,
+      "samples/s/ch")
+bench("adc_stream_many 8ch",
+      lambda: adc_stream_many(chans, buf, lambda b: None, 4), n // 400 + 1,
+      4 * rounds, "samples/s/ch")
+
+# The control loop only applies changes while it is running.
+write_dac_sel(0b10, 0)
+write_adc_sel(0b100, 0)
+cl = ControlLoop()
+cl.start(0, 0, 0, 0)
+bench("cl set_params", lambda: cl.set_params(0, 0, 0, 0), n // 10 + 1)
+cl.print_stats()
+cl.stop()
+write_dac_sel(0, 0)
+write_adc_sel(0, 0)
@@ -5,6 +5,9 @@
 #
 # Upsilon Micropython Standard Library.
 
+import sys
+import struct
+from time import ticks_us, ticks_diff, sleep_us
 from mmio import *
 
 # Write a 20 bit twos-complement value to a DAC.
@@ -46,3 +49,237 @@ def adc_read(num):
     write_adc_arm(1, num)
     write_adc_arm(0, num)
     return read_adc_recv_buf(num) 
+
+# Block acquisition. See ``comm_block.py``.
+try:
+    from comm_block import *
+except SyntaxError:
+    # No native code emitter: compile the same file as bytecode. The
+    # decorator lines are blanked, so line numbers stay the same.
+    _path = __file__.rsplit('/', 1)[0] + '/comm_block.py' \
+            if '/' in __file__ else 'comm_block.py'
+    with open(_path) as _f:
+        _src = _f.read().replace("@micropython.native\n", "\n")
+    exec(compile(_src, _path, "exec"), globals())
+    del _path, _f, _src
+
+def dac_ramp_and_sample(dac, adc, start, stop, step, per_step, buf):
+    """
+    Sweep a DAC over ``range(start, stop, step)`` and read ``per_step``
+    ADC samples at each DAC value.
+
+    :param buf: ``array('i')`` with room for ``per_step`` samples per
+      DAC value. The samples of the k-th DAC value are at
+      ``buf[k*per_step:(k+1)*per_step]``.
+    :return: Number of samples read.
+    """
+    off = 0
+    for v in range(start, stop, step):
+        dac_write_volt(v, dac)
+        adc_read_block(adc, per_step, buf, off)
+        off += per_step
+    return off
+
+def adc_stream_many(chans, buf, on_full, blocks=0,
+                    timeout_us=ADC_TIMEOUT_US):
+    """
+    Sample the ADCs in ``chans`` continuously, as in
+    ``adc_read_block_many``.
+
+    :param buf: ``array('i')`` that is filled again and again. Its
+      length should be a multiple of ``len(chans)``.
+    :param on_full: Called with ``buf`` each time it is full, e.g. to
+      send it with ``FrameWriter``. Return ``False`` to stop.
+    :param blocks: Number of times to fill ``buf``. ``0`` runs until
+      ``on_full`` returns ``False``.
+    :param timeout_us: Time to wait for each conversion.
+    :return: Number of times ``buf`` was filled.
+    :raises Exception: If a conversion does not finish in time.
+    """
+    n = len(buf) // len(chans)
+    done = 0
+    while blocks == 0 or done < blocks:
+        adc_read_block_many(chans, n, buf, 0, timeout_us)
+        done += 1
+        if on_full(buf) is False:
+            break
+    return done
+
+
+# Binary sample frames.
+#
+# Printing samples as text is slow on the controller and slow to parse
+# on the client. Bulk data is instead sent as frames. Each frame is a
+# 12 byte little-endian header
+#
+#   magic   2 bytes  b'UP'
+#   channel 1 byte   stream ID (meaning is up to the script)
+#   bits    1 byte   significant bits of each sample
+#   flags   1 byte   FRAME_SIGNED if samples are twos-complement
+#   (pad)   1 byte
+#   count   2 bytes  number of samples
+#   seq     4 bytes  frame sequence number
+#
+# followed by ``count`` 32 bit little-endian samples. The client decodes
+# these with ``util.FrameDecoder``.
+
+FRAME_MAGIC = b'UP'
+FRAME_HEADER = '<2sBBBBHI'
+FRAME_SIGNED = 1
+
+class FrameWriter:
+    def __init__(self, stream=None):
+        """
+        :param stream: Binary stream to write frames to. Defaults to
+          standard output.
+        """
+        if stream is None:
+            stream = sys.stdout.buffer
+        self.stream = stream
+        self.seq = 0
+
+    def write(self, channel, bits, buf, n=None, signed=True):
+        """
+        Write a frame of samples.
+
+        :param channel: Stream ID of the samples.
+        :param bits: Significant bits of each sample.
+        :param buf: ``array('i')`` of samples. The raw contents of the
+          array are written, so no per-sample formatting is done.
+        :param n: Number of samples of ``buf`` to send. Defaults to all.
+        :param signed: Samples are twos-complement integers of length
+          ``bits``.
+        """
+        if n is None:
+            n = len(buf)
+        flags = FRAME_SIGNED if signed else 0
+        self.stream.write(struct.pack(FRAME_HEADER, FRAME_MAGIC, channel,
+                                      bits, flags, 0, n, self.seq))
+        self.stream.write(memoryview(buf)[:n])
+        self.seq = (self.seq + 1) & 0xFFFFFFFF
+
+# Control loop client.
+#
+# The control loop reads its parameters from the ``cl_*_in`` registers
+# only when the ``cl_assert_change``/``cl_change_made`` handshake is
+# done (see ``mmio_descr``). All parameters written before the handshake
+# are applied together at the start of a loop cycle.
+
+class ControlLoop:
+    def __init__(self, spin_budget=32, backoff_us=10, max_backoff_us=2000,
+                 timeout_ms=500):
+        """
+        :param spin_budget: Number of times a flag is polled without
+          waiting before backing off.
+        :param backoff_us: First wait after the spin budget is used up.
+          The wait doubles up to ``max_backoff_us``.
+        :param timeout_ms: Time to wait for the control loop to respond
+          before raising an exception.
+        """
+        self.spin_budget = spin_budget
+        self.backoff_us = backoff_us
+        self.max_backoff_us = max_backoff_us
+        self.timeout_us = timeout_ms * 1000
+
+        # Handshake statistics.
+        self.handshakes = 0
+        self.timeouts = 0
+        self.spins = 0
+        self.last_us = 0
+        self.max_us = 0
+        self.total_us = 0
+
+    def _wait(self, read, val, start):
+        """
+        Poll ``read()`` until it returns ``val``.
+
+        :raises Exception: On timeout.
+        """
+        spins = 0
+        wait = self.backoff_us
+        while read() != val:
+            spins += 1
+            if spins <= self.spin_budget:
+                continue
+            if ticks_diff(ticks_us(), start) > self.timeout_us:
+                self.spins += spins
+                self.timeouts += 1
+                raise Exception("control loop handshake timed out")
+            sleep_us(wait)
+            wait = min(wait * 2, self.max_backoff_us)
+        self.spins += spins
+
+    def _handshake(self):
+        start = ticks_us()
+        write_cl_assert_change(1)
+        try:
+            self._wait(read_cl_change_made, 1, start)
+        finally:
+            write_cl_assert_change(0)
+        # The next handshake is only seen once the loop has lowered
+        # change_made.
+        self._wait(read_cl_change_made, 0, start)
+
+        t = ticks_diff(ticks_us(), start)
+        self.handshakes += 1
+        self.last_us = t
+        self.total_us += t
+        if t > self.max_us:
+            self.max_us = t
+
+    def _write_params(self, setpt, P, I, delay):
+        if setpt is not None:
+            write_cl_setpt_in(setpt)
+        if P is not None:
+            write_cl_P_in(P)
+        if I is not None:
+            write_cl_I_in(I)
+        if delay is not None:
+            write_cl_delay_in(delay)
+
+    def set_params(self, setpt=None, P=None, I=None, delay=None):
+        """
+        Change loop parameters in one handshake. Parameters that are
+        ``None`` keep their current values.
+
+        The loop only applies changes while it is running.
+
+        :param setpt: Setpoint in ADC units (twos-complement).
+        :param P: Proportional constant in 21.43 fixed point.
+        :param I: Integral constant in 21.43 fixed point.
+        :param delay: Cycles to wait between loop iterations.
+        :raises Exception: If the loop is not running or does not
+          respond.
+        """
+        if not read_cl_in_loop():
+            raise Exception("control loop is not running")
+        self._write_params(setpt, P, I, delay)
+        self._handshake()
+
+    def start(self, setpt=None, P=None, I=None, delay=None):
+        """
+        Start the loop with the given parameters. The loop resets the
+        setpoint, I and delay when it stops, so pass all of them.
+        """
+        self._write_params(setpt, P, I, delay)
+        write_cl_run_loop_in(1)
+        self._handshake()
+
+    def stop(self):
+        write_cl_run_loop_in(0)
+
+    def running(self):
+        return read_cl_in_loop()
+
+    def status(self):
+        """
+        :return: Tuple of ``cl_z_pos``, ``cl_z_measured`` and
+          ``cl_cycle_count`` (raw).
+        """
+        return read_cl_status()
+
+    def print_stats(self):
+        avg = self.total_us // self.handshakes if self.handshakes else 0
+        print("handshakes", self.handshakes, "timeouts", self.timeouts,
+              "spins", self.spins, "last_us", self.last_us,
+              "avg_us", avg, "max_us", self.max_us)
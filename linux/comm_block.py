@@ -0,0 +1,159 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Block acquisition, imported by ``comm.py``.
+#
+# These functions fill preallocated buffers so that no objects are
+# allocated per sample. Use ``array('i')`` buffers: they hold 32 bit
+# integers on both the controller and the host, and they can be sent
+# with ``FrameWriter`` without conversion.
+#
+# ``adc_read_many`` and ``adc_read_block_many`` run the transfers of
+# several ADCs at the same time. They read every receive buffer with
+# one ``read_adc_recv_buf_all`` call into ``_adc_all``.
+#
+# The native code emitter is not built into every MicroPython port (for
+# instance RV32 before MicroPython 1.23), and ``@micropython.native``
+# is a syntax error on those ports. ``comm.py`` then compiles this file
+# without the decorators, so the functions run as bytecode.
+
+import micropython
+from array import array
+from time import ticks_us, ticks_diff
+from mmio import *
+
+# A conversion takes a few microseconds. A ``finished`` flag that stays
+# low for much longer means that the ADC master is stuck.
+ADC_TIMEOUT_US = 10000
+# Polls of a flag before the time is checked, as in ``ControlLoop``.
+SPIN_BUDGET = 32
+
+_adc_all = array('i', [0] * 8)
+
+@micropython.native
+def wait_finished(finished, num, timeout_us=ADC_TIMEOUT_US):
+    """
+    Poll ``finished(num)`` until it is true. The first ``SPIN_BUDGET``
+    polls do not look at the time.
+
+    :return: ``False`` if the flag stayed low for ``timeout_us``.
+    """
+    spins = 0
+    start = 0
+    while not finished(num):
+        spins += 1
+        if spins < SPIN_BUDGET:
+            continue
+        if spins == SPIN_BUDGET:
+            start = ticks_us()
+        elif ticks_diff(ticks_us(), start) > timeout_us:
+            return False
+    return True
+
+@micropython.native
+def adc_read_block(num, n, buf, off=0, timeout_us=ADC_TIMEOUT_US):
+    """
+    Read ``n`` samples from an ADC into ``buf[off:off+n]``.
+
+    Unlike ``adc_read``, this waits for each conversion to finish.
+
+    :param num: ADC number.
+    :param n: Number of samples.
+    :param buf: ``array('i')`` of raw (not sign extended) samples.
+    :param off: Index of the first sample in ``buf``.
+    :param timeout_us: Time to wait for a conversion.
+    :return: ``buf``
+    :raises Exception: If a conversion does not finish in time.
+    """
+    arm = write_adc_arm
+    finished = read_adc_finished
+    recv = read_adc_recv_buf
+    for i in range(off, off + n):
+        arm(1, num)
+        if not wait_finished(finished, num, timeout_us):
+            arm(0, num)
+            raise Exception("ADC %d timed out" % num)
+        buf[i] = recv(num)
+        arm(0, num)
+    return buf
+
+@micropython.native
+def _disarm_all(chans):
+    arm = write_adc_arm
+    for c in chans:
+        arm(0, c)
+
+@micropython.native
+def adc_read_many(chans, buf, off=0, timeout_us=ADC_TIMEOUT_US):
+    """
+    Read one sample from each ADC in ``chans``.
+
+    All ADCs are armed before any is waited for, so their transfers run
+    at the same time and the call takes about as long as one transfer.
+
+    :param chans: Sequence of ADC numbers.
+    :param buf: ``array('i')``. The sample of ``chans[k]`` is put in
+      ``buf[off+k]``.
+    :param timeout_us: Time to wait for each ADC.
+    :return: ``buf``
+    :raises Exception: If a conversion does not finish in time. All ADCs
+      in ``chans`` are disarmed.
+    """
+    arm = write_adc_arm
+    finished = read_adc_finished
+    cur = _adc_all
+    for c in chans:
+        arm(1, c)
+    for c in chans:
+        if not wait_finished(finished, c, timeout_us):
+            _disarm_all(chans)
+            raise Exception("ADC %d timed out" % c)
+    read_adc_recv_buf_all(cur)
+    for c in chans:
+        arm(0, c)
+    for k in range(len(chans)):
+        buf[off + k] = cur[chans[k]]
+    return buf
+
+@micropython.native
+def adc_read_block_many(chans, n, buf, off=0, timeout_us=ADC_TIMEOUT_US):
+    """
+    Read ``n`` samples from each ADC in ``chans``, with the transfers of
+    all ADCs running at the same time.
+
+    The next transfers are started before the received samples are put
+    in ``buf``, so copying overlaps with conversion.
+
+    :param buf: ``array('i')`` with room for ``n*len(chans)`` samples.
+      Samples are interleaved: sample ``i`` of ``chans[k]`` is at
+      ``buf[off + i*len(chans) + k]``.
+    :param timeout_us: Time to wait for each ADC.
+    :return: ``buf``
+    :raises Exception: If a conversion does not finish in time. All ADCs
+      in ``chans`` are disarmed.
+    """
+    arm = write_adc_arm
+    finished = read_adc_finished
+    recv_all = read_adc_recv_buf_all
+    cur = _adc_all
+    m = len(chans)
+    for c in chans:
+        arm(1, c)
+    for i in range(n):
+        for c in chans:
+            if not wait_finished(finished, c, timeout_us):
+                _disarm_all(chans)
+                raise Exception("ADC %d timed out" % c)
+        # The receive buffers are only stable between transfers.
+        recv_all(cur)
+        for c in chans:
+            arm(0, c)
+        if i + 1 < n:
+            for c in chans:
+                arm(1, c)
+        j = off + i * m
+        for k in range(m):
+            buf[j + k] = cur[chans[k]]
+    return buf
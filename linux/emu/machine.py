@@ -0,0 +1,29 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Host emulation of the parts of the MicroPython ``machine`` module used
+# by the generated ``mmio`` module. Accesses are passed to the
+# ``regmodel.RegisterModel`` set with ``attach()``.
+
+_model = None
+
+def attach(model):
+    """ Send all memory accesses to ``model``. """
+    global _model
+    _model = model
+
+class _Mem:
+    def __init__(self, width):
+        self.width = width
+
+    def __getitem__(self, addr):
+        return _model.read(addr, self.width)
+
+    def __setitem__(self, addr, val):
+        _model.write(addr, self.width, val)
+
+mem8 = _Mem(8)
+mem16 = _Mem(16)
+mem32 = _Mem(32)
@@ -0,0 +1,16 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Host stand-in for the MicroPython ``micropython`` module. The code
+# emitters are no-ops on the host.
+
+def native(f):
+    return f
+
+def viper(f):
+    return f
+
+def const(x):
+    return x
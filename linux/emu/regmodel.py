@@ -0,0 +1,411 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Register model of the Upsilon SoC for running controller scripts on a
+# host computer.
+#
+# The register layout is built from a LiteX "csr.json" and
+# ``mmio_descr.registers``, the same way ``csr2mp.py`` generates the
+# ``mmio`` module. Register reads and writes are passed to behavioral
+# models that emulate the SPI masters, the DACs and ADCs attached to them
+# and the control loop.
+
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', '..', 'gateware'))
+import csr2mp
+import mmio_descr
+
+def sign_extend(value, bits):
+    """ Interpret ``value`` as a twos-complement integer of ``bits`` length. """
+    if (value >> (bits - 1)) & 1:
+        return value - (1 << bits)
+    return value
+
+def saturate(value, bits):
+    """ Clamp ``value`` to a twos-complement integer of ``bits`` length. """
+    hi = (1 << (bits - 1)) - 1
+    return max(-hi - 1, min(hi, value))
+
+# Conversion from 20 bit DAC units (-10 V to 10 V) to 18 bit ADC units
+# (-10.24 V to 10.24 V).
+DAC_TO_ADC = (20 / 2**20) / (20.48 / 2**18)
+
+class RegisterModel:
+    """
+    Values of all MMIO registers, and the models attached to them.
+
+    Registers are identified by ``(name, num)``, where ``num`` is ``None``
+    for registers with one instance.
+    """
+
+    def __init__(self, csrjson=None, registers=mmio_descr.registers,
+                 timing=True, clock=time.perf_counter):
+        """
+        :param csrjson: Filename or contents of a LiteX "csr.json" file.
+          If ``None``, the layout of ``csr2mp.make_csrs`` is used.
+        :param registers: A list of ``mmio_descr`` ``Descr``s.
+        :param timing: If ``True``, SPI transfers and control loop cycles
+          take (approximately) as long as they do in hardware. If ``False``,
+          transfers finish at the next register access, and the control
+          loop runs one cycle per register access.
+        :param clock: Function returning the current time in seconds.
+        """
+        if csrjson is None:
+            csrjson = csr2mp.make_csrs(registers)
+        self.csr = csr2mp.CSRHandler(csrjson, registers)
+        self.timing = timing
+        self.clock = clock
+        self.now = clock()
+        self.models = []
+
+        self.regs = {}
+        self.values = {}
+        # Address -> (key, part), where part is "hi" or "lo" for the
+        # two words of a 64 bit register and None otherwise.
+        self.addrs = {}
+        for reg in registers:
+            self.csr.update_reg(reg)
+            nums = [None] if reg.num == 1 else range(reg.num)
+            for num in nums:
+                key = (reg.name, num)
+                self.regs[key] = reg
+                self.values[key] = 0
+                addr = self.csr.get_reg_addr(reg, num)
+                if reg.regsize == 64:
+                    # Big CSR ordering: high word at the lower address.
+                    self.addrs[addr] = (key, "hi")
+                    self.addrs[addr + 4] = (key, "lo")
+                else:
+                    self.addrs[addr] = (key, None)
+
+        # Counters of accesses by register name.
+        self.reads = {}
+        self.writes = {}
+
+    def add(self, model):
+        """ Attach a behavioral model. :return: ``model`` """
+        self.models.append(model)
+        model.attach(self)
+        return model
+
+    def get(self, name, num=None):
+        """ Get a register value without side effects. """
+        return self.values[(name, num)]
+
+    def set(self, name, num, val):
+        """
+        Set a register value without side effects. Models use this to
+        update read-only registers.
+        """
+        key = (name, num)
+        self.values[key] = val & ((1 << self.regs[key].blen) - 1)
+
+    def advance(self):
+        """ Run all models up to the current time. """
+        self.now = self.clock()
+        for m in self.models:
+            m.advance(self.now)
+
+    def _lookup(self, addr):
+        try:
+            return self.addrs[addr]
+        except KeyError:
+            raise Exception(f"bus error: no register at {addr:#x}")
+
+    def read(self, addr, width):
+        """ Emulate ``machine.memNN[addr]``. """
+        key, part = self._lookup(addr)
+        self.advance()
+        self.reads[key[0]] = self.reads.get(key[0], 0) + 1
+        val = self.values[key]
+        if part == "lo":
+            val &= 0xFFFFFFFF
+        elif part == "hi":
+            val >>= 32
+        return val & ((1 << width) - 1)
+
+    def write(self, addr, width, val):
+        """ Emulate ``machine.memNN[addr] = val``. """
+        key, part = self._lookup(addr)
+        reg = self.regs[key]
+        if reg.rwperm == "read-only":
+            raise Exception(f"write to read-only register {key}")
+        self.advance()
+        self.writes[key[0]] = self.writes.get(key[0], 0) + 1
+
+        val &= (1 << width) - 1
+        old = self.values[key]
+        if part == "lo":
+            val = (old & ~0xFFFFFFFF) | val
+        elif part == "hi":
+            val = (old & 0xFFFFFFFF) | (val << 32)
+        self.set(key[0], key[1], val)
+        for m in self.models:
+            m.on_write(key[0], key[1], self.values[key], old)
+
+class Model:
+    """ Base class for behavioral models. """
+
+    def attach(self, rm):
+        self.rm = rm
+
+    def on_write(self, name, num, val, old):
+        """ Called after a register is written. """
+        pass
+
+    def advance(self, now):
+        """ Called before every register access. """
+        pass
+
+class SPIModel(Model):
+    """
+    Common ``arm``/``finished`` handshake of the MMIO SPI masters.
+
+    Raising ``{prefix}_arm`` starts a transfer that finishes after
+    ``duration`` seconds. If ``{prefix}_arm`` is still high then,
+    ``{prefix}_finished`` is raised. Lowering ``{prefix}_arm`` lowers
+    ``{prefix}_finished``. Subclasses implement ``transfer()``.
+    """
+
+    def __init__(self, prefix, num, duration):
+        self.prefix = prefix
+        self.num = num
+        self.duration = duration
+        self.done_at = None
+
+    def on_write(self, name, num, val, old):
+        if num != self.num or name != f"{self.prefix}_arm":
+            return
+        if val and not old and self.done_at is None:
+            duration = self.duration if self.rm.timing else 0
+            self.done_at = self.rm.now + duration
+            self.start()
+        elif not val:
+            self.rm.set(f"{self.prefix}_finished", self.num, 0)
+
+    def advance(self, now):
+        if self.done_at is not None and now >= self.done_at:
+            self.done_at = None
+            self.transfer()
+            if self.rm.get(f"{self.prefix}_arm", self.num):
+                self.rm.set(f"{self.prefix}_finished", self.num, 1)
+
+    def start(self):
+        """ Called when a transfer starts. """
+        pass
+
+    def transfer(self):
+        """ Called when a transfer finishes. """
+        pass
+
+class DACModel(SPIModel):
+    """
+    Analog Devices 20 bit DAC on an MMIO SPI master.
+
+    Each transfer shifts out the response to the previous transfer: the
+    register contents after a read command, and an echo of the previous
+    command otherwise.
+    """
+
+    def __init__(self, num, transfer_time=24*20*10e-9):
+        super().__init__("dac", num, transfer_time)
+        self.dac_regs = {}
+        self.out = 0
+        self.word = 0
+
+    def start(self):
+        self.word = self.rm.get("dac_send_buf", self.num)
+
+    def transfer(self):
+        # Another master (the control loop) controls the DAC.
+        if self.rm.get("dac_sel", self.num) != 0:
+            return
+        self.rm.set("dac_recv_buf", self.num, self.out)
+        word = self.word
+        reg = (word >> 20) & 0x7
+        if (word >> 23) & 1:
+            self.out = (word & 0xF00000) | self.dac_regs.get(reg, 0)
+        else:
+            self.dac_regs[reg] = word & 0xFFFFF
+            self.out = word
+
+    @property
+    def value(self):
+        """ DAC output as a signed integer. """
+        return sign_extend(self.dac_regs.get(1, 0), 20)
+
+    @value.setter
+    def value(self, v):
+        self.dac_regs[1] = v & 0xFFFFF
+
+class NoisyADCModel(SPIModel):
+    """
+    Linear Technologies 18 bit ADC on an MMIO SPI master, measuring
+    ``gain*source() + offset`` with gaussian noise.
+    """
+
+    def __init__(self, num, source=None, gain=1.0, offset=0.0, noise=2.0,
+                 conv_time=(53 + 18*10)*10e-9, seed=None):
+        """
+        :param source: Function returning the measured quantity. Defaults
+          to 0.
+        :param noise: Standard deviation of the noise in ADC units.
+        """
+        super().__init__("adc", num, conv_time)
+        self.source = source
+        self.gain = gain
+        self.offset = offset
+        self.noise = noise
+        self.rng = random.Random(seed)
+
+    def sample(self):
+        x = self.source() if self.source is not None else 0
+        x = self.gain*x + self.offset + self.rng.gauss(0, self.noise)
+        return saturate(round(x), 18)
+
+    def transfer(self):
+        # 0b10 flushes the ADC without receiving data, and 0b100 gives
+        # the ADC to the control loop.
+        if self.rm.get("adc_sel", self.num) != 0:
+            return
+        self.rm.set("adc_recv_buf", self.num, self.sample())
+
+class ControlLoopModel(Model):
+    """
+    Control loop running on a first-order plant.
+
+    The plant output relaxes to ``gain*z_pos + offset`` with time
+    constant ``tau``. The loop follows ``control_loop_math`` in floating
+    point, so results are close to but not bit-exact with the hardware.
+    """
+
+    CYCLE_TIME = 10e-9
+    ADC_TO_DAC = 50/128
+
+    def __init__(self, dac=None, gain=DAC_TO_ADC, offset=0.0, tau=1e-3,
+                 noise=2.0, base_cycles=1000, max_steps=1000, seed=None):
+        """
+        :param dac: ``DACModel`` of the DAC the loop controls. Its value
+          is the initial Z position, and it follows the loop output while
+          ``dac_sel`` gives it to the loop.
+        :param base_cycles: Clock cycles of a loop iteration without
+          delay.
+        :param max_steps: Maximum iterations to run between register
+          accesses. If the host cannot keep up, the loop runs slower than
+          in real time.
+        """
+        self.dac = dac
+        self.gain = gain
+        self.offset = offset
+        self.tau = tau
+        self.noise = noise
+        self.base_cycles = base_cycles
+        self.max_steps = max_steps
+        self.rng = random.Random(seed)
+
+        self.running = False
+        self.setpt = 0
+        self.P = 0.0
+        self.I = 0.0
+        self.delay = 0
+        self.y = 0.0
+        self.z = 0
+        self.next_iter = 0
+        self.reset()
+
+    def reset(self):
+        self.setpt = 0
+        self.I = 0.0
+        self.delay = 0
+        self.e_prev = 0
+        self.adj_prev = 0.0
+
+    def on_write(self, name, num, val, old):
+        rm = self.rm
+        if name == "cl_run_loop_in":
+            if val and not self.running:
+                self.running = True
+                self.z = self.dac.value if self.dac is not None else 0
+                self.next_iter = rm.now
+                rm.set("cl_in_loop", None, 1)
+            elif not val and self.running:
+                self.running = False
+                self.reset()
+                rm.set("cl_in_loop", None, 0)
+        elif name == "cl_assert_change" and not val:
+            rm.set("cl_change_made", None, 0)
+
+    def period(self):
+        return (self.base_cycles + self.delay) * self.CYCLE_TIME
+
+    def advance(self, now):
+        if not self.running:
+            return
+        if not self.rm.timing:
+            steps = 1
+        else:
+            if now < self.next_iter:
+                return
+            n = int((now - self.next_iter) / self.period()) + 1
+            self.next_iter += n * self.period()
+            steps = min(n, self.max_steps)
+        for _ in range(steps):
+            self.step()
+
+    def step(self):
+        rm = self.rm
+        # Parameters are applied at the start of a cycle.
+        if rm.get("cl_assert_change") and not rm.get("cl_change_made"):
+            rm.set("cl_change_made", None, 1)
+            self.setpt = sign_extend(rm.get("cl_setpt_in"), 18)
+            self.P = sign_extend(rm.get("cl_P_in"), 64) / 2**43
+            self.I = sign_extend(rm.get("cl_I_in"), 64) / 2**43
+            self.delay = rm.get("cl_delay_in")
+            self.e_prev = 0
+            self.adj_prev = 0.0
+
+        cycles = (self.base_cycles + self.delay) & ((1 << 18) - 1)
+        dt = self.period()
+        alpha = 1 - math.exp(-dt / self.tau)
+        self.y += (self.gain*self.z + self.offset - self.y) * alpha
+        measured = saturate(round(self.y + self.rng.gauss(0, self.noise)), 18)
+
+        e = math.floor((self.setpt - measured) * self.ADC_TO_DAC)
+        adj = self.adj_prev + e*(self.P + self.I*cycles*self.CYCLE_TIME) \
+              - self.e_prev*self.P
+        self.z = saturate(self.z + math.trunc(adj), 20)
+        self.e_prev = e
+        self.adj_prev = adj
+
+        rm.set("cl_z_pos", None, self.z)
+        rm.set("cl_z_measured", None, measured)
+        rm.set("cl_cycle_count", None, cycles)
+        if self.dac is not None and rm.get("dac_sel", self.dac.num) == 0b10:
+            self.dac.value = self.z
+
+def default_model(csrjson=None, timing=True, seed=None, noise=2.0):
+    """
+    Register model with a DAC and a noisy ADC on each of the 8 channels
+    and a control loop on DAC 0. Each ADC measures the DAC of the same
+    number.
+
+    :return: The ``RegisterModel``.
+    """
+    rm = RegisterModel(csrjson, timing=timing)
+    rng = random.Random(seed)
+    dacs = [rm.add(DACModel(i)) for i in range(8)]
+    for i, dac in enumerate(dacs):
+        rm.add(NoisyADCModel(i, source=lambda dac=dac: dac.value,
+                             gain=DAC_TO_ADC, noise=noise,
+                             seed=rng.getrandbits(32)))
+    rm.add(ControlLoopModel(dac=dacs[0], noise=noise,
+                            seed=rng.getrandbits(32)))
+    return rm
@@ -0,0 +1,116 @@
+#!/usr/bin/python3
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Run a controller script from ``linux/`` on the host:
+#
+#     python3 linux/emu/run.py [--csr csr.json] noise_test.py [args...]
+#
+# The script runs unmodified against an emulated ``machine`` module. The
+# ``mmio`` module is generated with ``csr2mp.py``, and the registers are
+# backed by ``regmodel.default_model()``.
+
+import argparse
+import io
+import os
+import runpy
+import sys
+import time
+import types
+
+EMU_DIR = os.path.dirname(os.path.abspath(__file__))
+LINUX_DIR = os.path.dirname(EMU_DIR)
+
+def install_time():
+    """ Add the MicroPython extensions of the ``time`` module. """
+    time.sleep_ms = lambda ms: time.sleep(ms / 1000)
+    time.sleep_us = lambda us: time.sleep(us / 1000000)
+    time.ticks_ms = lambda: time.perf_counter_ns() // 1000000
+    time.ticks_us = lambda: time.perf_counter_ns() // 1000
+    time.ticks_cpu = time.perf_counter_ns
+    time.ticks_add = lambda t, delta: t + delta
+    time.ticks_diff = lambda new, old: new - old
+
+def install_mmio(rm, mode="micropython", profile=False):
+    """
+    Generate the ``mmio`` module for the register layout of ``rm`` and
+    make it importable.
+
+    :param profile: Generate the module with the access profiler (see
+      ``csr2mp.ProfileGenerator``).
+    """
+    import csr2mp
+    import mmio_descr
+
+    f = io.StringIO()
+    csrh = csr2mp.CSRHandler(rm.csr.csrs, mmio_descr.registers,
+                             mmio_descr.snapshots)
+    for r in mmio_descr.registers:
+        csrh.update_reg(r)
+    gen = csr2mp.generators[mode](csrh, f)
+    if profile:
+        gen = csr2mp.ProfileGenerator(gen)
+    gen.print_file()
+
+    mod = types.ModuleType("mmio")
+    mod.__file__ = "<mmio>"
+    exec(compile(f.getvalue(), "mmio.py", "exec"), mod.__dict__)
+    sys.modules["mmio"] = mod
+    return mod
+
+def setup(csrjson=None, mode="micropython", timing=True, seed=None,
+          profile=False):
+    """
+    Set up the emulated controller in this interpreter.
+
+    :return: The ``regmodel.RegisterModel`` of the controller.
+    """
+    for d in (LINUX_DIR, EMU_DIR):
+        if d not in sys.path:
+            sys.path.insert(0, d)
+    import machine
+    import regmodel
+
+    install_time()
+    rm = regmodel.default_model(csrjson, timing=timing, seed=seed)
+    machine.attach(rm)
+    install_mmio(rm, mode, profile)
+    return rm
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Run a controller script on an emulated controller")
+    parser.add_argument("--csr", help="LiteX csr.json file")
+    parser.add_argument("--mode", default="micropython",
+                        help="csr2mp.py mode of the mmio module")
+    parser.add_argument("--no-timing", action="store_true",
+                        help="finish SPI transfers instantly")
+    parser.add_argument("--seed", type=int, help="noise seed")
+    parser.add_argument("--profile", action="store_true",
+                        help="print the register accesses of the script")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="write the register accesses as JSON")
+    parser.add_argument("script", help="script in linux/")
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    profile = args.profile or args.profile_json is not None
+    setup(args.csr, args.mode, not args.no_timing, args.seed, profile)
+    script = args.script
+    if not os.path.exists(script):
+        script = os.path.join(LINUX_DIR, script)
+    sys.argv = [script] + args.args
+    try:
+        runpy.run_path(script, run_name="__main__")
+    finally:
+        if profile:
+            mmio = sys.modules["mmio"]
+            if args.profile:
+                mmio.profile_dump()
+            if args.profile_json is not None:
+                mmio.profile_dump(args.profile_json, as_json=True)
+
+if __name__ == "__main__":
+    main()
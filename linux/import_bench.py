@@ -0,0 +1,39 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Measure the time and heap taken by importing modules, e.g. to compare
+# the "mmio" modules generated by each csr2mp.py mode (copied to the
+# controller as mmio_table.py, mmio_compact.mpy, ...):
+#
+# Usage: micropython import_bench.py [module ...]
+#
+# Each module is imported once, in a fresh interpreter ideally, since a
+# module that is already imported is not measured. Under CPython the heap
+# is measured with tracemalloc. (The emulator generates "mmio" before
+# the script runs: use gateware/csr2mp_bench.py on the host instead.)
+
+import gc
+import sys
+from time import ticks_us, ticks_diff
+
+try:
+    mem_alloc = gc.mem_alloc
+except AttributeError:
+    import tracemalloc
+    tracemalloc.start()
+    mem_alloc = lambda: tracemalloc.get_traced_memory()[0]
+
+names = sys.argv[1:] if len(sys.argv) > 1 else ["mmio"]
+for name in names:
+    if name in sys.modules:
+        print(name, "already imported")
+        continue
+    gc.collect()
+    before = mem_alloc()
+    start = ticks_us()
+    __import__(name)
+    t = ticks_diff(ticks_us(), start)
+    gc.collect()
+    print(name, t, "us", mem_alloc() - before, "bytes")
@@ -1,10 +1,16 @@
 from comm import *
-from time import sleep_ms
+from array import array
 
+# Channel 0 frames carry the DAC setting, channel 1 frames carry the
+# ADC samples taken at that setting.
 dac_init(0)
 write_adc_sel(0,0)
+out = FrameWriter()
+dac = array('i', [0])
+samples = array('i', [0] * 20)
 for i in range(-300,300):
     dac_write_volt(i, 0)
-    for j in range(0,20):
-        print(i, adc_read(0))
-
+    dac[0] = i
+    out.write(0, 20, dac)
+    adc_read_block(0, len(samples), samples)
+    out.write(1, 18, samples)
@@ -0,0 +1,266 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Resident RPC server.
+#
+# Starting MicroPython, importing ``mmio`` and initializing the DACs
+# takes longer than most single operations. This server is started once,
+# keeps the hardware initialized, and runs requests sent over a TCP
+# port. The client side is ``client/rpc.py``.
+#
+# Usage: micropython rpcd.py [port] [dac ...]
+#
+# The listed DACs (default 0) are initialized at startup.
+#
+# A request is a 12 byte little-endian header
+#
+#   magic   2 bytes  b'UR'
+#   op      1 byte   operation (OP_* below)
+#   (pad)   1 byte
+#   id      4 bytes  request ID, copied into the reply
+#   length  4 bytes  length of the arguments
+#
+# followed by the arguments as 64 bit little-endian signed integers. A
+# reply has the same header with magic b'UA' and the status (0 on
+# success) in the pad byte, followed by the result: 32 bit little-endian
+# samples, or the error message if the status is not 0.
+#
+# Requests are run in the order they arrive and replies are sent in the
+# same order, so a client can send several requests before reading the
+# replies. One client is served at a time.
+
+import socket
+import struct
+from array import array
+from sys import argv
+from comm import *
+
+# The constants below are repeated in client/rpc.py and must match it.
+RPC_PORT = 5018
+
+REQ_MAGIC = b'UR'
+REPLY_MAGIC = b'UA'
+HEADER = '<2sBBII'
+HEADER_SIZE = 12
+
+# Limit on the arguments of one request.
+MAX_ARGS = 64
+# Limit on the samples of one reply. The sample buffer is allocated once
+# with this size.
+MAX_SAMPLES = 65536
+
+OP_PING = 0
+OP_DAC_WRITE = 1     # dac, value
+OP_ADC_READ = 2      # adc, n -> n samples
+OP_ADC_READ_MANY = 3 # n, adc... -> n rounds of one sample per ADC
+OP_RAMP = 4          # dac, adc, start, stop, step, per_step -> samples
+OP_CL_START = 5      # setpt, P, I, delay
+OP_CL_SET = 6        # setpt, P, I, delay
+OP_CL_STOP = 7
+OP_CL_STATUS = 8     # -> z_pos, z_measured, cycle_count (raw)
+
+class Server:
+    def __init__(self, port=RPC_PORT, dacs=(0,), max_samples=MAX_SAMPLES):
+        """
+        :param dacs: DACs to initialize.
+        :param max_samples: Size of the sample buffer, and the largest
+          number of samples a request may ask for.
+        """
+        for d in dacs:
+            dac_init(d)
+        self.cl = ControlLoop()
+        # Current settings of dac_sel and adc_sel 0, so that they are only
+        # written when they change.
+        self.dac_sel = None
+        self.adc_sel = None
+        self.select(0, 0)
+
+        self.buf = array('i', [0] * max_samples)
+        self.header = bytearray(HEADER_SIZE)
+        self.args = bytearray(8 * MAX_ARGS)
+        self.requests = 0
+        self.errors = 0
+
+        self.handlers = {
+            OP_PING: self.ping,
+            OP_DAC_WRITE: self.dac_write,
+            OP_ADC_READ: self.adc_read,
+            OP_ADC_READ_MANY: self.adc_read_many,
+            OP_RAMP: self.ramp,
+            OP_CL_START: self.cl_start,
+            OP_CL_SET: self.cl_set,
+            OP_CL_STOP: self.cl_stop,
+            OP_CL_STATUS: self.cl_status,
+        }
+
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(socket.getaddrinfo("0.0.0.0", port)[0][-1])
+        self.sock.listen(1)
+
+    def select(self, dac_sel, adc_sel):
+        """ Give DAC 0 and ADC 0 to the MMIO masters or the control loop. """
+        if dac_sel != self.dac_sel:
+            write_dac_sel(dac_sel, 0)
+            self.dac_sel = dac_sel
+        if adc_sel != self.adc_sel:
+            write_adc_sel(adc_sel, 0)
+            self.adc_sel = adc_sel
+
+    def samples(self, n):
+        """
+        :return: The sample buffer, if ``n`` samples fit in it.
+        :raises Exception: If ``n`` is negative or too large.
+        """
+        if n < 0 or n > len(self.buf):
+            raise Exception("%d samples, not in [0, %d]" % (n, len(self.buf)))
+        return self.buf
+
+    def check_dac(self, num):
+        """ :raises Exception: If the control loop has the DAC. """
+        if num == 0 and self.dac_sel != 0:
+            raise Exception("DAC 0 is controlled by the control loop")
+
+    def check_adc(self, num):
+        """ :raises Exception: If the control loop has the ADC. """
+        if num == 0 and self.adc_sel != 0:
+            raise Exception("ADC 0 is controlled by the control loop")
+
+    # Handlers take the arguments and return the number of samples of
+    # ``self.buf`` in the result. Arguments are checked before anything
+    # is done, so that bad requests get an error reply.
+
+    def ping(self, a):
+        return 0
+
+    def dac_write(self, a):
+        self.check_dac(a[0])
+        dac_write_volt(a[1], a[0])
+        return 0
+
+    def adc_read(self, a):
+        adc, n = a
+        self.check_adc(adc)
+        adc_read_block(adc, n, self.samples(n))
+        return n
+
+    def adc_read_many(self, a):
+        chans = a[1:]
+        for c in chans:
+            self.check_adc(c)
+        if a[0] < 0:
+            raise Exception("negative sample count")
+        n = a[0] * len(chans)
+        adc_read_block_many(chans, a[0], self.samples(n))
+        return n
+
+    def ramp(self, a):
+        dac, adc, start, stop, step, per_step = a
+        self.check_dac(dac)
+        self.check_adc(adc)
+        if per_step < 0:
+            raise Exception("negative sample count")
+        n = len(range(start, stop, step)) * per_step
+        return dac_ramp_and_sample(dac, adc, start, stop, step, per_step,
+                                   self.samples(n))
+
+    def cl_start(self, a):
+        self.select(0b10, 0b100)
+        self.cl.start(*a)
+        return 0
+
+    def cl_set(self, a):
+        self.cl.set_params(*a)
+        return 0
+
+    def cl_stop(self, a):
+        self.cl.stop()
+        self.select(0, 0)
+        return 0
+
+    def cl_status(self, a):
+        b = self.buf
+        b[0], b[1], b[2] = read_cl_status()
+        return 3
+
+    def _recv(self, buf, n):
+        mv = memoryview(buf)
+        got = 0
+        while got < n:
+            k = self.recv_into(mv[got:n])
+            if not k:
+                return False
+            got += k
+        return True
+
+    def _reply(self, op, status, rid, data, size):
+        struct.pack_into(HEADER, self.header, 0, REPLY_MAGIC, op, status,
+                         rid, size)
+        self.send(self.header)
+        if size:
+            self.send(data)
+
+    def handle(self):
+        """ Run one request. :return: ``False`` if the client left. """
+        if not self._recv(self.header, HEADER_SIZE):
+            return False
+        magic, op, _, rid, length = struct.unpack(HEADER, self.header)
+        if magic != REQ_MAGIC or length % 8 or length > len(self.args):
+            raise Exception("bad request header")
+        if not self._recv(self.args, length):
+            return False
+        a = struct.unpack('<%dq' % (length // 8), self.args[:length]) \
+            if length else ()
+        self.requests += 1
+        try:
+            f = self.handlers.get(op)
+            if f is None:
+                raise Exception("unknown op %d" % op)
+            n = f(a)
+        except Exception as e:
+            self.errors += 1
+            msg = str(e).encode()
+            self._reply(op, 1, rid, msg, len(msg))
+            return True
+        self._reply(op, 0, rid, memoryview(self.buf)[:n], 4 * n)
+        return True
+
+    def serve(self):
+        while True:
+            sock, addr = self.sock.accept()
+            print("rpc: connected", addr)
+            # MicroPython sockets have ``readinto``, and CPython sockets
+            # (in the emulator) have ``recv_into``.
+            self.recv_into = getattr(sock, "recv_into", None) or sock.readinto
+            self.send = sock.sendall
+            # Replies are written as a header and the samples. Without
+            # TCP_NODELAY the samples wait for the ACK of the header. The
+            # MicroPython socket module may not define the constants, so
+            # the Linux values are the defaults.
+            try:
+                sock.setsockopt(getattr(socket, "IPPROTO_TCP", 6),
+                                getattr(socket, "TCP_NODELAY", 1), 1)
+            except OSError:
+                pass
+            try:
+                while self.handle():
+                    pass
+            except Exception as e:
+                print("rpc:", e)
+            sock.close()
+            print("rpc: disconnected, requests", self.requests,
+                  "errors", self.errors)
+
+    def close(self):
+        self.sock.close()
+
+if __name__ == "__main__":
+    port = int(argv[1]) if len(argv) > 1 else RPC_PORT
+    dacs = [int(d) for d in argv[2:]] or [0]
+    s = Server(port, dacs)
+    try:
+        s.serve()
+    finally:
+        s.close()
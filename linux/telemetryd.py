@@ -0,0 +1,228 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Control loop telemetry service.
+#
+# Samples ``cl_z_pos``, ``cl_z_measured`` and ``cl_cycle_count`` at a
+# fixed rate into a ring buffer, and sends them in frames (see
+# ``comm.FrameWriter``) to every client connected to a TCP port. The
+# client side is ``client/telemetry.py``.
+#
+# Usage: micropython telemetryd.py [rate_hz] [port] [batch]
+#
+# Each batch is sent as four frames of ``batch`` samples with the same
+# length, one for each channel below. The index channel is the number of
+# the sampling slot (time since start divided by the period), so missed
+# slots and samples overwritten in the ring buffer of a slow client show
+# up as gaps in the index.
+#
+# Client sockets are non-blocking, so a slow client never holds up
+# sampling. Each client has an output buffer of one batch. A batch is
+# only put in it once the previous one is sent, and until then the
+# samples wait in the ring buffer.
+
+import socket
+import struct
+from array import array
+from errno import EAGAIN
+from sys import argv
+from time import ticks_ms, ticks_us, ticks_diff, sleep_us
+from comm import *
+
+TELEMETRY_PORT = 5017
+
+CH_INDEX = 0
+CH_Z_POS = 1
+CH_Z_MEASURED = 2
+CH_CYCLE_COUNT = 3
+
+class _Client:
+    """
+    Connected client, its position in the ring buffer, and the frames
+    that are not sent yet.
+    """
+    def __init__(self, sock, pos, out_size):
+        self.sock = sock
+        self.pos = pos
+        self.frames = FrameWriter(self)
+        self.out = bytearray(out_size)
+        self.out_mv = memoryview(self.out)
+        # Bytes of ``out`` that are not sent yet.
+        self.start = 0
+        self.end = 0
+        # Samples lost because the client fell behind.
+        self.dropped = 0
+        # Last time the client took data (or had nothing to take).
+        self.last_ms = ticks_ms()
+
+    def write(self, b):
+        # The samples come as a view of an ``array('i')``, which
+        # MicroPython does not copy into a byte buffer, so copy the raw
+        # bytes first (once per frame).
+        b = bytes(b)
+        n = len(b)
+        self.out_mv[self.end:self.end + n] = b
+        self.end += n
+
+    def flush(self):
+        """
+        Send as much of the output buffer as the socket takes.
+
+        :return: ``True`` if the buffer is empty.
+        """
+        while self.start < self.end:
+            try:
+                k = self.sock.send(self.out_mv[self.start:self.end])
+            except OSError as e:
+                if e.args[0] != EAGAIN:
+                    raise
+                k = 0
+            if not k:
+                return False
+            self.start += k
+            self.last_ms = ticks_ms()
+        self.start = self.end = 0
+        self.last_ms = ticks_ms()
+        return True
+
+class Telemetry:
+    def __init__(self, rate_hz=1000, port=TELEMETRY_PORT, batch=128,
+                 size=4096, timeout=1):
+        """
+        :param rate_hz: Samples per second.
+        :param port: TCP port to listen on.
+        :param batch: Samples per frame.
+        :param size: Samples kept in the ring buffer. A client that falls
+          behind by more than this loses the oldest samples.
+        :param timeout: Seconds a client may take no data before it is
+          disconnected, and time to wait for each client when the last
+          samples are sent.
+        """
+        if batch > size:
+            raise Exception("batch is larger than the ring buffer")
+        self.period_us = 1000000 // rate_hz
+        self.batch = batch
+        self.size = size
+        self.timeout = timeout
+
+        self.index = array('i', [0] * size)
+        self.z_pos = array('i', [0] * size)
+        self.z_measured = array('i', [0] * size)
+        self.cycle_count = array('i', [0] * size)
+        # Total number of samples taken.
+        self.written = 0
+        # Number of sampling slots that were missed.
+        self.missed = 0
+        # Samples lost by clients that fell behind.
+        self.dropped = 0
+        self.clients = []
+        # Bytes of the four frames of a batch.
+        self.batch_bytes = 4 * (struct.calcsize(FRAME_HEADER) + 4 * batch)
+
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(socket.getaddrinfo("0.0.0.0", port)[0][-1])
+        self.sock.listen(2)
+        self.sock.setblocking(False)
+
+    def sample(self, slot):
+        i = self.written % self.size
+        self.index[i] = slot
+        self.z_pos[i], self.z_measured[i], self.cycle_count[i] = \
+            read_cl_status()
+        self.written += 1
+
+    def accept(self):
+        try:
+            sock, addr = self.sock.accept()
+        except OSError:
+            return
+        sock.setblocking(False)
+        # New clients start with the next sample.
+        self.clients.append(_Client(sock, self.written, self.batch_bytes))
+        print("telemetry: connected", addr)
+
+    def _send(self, c, flush):
+        lag = self.written - c.pos
+        if lag > self.size:
+            c.dropped += lag - self.size
+            self.dropped += lag - self.size
+            c.pos = self.written - self.size
+        while True:
+            if not c.flush():
+                if ticks_diff(ticks_ms(), c.last_ms) > self.timeout * 1000:
+                    raise OSError("client stalled")
+                return
+            n = self.written - c.pos
+            if n == 0 or (n < self.batch and not flush):
+                return
+            start = c.pos % self.size
+            n = min(n, self.batch, self.size - start)
+            end = start + n
+            w = c.frames
+            w.write(CH_INDEX, 32, memoryview(self.index)[start:end])
+            w.write(CH_Z_POS, 20, memoryview(self.z_pos)[start:end])
+            w.write(CH_Z_MEASURED, 18, memoryview(self.z_measured)[start:end])
+            w.write(CH_CYCLE_COUNT, 18, memoryview(self.cycle_count)[start:end],
+                    signed=False)
+            c.pos += n
+
+    def send(self, flush=False):
+        """
+        Send full batches to all clients.
+
+        :param flush: Also send partial batches, and wait up to
+          ``timeout`` for each client to take them.
+        """
+        for c in self.clients[:]:
+            try:
+                if flush:
+                    c.sock.settimeout(self.timeout)
+                self._send(c, flush)
+            except OSError:
+                print("telemetry: disconnected, dropped", c.dropped)
+                c.sock.close()
+                self.clients.remove(c)
+
+    def run(self, duration_s=None):
+        """
+        Sample until ``duration_s`` seconds have passed, or forever.
+        """
+        start = ticks_us()
+        slot = 0
+        while duration_s is None or slot * self.period_us < duration_s * 1000000:
+            self.sample(slot)
+            self.accept()
+            self.send()
+
+            # Skip the slots that passed while sending.
+            now = slot + 1
+            late = ticks_diff(ticks_us(), start) // self.period_us
+            if late > now:
+                self.missed += late - now
+                now = late
+            slot = now
+            wait = slot * self.period_us - ticks_diff(ticks_us(), start)
+            if wait > 0:
+                sleep_us(wait)
+        self.send(flush=True)
+
+    def close(self):
+        for c in self.clients:
+            c.sock.close()
+        self.clients = []
+        self.sock.close()
+
+if __name__ == "__main__":
+    rate = int(argv[1]) if len(argv) > 1 else 1000
+    port = int(argv[2]) if len(argv) > 2 else TELEMETRY_PORT
+    batch = int(argv[3]) if len(argv) > 3 else 128
+    t = Telemetry(rate, port, batch)
+    try:
+        t.run()
+    finally:
+        print("telemetry: samples", t.written, "missed", t.missed,
+              "dropped", t.dropped)
+        t.close()
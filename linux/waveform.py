@@ -0,0 +1,64 @@
+# Copyright 2023 (C) Peter McGoron
+# This file is a part of Upsilon, a free and open source software project.
+# For license terms, refer to the files in `doc/copying` in the Upsilon
+# source distribution.
+#
+# Load waveform images (made by client/waveform.py) into the RAM that the
+# waveform module reads.
+#
+# Usage: micropython waveform.py load IMAGE ADDR [DEV]
+#        micropython waveform.py dump ADDR OUT [DEV]
+#
+# The image is copied with one write to /dev/mem (or DEV) at the physical
+# address ADDR, instead of one machine.mem32 write per word.
+
+import sys
+
+WORD_AMNT = 2048
+IMAGE_BYTES = 4 * WORD_AMNT
+
+def load_image(image, addr, dev="/dev/mem"):
+    """
+    Copy an image to physical memory.
+
+    :param image: Bytes of the image.
+    :param addr: Physical address of the waveform buffer.
+    :raises Exception: When the image or address is bad, or the copy is
+      short.
+    """
+    if len(image) != IMAGE_BYTES:
+        raise Exception("image is %d bytes, not %d" % (len(image), IMAGE_BYTES))
+    if addr % 4 != 0:
+        raise Exception("address %x is not word aligned" % addr)
+    with open(dev, "r+b") as f:
+        f.seek(addr)
+        n = f.write(image)
+    if n != len(image):
+        raise Exception("wrote %d of %d bytes" % (n, len(image)))
+
+def read_image(addr, dev="/dev/mem"):
+    """ :return: Bytes of the image at ``addr``. """
+    with open(dev, "rb") as f:
+        f.seek(addr)
+        return f.read(IMAGE_BYTES)
+
+def load_file(path, addr, dev="/dev/mem"):
+    """ Load an image file and check that the RAM has the image. """
+    with open(path, "rb") as f:
+        image = f.read()
+    load_image(image, addr, dev)
+    if read_image(addr, dev) != image:
+        raise Exception("RAM does not match %s" % path)
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 4 and sys.argv[1] == "load":
+        dev = sys.argv[4] if len(sys.argv) > 4 else "/dev/mem"
+        load_file(sys.argv[2], int(sys.argv[3], 0), dev)
+        print("loaded", sys.argv[2])
+    elif len(sys.argv) >= 4 and sys.argv[1] == "dump":
+        dev = sys.argv[4] if len(sys.argv) > 4 else "/dev/mem"
+        with open(sys.argv[3], "wb") as f:
+            f.write(read_image(int(sys.argv[2], 0), dev))
+    else:
+        print("usage: waveform.py load IMAGE ADDR [DEV]")
+        print("       waveform.py dump ADDR OUT [DEV]")